@@ -0,0 +1,680 @@
+"""Asyncio server for the commit emailer.
+
+Serves the same routes as the flask app in emailer.py, and shares its
+config, signature checking, push parsing, message building, dedup and
+metrics. The github PR lookup and the SMTP delivery use non-blocking
+clients, so a single process can keep hundreds of webhooks in flight
+instead of one per gunicorn worker thread. Run it with:
+
+    python aioemailer.py --port $PORT
+
+Emails are delivered in the background and the webhook answered with a 202,
+at most GITHUB_COMMIT_EMAILER_QUEUE_SIZE at a time. With
+GITHUB_COMMIT_EMAILER_DELIVERY_WORKERS=0 the email is sent before
+responding. Digest mode and the outbox keep their own threads, so emails go
+to them from a thread pool when they are configured. Likewise, calls that
+may wait on shared state (see emailer._open_state()) are made from the
+thread pool when it is configured.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextvars
+import http
+import json
+import logging
+import os
+import re
+import signal
+import smtplib
+import ssl
+import sys
+import time
+import urllib.parse
+
+import emailer
+
+
+async def start_server(host, port):
+    """Returns started asyncio server for the app on host and port."""
+    return await asyncio.start_server(_handle_connection, host, port,
+                                      limit=_HEAD_LIMIT)
+
+
+async def serve(host, port, drain_timeout=30):
+    """Serve the app until SIGTERM or SIGINT, then wait up to drain_timeout
+    seconds for emails still being delivered."""
+    server = await start_server(host, port)
+    logging.info('Listening on %s:%s.', host, port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    server.close()
+    await server.wait_closed()
+    if _tasks:
+        logging.info('Waiting for %d emails.', len(_tasks))
+        await asyncio.wait(_tasks, timeout=drain_timeout)
+    await _smtp_pool.close()
+
+
+class _HTTPError(Exception):
+    """Raised while handling a request to answer it with status."""
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class _Request(object):
+    """HTTP request whose body has not been read yet."""
+
+    def __init__(self, method, path, headers, reader):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.reader = reader
+        self.body_read = False
+        length = headers.get('content-length')
+        self.content_length = int(length) if length is not None else None
+        if not self.content_length:
+            self.body_read = True
+
+
+async def _handle_connection(reader, writer):
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                break
+            except asyncio.LimitOverrunError:
+                _write_response(writer, 431, {}, b'', False)
+                break
+            try:
+                request = _parse_request(head, reader)
+            except ValueError:
+                _write_response(writer, 400, {}, b'', False)
+                break
+            status, headers, body = await _dispatch(request)
+            keep_alive = (request.body_read and
+                          request.headers.get('connection', '').lower() !=
+                          'close')
+            _write_response(writer, status, headers, body, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def _parse_request(head, reader):
+    """Returns _Request for the request line and headers in head."""
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/1.'):
+        raise ValueError(version)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    if version == 'HTTP/1.0' and 'connection' not in headers:
+        headers['connection'] = 'close'
+    path = urllib.parse.urlsplit(target).path
+    return _Request(method, path, headers, reader)
+
+
+def _write_response(writer, status, headers, body, keep_alive):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    headers = dict(headers)
+    headers.setdefault('Content-Type', 'text/html; charset=utf-8')
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    lines = ['HTTP/1.1 {0} {1}'.format(status, http.HTTPStatus(status).phrase)]
+    lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+async def _dispatch(request):
+    """Returns (status, headers, body) answering request."""
+    try:
+        route = _ROUTES.get(request.path)
+        if route is None:
+            raise _HTTPError(404)
+        method, handler = route
+        if request.method != method:
+            raise _HTTPError(405)
+        return await handler(request)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        raise
+    except _HTTPError as e:
+        return e.status, {}, http.HTTPStatus(e.status).phrase
+    except Exception:
+        logging.exception('Error handling %s %s.', request.method,
+                          request.path)
+        emailer._errors.report()
+        return 500, {}, http.HTTPStatus(500).phrase
+
+
+async def index(request):
+    """Redirect to chapel homepage."""
+    return 301, {'Location': 'http://chapel-lang.org/'}, ''
+
+
+async def metrics(request):
+    """Report metrics in Prometheus text format."""
+    return (200, {'Content-Type': 'text/plain; version=0.0.4'},
+            emailer._metrics.render())
+
+
+async def commit_email(request):
+    """Receive web hook from github and generate email."""
+
+    # Only look at push events. Ignore the rest.
+    event = request.headers.get('x-github-event')
+    delivery = request.headers.get('x-github-delivery')
+    with emailer._WebhookLog(delivery, event):
+        if event != 'push':
+            return 200, {}, emailer._skip('not_push')
+
+        # Verify signature while reading the body.
+        config = emailer._get_config()
+        with emailer._metrics.timer('signature'):
+            body = await _read_signed_body(request, config)
+        if body is None:
+            logging.warn('Invalid signature, skipping request.')
+            return 200, {}, emailer._skip('bad_signature')
+
+        dedup = emailer._dedup
+        try:
+            msg_info, dedup_key = await _call(
+                dedup.state, emailer._push_msg_info, delivery, body, config)
+        except emailer._Skip as e:
+            return 200, {}, emailer._skip(e.reason)
+
+        if emailer._delivery_queue.workers == 0:
+            try:
+                await _deliver(msg_info)
+            except Exception:
+                # Let github's retry through.
+                await _call(dedup.state, dedup.discard, dedup_key)
+                raise
+            return 200, {}, 'yep'
+
+        if len(_tasks) >= emailer._delivery_queue.maxsize:
+            logging.error('Too many emails in flight, rejecting request.')
+            emailer._metrics.inc('commit_emailer_webhooks_rejected_total')
+            await _call(dedup.state, dedup.discard, dedup_key)
+            emailer._log_webhook('busy')
+            return 503, {}, 'busy'
+        # The task runs with a copy of this context, and so this webhook's
+        # _WebhookLog.
+        task = asyncio.create_task(_deliver_in_background(msg_info))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        return 202, {}, 'yep'
+
+
+_ROUTES = {
+    '/': ('GET', index),
+    '/metrics': ('GET', metrics),
+    '/commit-email': ('POST', commit_email),
+}
+
+
+async def _read_signed_body(request, config):
+    """Returns request body if it is signed with the configured secret. None,
+    otherwise. Like emailer._read_signed_body, but reads from the stream
+    without blocking."""
+    gh_signature, algorithm = emailer._signature_header(request.headers)
+    if gh_signature is None:
+        return None
+    if request.content_length is None:
+        raise _HTTPError(411)
+    if request.content_length > config.max_body:
+        raise _HTTPError(413)
+
+    mac = config.secret_macs[algorithm].copy()
+    chunks = []
+    remaining = request.content_length
+    while remaining:
+        chunk = await request.reader.readexactly(
+            min(remaining, emailer._BODY_CHUNK_SIZE))
+        remaining -= len(chunk)
+        mac.update(chunk)
+        chunks.append(chunk)
+    request.body_read = True
+
+    if not emailer._signature_matches(gh_signature, algorithm, mac):
+        return None
+    return b''.join(chunks)
+
+
+async def _deliver_in_background(msg_info):
+    try:
+        await _deliver(msg_info)
+    except Exception:
+        logging.exception('Failed to deliver email.')
+        emailer._errors.report()
+
+
+async def _deliver(msg_info):
+    """Look up the PR url for msg_info and send the notification email."""
+    decision = 'failed'
+    try:
+        if msg_info['pr_url'] is None:
+            msg_info['pr_url'] = await _get_pr_url(
+                msg_info['repo'], msg_info['sha'], msg_info.get('deadline'))
+        sent = await _send_email(msg_info)
+        decision = emailer._delivered(sent)
+    finally:
+        emailer._log_webhook(decision)
+
+
+async def _send_email(msg_info):
+    """Create and send commit notification email. Returns False if the
+    outbox kept it to retry later, otherwise True."""
+    if emailer._digest is not None or emailer._outbox is not None:
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, context.run,
+                                          emailer._send_email, msg_info)
+
+    sender, route, subject, body, html_body = emailer._email_for(msg_info)
+    message = emailer._build_message(sender, route, subject, body, html_body)
+    await _smtp_pool.sendmail(sender, route.recipients, message)
+    return True
+
+
+async def _get_pr_url(repo, sha, deadline=None):
+    """Returns html url of the PR that introduced sha, or "Unavailable" if
+    github cannot tell us by deadline, a time.monotonic() value. Successful
+    lookups are cached."""
+    cache = emailer._pr_url_cache
+    pr_url = await _call(cache.state, cache.get, (repo, sha))
+    if pr_url is not None:
+        return pr_url
+
+    limiter = emailer._github_limiter
+    reservation = await _call(limiter.state, emailer._reserve_github_lookup,
+                              deadline)
+    if reservation is None:
+        return 'Unavailable'
+    wait, timeout = reservation
+    await asyncio.sleep(wait)
+
+    url = emailer._pr_lookup_url(repo, sha)
+    try:
+        with emailer._metrics.timer('pr_lookup'):
+            try:
+                status, headers, body = await asyncio.wait_for(
+                    _get(url, emailer._github_headers()), timeout)
+            except Exception:
+                emailer._github_breaker.record(False)
+                raise
+        emailer._github_breaker.record(status < 500)
+        await _call(limiter.state, limiter.observe, status, headers)
+        if status != 200:
+            raise IOError('github answered {0}'.format(status))
+        pulls = json.loads(body)
+        emailer._log_payload('github_pulls', pulls)
+        pr_url = pulls[0]['html_url']
+    except Exception as e:
+        logging.error('Could not fetch PR url from github: %r', e)
+        return 'Unavailable'
+    await _call(cache.state, cache.put, (repo, sha), pr_url)
+    return pr_url
+
+
+async def _call(state, func, *args):
+    """Returns func(*args). If state is set, func may wait on it, so it is
+    run in the default thread pool instead of blocking the event loop, in a
+    copy of this context."""
+    if state is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, context.run, func, *args)
+
+
+async def _get(url, headers):
+    """Returns (status, headers, body) of the response to a GET of url.
+    Response header names are lower case.
+
+    Each request uses a new connection, closed afterwards.
+    """
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=_ssl_context() if https else None,
+        limit=_HEAD_LIMIT)
+    try:
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        lines = ['GET {0} HTTP/1.1'.format(path),
+                 'Host: {0}'.format(parts.netloc),
+                 'User-Agent: github-email-notifications',
+                 'Connection: close']
+        lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        response_headers = {}
+        for line in lines[1:]:
+            if line:
+                name, value = line.split(':', 1)
+                response_headers[name.strip().lower()] = value.strip()
+        body = await _read_response_body(reader, response_headers)
+    finally:
+        writer.close()
+    return status, response_headers, body
+
+
+async def _read_response_body(reader, headers):
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        return b''.join(chunks)
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read()
+
+
+_ssl_contexts = []
+
+
+def _ssl_context():
+    # Loading the CA bundle is slow, so share one context.
+    if not _ssl_contexts:
+        _ssl_contexts.append(ssl.create_default_context())
+    return _ssl_contexts[0]
+
+
+class _AsyncSMTP(object):
+    """Non-blocking SMTP client connection. Errors are raised as the
+    smtplib exceptions smtplib.SMTP.sendmail would raise."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pipelining = False
+
+    @classmethod
+    async def connect(cls, host, port, login=None, password=None):
+        """Returns connection to host and port, logged in if login is set
+        and the server offers AUTH."""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), _SMTP_TIMEOUT)
+        self = cls(reader, writer)
+        try:
+            code, msg = await self.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, msg)
+            code, msg = await self.command('EHLO {0}'.format(_LOCAL_HOSTNAME))
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, msg)
+            features = msg.decode('latin-1').lower().split('\n')
+            self.pipelining = 'pipelining' in features
+            if login and any(f.startswith('auth') for f in features):
+                token = base64.b64encode('\0{0}\0{1}'.format(
+                    login, password).encode('utf-8')).decode('ascii')
+                code, msg = await self.command('AUTH PLAIN ' + token)
+                if code != 235:
+                    raise smtplib.SMTPAuthenticationError(code, msg)
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    async def reply(self):
+        """Returns (code, message) of the server's next reply."""
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(),
+                                              _SMTP_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise smtplib.SMTPServerDisconnected('Timed out')
+            if not line:
+                raise smtplib.SMTPServerDisconnected(
+                    'Connection unexpectedly closed')
+            lines.append(line[4:].rstrip(b'\r\n'))
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+    async def command(self, line):
+        """Send command line, and returns (code, message) of the reply."""
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        return await self.reply()
+
+    async def sendmail(self, sender, recipients, message):
+        """Send message, a string, to recipients. Returns the dict of
+        refused recipients, like smtplib.SMTP.sendmail. The MAIL and RCPT
+        commands are pipelined if the server supports it."""
+        mail = 'MAIL FROM:{0}'.format(smtplib.quoteaddr(sender))
+        rcpts = ['RCPT TO:{0}'.format(smtplib.quoteaddr(r))
+                 for r in recipients]
+        if self.pipelining:
+            self.writer.write(''.join(
+                line + '\r\n' for line in [mail] + rcpts).encode('utf-8'))
+            mail_reply = await self.reply()
+            rcpt_replies = [await self.reply() for _ in rcpts]
+        else:
+            mail_reply = await self.command(mail)
+            rcpt_replies = []
+            if mail_reply[0] == 250:
+                rcpt_replies = [await self.command(line) for line in rcpts]
+        code, msg = mail_reply
+        if code != 250:
+            await self.command('RSET')
+            raise smtplib.SMTPSenderRefused(code, msg, sender)
+        refused = {}
+        for recipient, (code, msg) in zip(recipients, rcpt_replies):
+            if code not in (250, 251):
+                refused[recipient] = (code, msg)
+        if len(refused) == len(recipients):
+            await self.command('RSET')
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, msg = await self.command('DATA')
+        if code != 354:
+            await self.command('RSET')
+            raise smtplib.SMTPDataError(code, msg)
+        self.writer.write(_smtp_data(message))
+        code, msg = await self.reply()
+        if code != 250:
+            await self.command('RSET')
+            raise smtplib.SMTPDataError(code, msg)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.close()
+
+    def close(self):
+        self.writer.close()
+
+
+def _smtp_data(message):
+    """Returns message as DATA bytes: CRLF line endings, dot stuffed, and
+    ending in the terminating dot line."""
+    data = re.sub(r'(?:\r\n|\n|\r(?!\n))', '\r\n', message)
+    data = re.sub(r'(?m)^\.', '..', data)
+    if not data.endswith('\r\n'):
+        data += '\r\n'
+    return data.encode('utf-8') + b'.\r\n'
+
+
+class _AsyncSMTPPool(object):
+    """Pool of logged in non-blocking SMTP connections, like
+    emailer._SMTPPool. At most size connections are open at once, idle ones
+    are closed after idle_timeout seconds, and a send over a connection the
+    server has dropped is retried once on a new connection. Emails to more
+    than max_recipients are sent in chunks, in parallel.
+    """
+
+    def __init__(self, host, port, size=2, idle_timeout=60, limiter=None,
+                 max_recipients=1000):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.limiter = limiter
+        self.max_recipients = max_recipients
+        self._loop = None
+        self._semaphore = None
+        self._idle = []
+
+    @property
+    def _slots(self):
+        """Semaphore limiting the connections in use. It is created in the
+        running event loop on first use, since on python < 3.10 it is bound
+        to the loop it was created in; a new loop starts with a new one and
+        no idle connections."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.size)
+            self._idle = []
+            self._loop = loop
+        return self._semaphore
+
+    async def sendmail(self, sender, recipients, message):
+        """Send message to recipients over pooled connections. Returns the
+        dict of refused recipients. Like emailer._SMTPPool.sendmail, chunks
+        that could not be sent, or were refused for now, are retried once,
+        and it raises if no recipient could be sent to, or
+        emailer._SMTPIncomplete if some still could not be."""
+        chunks = emailer._chunks(recipients, self.max_recipients)
+        retry, refused = emailer._fan_out_retries(
+            chunks, await self._send_chunks(sender, chunks, message))
+        return emailer._fan_out_refused(
+            retry, await self._send_chunks(sender, retry, message), refused)
+
+    async def _send_chunks(self, sender, chunks, message):
+        """Returns (refused, error) of sending message to each chunk of
+        recipients. The pool's slots limit how many are sent at once."""
+        return await asyncio.gather(*[
+            self._try_send(sender, chunk, message) for chunk in chunks])
+
+    async def _try_send(self, sender, recipients, message):
+        try:
+            return await self._send(sender, recipients, message), None
+        except smtplib.SMTPRecipientsRefused as e:
+            return e.recipients, None
+        except Exception as e:
+            return {}, e
+
+    async def _send(self, sender, recipients, message):
+        """Send message over a pooled connection. Returns the dict of
+        refused recipients."""
+        if self.limiter is not None:
+            await asyncio.sleep(await _call(
+                getattr(self.limiter, 'state', None), self.limiter.reserve))
+        metrics = emailer._metrics
+        async with self._slots:
+            for attempt in range(2):
+                try:
+                    conn = await self._checkout()
+                except Exception:
+                    metrics.inc('commit_emailer_emails_failed_total')
+                    raise
+                try:
+                    with metrics.timer('sendmail'):
+                        result = await conn.sendmail(sender, recipients,
+                                                     message)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    conn.close()
+                    if attempt:
+                        metrics.inc('commit_emailer_emails_failed_total')
+                        raise
+                    logging.warn('SMTP connection dropped, reconnecting.')
+                    continue
+                except BaseException:
+                    conn.close()
+                    metrics.inc('commit_emailer_emails_failed_total')
+                    raise
+                self._idle.append((conn, time.monotonic()))
+                metrics.inc('commit_emailer_emails_sent_total')
+                return result
+
+    async def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            await conn.quit()
+
+    async def _checkout(self):
+        now = time.monotonic()
+        while self._idle:
+            conn, last_used = self._idle.pop()
+            if now - last_used <= self.idle_timeout:
+                return conn
+            await conn.quit()
+        config = emailer._get_config()
+        with emailer._metrics.timer('smtp_login'):
+            return await _AsyncSMTP.connect(self.host, self.port,
+                                            config.mailgun_login,
+                                            config.mailgun_password)
+
+
+_HEAD_LIMIT = 64 * 1024
+_LOCAL_HOSTNAME = 'github-email-notifications'
+_SMTP_TIMEOUT = 60
+
+# Emails being delivered in the background.
+_tasks = set()
+emailer._metrics.gauge('commit_emailer_deliveries_in_flight',
+                       lambda: len(_tasks))
+
+_smtp_pool = _AsyncSMTPPool(
+    emailer._smtp_pool.host, emailer._smtp_pool.port,
+    size=emailer._smtp_pool.size,
+    idle_timeout=emailer._smtp_pool.idle_timeout,
+    limiter=emailer._smtp_pool.limiter,
+    max_recipients=emailer._smtp_pool.max_recipients)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int,
+                        default=int(os.environ.get('PORT', 5000)))
+    args = parser.parse_args(argv)
+
+    try:
+        emailer.reload_config()
+    except (OSError, ValueError) as e:
+        logging.error('Invalid config: %s', e)
+        return 1
+    emailer._init_rollbar()
+    if emailer._outbox is not None:
+        # Replay anything a previous process left behind.
+        emailer._outbox._ensure_started()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    finally:
+        emailer.flush_pending()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
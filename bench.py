@@ -0,0 +1,372 @@
+"""Load benchmark for the commit emailer.
+
+Replays a corpus of signed, synthetic push events against the app and reports
+throughput and latency percentiles. Emails go to a local stub SMTP server and
+PR lookups to a local stub github API, and errors to a local stub rollbar API
+(see stubs.py), so it runs offline.
+
+The app is driven either in process, through the flask test client,
+through a real gunicorn process started with the Procfile's settings, or
+through the asyncio server in aioemailer.py:
+
+    python bench.py --mode client --requests 500
+    python bench.py --mode gunicorn --workers 2 --concurrency 8
+    python bench.py --mode async --concurrency 200
+
+The startup mode instead measures how long the app takes to import, and
+starts gunicorn --runs times to time its first webhook, response and email,
+from the moment gunicorn is started, against a second webhook once warm:
+
+    python bench.py --mode startup --runs 5
+
+Payload sizes are set with --files, a comma separated list of changed file
+counts cycled through the corpus. --lookup-ratio is the fraction of merges
+whose message has no PR number, so their PR url comes from the github stub.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import hmac
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+import stubs
+
+SECRET = 'bench-secret'
+
+
+def make_payload(i, files, lookup):
+    """Returns push event body, as bytes, for a merge changing files files.
+    If lookup is True, the merge message has no PR number."""
+    if lookup:
+        first_line = 'Merge pull request from bench/branch-{0}'.format(i)
+    else:
+        first_line = 'Merge pull request #{0} from bench/branch-{0}'.format(i)
+    paths = ['dir{0}/sub{1}/file{2}.chpl'.format(j % 37, j % 5, j)
+             for j in range(files)]
+    head_commit = {
+        'id': '{0:040x}'.format(i),
+        'message': '{0}\n\nBenchmark merge number {1}.'.format(first_line, i),
+        'added': paths[0::3],
+        'removed': paths[1::3],
+        'modified': paths[2::3],
+    }
+    return json.dumps({
+        'ref': 'refs/heads/main',
+        'after': '{0:040x}'.format(i),
+        'deleted': False,
+        'compare': 'https://github.com/bench/repo/compare/a...b',
+        'repository': {'full_name': 'bench/repo'},
+        'pusher': {'name': 'bench', 'email': 'bench@example.com'},
+        'commits': [head_commit],
+        'head_commit': head_commit,
+    }).encode('utf-8')
+
+
+def make_corpus(count, file_counts, lookup_ratio):
+    """Returns list of (headers, body) for count signed push events."""
+    corpus = []
+    lookup_every = int(1 / lookup_ratio) if lookup_ratio else 0
+    for i in range(count):
+        lookup = bool(lookup_every) and i % lookup_every == 0
+        body = make_payload(i, file_counts[i % len(file_counts)], lookup)
+        mac = hmac.new(SECRET.encode('utf-8'), body, digestmod='sha256')
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': 'push',
+            'X-GitHub-Delivery': 'bench-{0}-{1}'.format(os.getpid(), i),
+            'X-Hub-Signature-256': 'sha256=' + mac.hexdigest(),
+        }
+        corpus.append((headers, body))
+    return corpus
+
+
+def app_env(smtp, github, rollbar, extra):
+    """Returns environment for an emailer app using the stub servers."""
+    env = dict(os.environ)
+    env.update({
+        'GITHUB_COMMIT_EMAILER_SECRET': SECRET,
+        'GITHUB_COMMIT_EMAILER_SENDER': 'bench@example.com',
+        'GITHUB_COMMIT_EMAILER_RECIPIENT': 'list@example.com',
+        'GITHUB_COMMIT_EMAILER_SMTP_HOST': '127.0.0.1',
+        'GITHUB_COMMIT_EMAILER_SMTP_PORT': str(smtp.port),
+        'GITHUB_COMMIT_EMAILER_GITHUB_API': github.url,
+        'GITHUB_COMMIT_EMAILER_LOG_LEVEL': 'WARNING',
+        'MAILGUN_LOGIN': 'bench',
+        'MAILGUN_PASSWORD': 'bench',
+        'ROLLBAR_ACCESS_TOKEN': 'bench',
+        'GITHUB_COMMIT_EMAILER_ROLLBAR_ENDPOINT': rollbar.endpoint,
+    })
+    env.update(extra)
+    return env
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest-rank pct percentile of sorted_values."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1,
+                      int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def run_client(corpus, env):
+    """Replay corpus through the flask test client. Returns list of
+    (status, seconds) per request."""
+    os.environ.update(env)
+    import emailer
+    emailer.app.config['TESTING'] = True
+    client = emailer.app.test_client()
+    results = []
+    for headers, body in corpus:
+        start = time.perf_counter()
+        r = client.post('/commit-email', headers=headers, data=body)
+        results.append((r.status_code, time.perf_counter() - start))
+    return results
+
+
+@contextlib.contextmanager
+def gunicorn_app(env, workers):
+    """Run the app under gunicorn, with the Procfile's config file, for the
+    duration of the with block. Yields the webhook url."""
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    # gunicorn 19 has no __main__, so run its console script's entry point
+    # with this python.
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         'emailer:app',
+         '--config', 'gunicorn.conf.py', '--workers', str(workers),
+         '--bind', '127.0.0.1:{0}'.format(port), '--log-level', 'warning'],
+        cwd=here, env=env)
+    try:
+        _wait_for_port(port, proc)
+        yield 'http://127.0.0.1:{0}/commit-email'.format(port)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@contextlib.contextmanager
+def async_app(env):
+    """Run the asyncio server for the duration of the with block. Yields the
+    webhook url."""
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, 'aioemailer.py', '--host', '127.0.0.1',
+         '--port', str(port)],
+        cwd=here, env=env)
+    try:
+        _wait_for_port(port, proc)
+        yield 'http://127.0.0.1:{0}/commit-email'.format(port)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def run_http(corpus, url, concurrency):
+    """Replay corpus against url, concurrency requests at a time. Returns
+    list of (status, seconds) per request."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    def post(item):
+        headers, body = item
+        start = time.perf_counter()
+        r = session.post(url, headers=headers, data=body)
+        return r.status_code, time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(post, corpus))
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait_for_port(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with {0}'.format(
+                proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start listening')
+
+
+def time_import(env):
+    """Returns seconds a new process takes to import the emailer."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.check_output(
+        [sys.executable, '-c', 'import time; start = time.perf_counter(); '
+         'import emailer; print(time.perf_counter() - start)'],
+        cwd=here, env=env)
+    return float(out)
+
+
+def run_startup(env, smtp, workers, runs):
+    """Start gunicorn runs times, and time a webhook, and its email, right
+    away and again once warm. Returns list of dicts of seconds per run."""
+    timings = []
+    for run in range(runs):
+        first, warm = make_corpus(2, [5], 1)
+        start = time.perf_counter()
+        with gunicorn_app(env, workers) as url:
+            cold_response, cold_email = _time_webhook(url, first, smtp)
+            warm_response, warm_email = _time_webhook(url, warm, smtp)
+        timings.append({
+            'to_first_response_s': cold_response - start,
+            'first_response_s': cold_response - cold_email[0],
+            'first_email_s': cold_email[1] - cold_email[0],
+            'warm_response_s': warm_response - warm_email[0],
+            'warm_email_s': warm_email[1] - warm_email[0],
+        })
+    return timings
+
+
+def _time_webhook(url, item, smtp):
+    """Post item to url. Returns the time of the response, and (the time of
+    the request, the time its email arrived)."""
+    headers, body = item
+    expected = len(smtp.messages) + 1
+    sent = time.perf_counter()
+    requests.post(url, headers=headers, data=body).raise_for_status()
+    answered = time.perf_counter()
+    if wait_for_emails(smtp, expected, 30) < expected:
+        raise RuntimeError('email did not arrive')
+    return answered, (sent, time.perf_counter())
+
+
+def startup_report(import_s, timings):
+    """Returns dict summarizing startup runs, with median times."""
+    summary = {'import_ms': round(import_s * 1000, 1), 'runs': len(timings)}
+    for key in sorted(timings[0]):
+        values = sorted(t[key] for t in timings)
+        summary[key.replace('_s', '_ms')] = round(
+            percentile(values, 50) * 1000, 1)
+    return summary
+
+
+def wait_for_emails(smtp, expected, timeout):
+    """Wait until smtp has received expected messages, or timeout seconds
+    have passed. Returns number received."""
+    deadline = time.monotonic() + timeout
+    while len(smtp.messages) < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return len(smtp.messages)
+
+
+def report(results, elapsed, emails, delivered_elapsed):
+    """Returns dict summarizing a benchmark run."""
+    latencies = sorted(seconds for _, seconds in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(results),
+        'statuses': statuses,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(results) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'emails': emails,
+        'emails_per_s': (round(emails / delivered_elapsed, 1)
+                         if delivered_elapsed else 0),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode',
+                        choices=['client', 'gunicorn', 'async', 'startup'],
+                        default='client')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='gunicorn starts, in startup mode')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--files', default='5,100,2000',
+                        help='changed file counts to cycle through')
+    parser.add_argument('--lookup-ratio', type=float, default=0.1)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='requests in flight, in gunicorn and async '
+                        'modes')
+    parser.add_argument('--smtp-latency', type=float, default=0.0)
+    parser.add_argument('--smtp-error-rate', type=float, default=0.0)
+    parser.add_argument('--github-latency', type=float, default=0.0)
+    parser.add_argument('--github-error-rate', type=float, default=0.0)
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='seconds to wait for emails after the last '
+                        'request')
+    parser.add_argument('--env', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='extra config var for the app, may be repeated')
+    args = parser.parse_args(argv)
+
+    smtp = stubs.StubSMTPServer(args.smtp_latency, args.smtp_error_rate)
+    github = stubs.StubGitHubServer(args.github_latency,
+                                    args.github_error_rate)
+    rollbar = stubs.StubRollbarServer()
+    extra = dict(item.split('=', 1) for item in args.env)
+    env = app_env(smtp, github, rollbar, extra)
+    if args.mode == 'startup':
+        summary = startup_report(
+            time_import(env),
+            run_startup(env, smtp, args.workers, args.runs))
+        summary.update(mode=args.mode)
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        smtp.stop()
+        github.stop()
+        rollbar.stop()
+        return 0
+
+    corpus = make_corpus(args.requests,
+                         [int(n) for n in args.files.split(',')],
+                         args.lookup_ratio)
+
+    with contextlib.ExitStack() as stack:
+        if args.mode == 'gunicorn':
+            url = stack.enter_context(gunicorn_app(env, args.workers))
+        elif args.mode == 'async':
+            url = stack.enter_context(async_app(env))
+        start = time.perf_counter()
+        if args.mode == 'client':
+            results = run_client(corpus, env)
+        else:
+            results = run_http(corpus, url, args.concurrency)
+        elapsed = time.perf_counter() - start
+        accepted = sum(1 for status, _ in results if status in (200, 202))
+        emails = wait_for_emails(smtp, accepted, args.drain_timeout)
+        delivered_elapsed = time.perf_counter() - start
+
+    summary = report(results, elapsed, emails, delivered_elapsed)
+    summary.update(mode=args.mode, github_requests=github.requests)
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    smtp.stop()
+    github.stop()
+    rollbar.stop()
+    return 0 if emails == accepted else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,145 @@
 
 
 from flask import Flask
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextvars
 import flask
+import fnmatch
+import hashlib
 import hmac
+import itertools
+import jinja2
+import json
 import logging
+import logging.handlers
 import os
 import os.path
+import posixpath
+import queue
+import random
+import re
 import rollbar
-import rollbar.contrib.flask
+import signal
 import smtplib
+import sqlite3
+import ssl
+import sys
 import requests
+import threading
+import time
+import urllib.parse
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+import sharedstate
+
 app = Flask(__name__)
 
-logging.basicConfig(level=logging.INFO)
+
+class _QueueLogHandler(logging.handlers.QueueHandler):
+    """Hands log records to a background thread, which formats them and
+    writes them with handlers, so that logging never waits on I/O.
+
+    Messages are only merged with their args in that thread, so args must
+    not be changed after logging them. While maxsize records are waiting,
+    new ones are dropped and counted. The thread is started lazily, and
+    restarted after a fork.
+    """
+
+    def __init__(self, handlers, maxsize):
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(maxsize))
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self._listener = None
+        self._pid = None
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _metrics.inc('commit_emailer_log_records_dropped_total')
+
+    def flush(self):
+        """Block until every queued record has been written."""
+        if self._pid == os.getpid():
+            self.queue.join()
+
+    def _start(self):
+        # Called with the handler lock held. Records queued by a parent
+        # process are for its own thread to write.
+        self.queue = queue.Queue(self.maxsize)
+        self._listener = logging.handlers.QueueListener(
+            self.queue, *self.handlers, respect_handler_level=True)
+        self._listener.start()
+        self._pid = os.getpid()
+
+
+class _JSONFormatter(logging.Formatter):
+    """Formats a record as a line of JSON with its time, level, logger and
+    message, and its fields, if logged with extra={'fields': {...}}."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', ()))
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    """Formats a record like logging.basicConfig() does, followed by its
+    fields, if any, as JSON."""
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + json.dumps(fields, separators=(',', ':'),
+                                     default=str)
+        return text
+
+
+def _configure_logging(env):
+    """Log to stderr through a _QueueLogHandler, unless logging has already
+    been configured. Returns the handler, or None."""
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    stream = logging.StreamHandler()
+    if env.get('GITHUB_COMMIT_EMAILER_LOG_FORMAT', 'json') == 'text':
+        stream.setFormatter(_TextFormatter(logging.BASIC_FORMAT))
+    else:
+        stream.setFormatter(_JSONFormatter())
+    handler = _QueueLogHandler(
+        [stream], int(env.get('GITHUB_COMMIT_EMAILER_LOG_QUEUE_SIZE', 10000)))
+    root.addHandler(handler)
+    root.setLevel(env.get('GITHUB_COMMIT_EMAILER_LOG_LEVEL', 'INFO').upper())
+    return handler
+
+
+_log_handler = _configure_logging(os.environ)
+_webhook_logger = logging.getLogger('emailer.webhooks')
+_payload_logger = logging.getLogger('emailer.payloads')
+_payload_sample_rate = float(os.environ.get(
+    'GITHUB_COMMIT_EMAILER_LOG_PAYLOAD_SAMPLE', 0))
+_redacted_fields = frozenset(os.environ.get(
+    'GITHUB_COMMIT_EMAILER_LOG_REDACT', 'email,token,secret,password')
+    .split(','))
+
+_MERGE_MARKER = b'Merge pull request'
 
 
 @app.before_first_request
@@ -25,16 +150,32 @@ def init_rollbar():
             'Skipping rollbar init because TESTING flag is set on flask app.')
         return
 
+    _init_rollbar()
+    flask.got_request_exception.connect(_report_request_exception, app)
+
+
+def _init_rollbar():
+    """Initialize rollbar from the environment."""
+    kwargs = {}
+    if 'GITHUB_COMMIT_EMAILER_ROLLBAR_ENDPOINT' in os.environ:
+        kwargs['endpoint'] = os.environ[
+            'GITHUB_COMMIT_EMAILER_ROLLBAR_ENDPOINT']
     rollbar.init(
         # throw KeyError if env var is not set.
         os.environ['ROLLBAR_ACCESS_TOKEN'],
         os.environ.get('GITHUB_COMMIT_EMAILER_ROLLBAR_ENV',
                        'github-email-notifications'),
         root=os.path.dirname(os.path.realpath(__file__)),
-        allow_logging_basic_config=False
+        allow_logging_basic_config=False,
+        # Items are only sent from the _ErrorReporter thread.
+        handler='blocking',
+        **kwargs
     )
-    flask.got_request_exception.connect(
-        rollbar.contrib.flask.report_exception, app)
+
+
+def _report_request_exception(sender, exception, **extra):
+    """Queue an exception raised handling a request to be reported."""
+    _errors.report(request=flask.request)
 
 
 @app.route('/')
@@ -43,157 +184,2507 @@ def index():
     return flask.redirect('http://chapel-lang.org/', code=301)
 
 
+@app.route('/metrics')
+def metrics():
+    """Report metrics in Prometheus text format."""
+    return flask.Response(_metrics.render(),
+                          content_type='text/plain; version=0.0.4')
+
+
 @app.route('/commit-email', methods=['POST'])
 def commit_email():
     """Receive web hook from github and generate email."""
 
     # Only look at push events. Ignore the rest.
     event = flask.request.headers['x-github-event']
-    logging.info('Received "{0}" event from github.'.format(event))
-    if event != 'push':
-        logging.info('Skipping "{0}" event.'.format(event))
-        return 'nope'
-
-    # Verify signature.
-    secret = _get_secret()
-
-    gh_signature = flask.request.headers.get('x-hub-signature', '')
-    if not _valid_signature(gh_signature, flask.request.data, secret):
-        logging.warn('Invalid signature, skipping request.')
-        return 'nope'
-
-    json_dict = flask.request.get_json()
-    logging.info('json body: {0}'.format(json_dict))
-    if "Merge pull request" not in json_dict['head_commit']['message']:
-        return 'nope'
-
-    if json_dict['deleted']:
-        logging.info('Branch was deleted, skipping email.')
-        return 'nope'
-
-    added = '\n'.join(['A {0}'.format(f) for f in
-                       json_dict['head_commit']['added']])
-    removed = '\n'.join(['R {0}'.format(f) for f in
-                         json_dict['head_commit']['removed']])
-    modified = '\n'.join(['M {0}'.format(f) for f in
-                          json_dict['head_commit']['modified']])
-    changes = '\n'.join([i for i in [added, removed, modified] if bool(i)])
-
-    pusher_email = '{0} <{1}>'.format(json_dict['pusher']['name'],
-                                      json_dict['pusher']['email'])
-
-    githubUrl = "https://api.github.com/repos/{}/commits/{}/pulls".format(
-        json_dict['repository']['full_name'], json_dict['after'])
-    logging.info(f"Github URL: {githubUrl}")
+    delivery = flask.request.headers.get('x-github-delivery')
+    with _WebhookLog(delivery, event):
+        if event != 'push':
+            return _skip('not_push')
+
+        # Verify signature while reading the body.
+        config = _get_config()
+        with _metrics.timer('signature'):
+            body = _read_signed_body(flask.request, config)
+        if body is None:
+            logging.warn('Invalid signature, skipping request.')
+            return _skip('bad_signature')
+
+        try:
+            msg_info, dedup_key = _push_msg_info(delivery, body, config)
+        except _Skip as e:
+            return _skip(e.reason)
+
+        if _delivery_queue.workers == 0:
+            try:
+                _deliver(msg_info)
+            except Exception:
+                # Let github's retry through.
+                _dedup.discard(dedup_key)
+                raise
+            return 'yep'
+
+        if not _delivery_queue.submit(msg_info):
+            logging.error('Delivery queue is full, rejecting request.')
+            _metrics.inc('commit_emailer_webhooks_rejected_total')
+            _dedup.discard(dedup_key)
+            _log_webhook('busy')
+            return 'busy', 503
+        return 'yep', 202
+
+
+class _Skip(Exception):
+    """Raised by _push_msg_info for a push that needs no email."""
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+def _skip(reason):
+    """Count and log a webhook that will not be emailed, and return the
+    response for it."""
+    _metrics.inc('commit_emailer_emails_skipped_total', reason=reason)
+    _log_webhook(reason)
+    return 'nope'
+
+
+_webhook_log = contextvars.ContextVar('webhook_log', default=None)
+
+
+class _WebhookLog(object):
+    """Collects the fields of the one structured log record written for
+    each webhook: delivery id, event, repo, sha, the decision made, and the
+    time taken by each stage timed while it is current.
+
+    Used as a context manager, it is the current _WebhookLog until the
+    block ends, and for delivery threads and tasks started in the block.
+    It also decides whether this webhook's payloads are logged; see
+    _log_payload().
+    """
+
+    def __init__(self, delivery, event):
+        self.fields = {'delivery': delivery, 'event': event}
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.sampled = random.random() < _payload_sample_rate
+        self.logged = False
+        self._token = None
+
+    def __enter__(self):
+        self._token = _webhook_log.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _webhook_log.reset(self._token)
+        if exc_type is not None:
+            # Handling the webhook failed before any decision was made.
+            self.log('error')
+
+    def stage(self, stage, seconds):
+        self.stages[stage] = round(seconds * 1000, 3)
+
+    def log(self, decision):
+        """Write the record, once, with decision."""
+        if self.logged:
+            return
+        self.logged = True
+        level = logging.INFO
+        if decision in ('busy', 'error', 'failed', 'retrying'):
+            level = logging.WARNING
+        if not _webhook_logger.isEnabledFor(level):
+            return
+        total = time.perf_counter() - self.start
+        fields = dict(self.fields, decision=decision, stages_ms=self.stages,
+                      total_ms=round(total * 1000, 3))
+        _webhook_logger.log(level, 'webhook', extra={'fields': fields})
+
+
+def _log_webhook(decision, **fields):
+    """Write the current webhook's log record with decision and fields."""
+    log = _webhook_log.get()
+    if log is not None:
+        log.fields.update(fields)
+        log.log(decision)
+
+
+def _log_payload(kind, payload):
+    """Log payload, a decoded JSON document, with _redacted_fields
+    redacted, if the current webhook is sampled for payload logging. Outside
+    a webhook, payloads are sampled one by one."""
+    log = _webhook_log.get()
+    if log is None:
+        sampled = random.random() < _payload_sample_rate
+    else:
+        sampled = log.sampled
+    if not sampled or not _payload_logger.isEnabledFor(logging.INFO):
+        return
+    fields = {'kind': kind, 'payload': _redact(payload, _redacted_fields)}
+    if log is not None:
+        fields['delivery'] = log.fields['delivery']
+    _payload_logger.info('payload', extra={'fields': fields})
+
+
+def _redact(value, names):
+    """Returns copy of a decoded JSON document with the values of object
+    members named in names replaced with "[redacted]"."""
+    if isinstance(value, dict):
+        return dict((k, '[redacted]' if k in names else _redact(v, names))
+                    for k, v in value.items())
+    if isinstance(value, list):
+        return [_redact(v, names) for v in value]
+    return value
+
+
+def _push_msg_info(delivery, body, config):
+    """Returns (msg_info, dedup_key) for the signed body of a push event with
+    X-GitHub-Delivery delivery, which may be None. Raises _Skip if the push
+    needs no email.
+
+    The dedup key has been added to _dedup; discard it if the email is not
+    going to be sent after all. If anything but _Skip is raised, it has
+    already been discarded.
+    """
+    dedup_key = None
+    try:
+        # Github does not escape plain ASCII in JSON strings, so a merge
+        # message appears verbatim in the body. Skip other pushes without
+        # decoding them.
+        if _MERGE_MARKER not in body:
+            raise _Skip('not_merge')
+
+        with _metrics.timer('parse'):
+            json_dict = json.loads(body)
+        _log_payload('push', json_dict)
+        log = _webhook_log.get()
+        if log is not None:
+            log.fields['repo'] = json_dict['repository']['full_name']
+            log.fields['sha'] = json_dict['after']
+        if json_dict['deleted']:
+            raise _Skip('deleted')
+
+        head_commit = json_dict['head_commit']
+        if _MERGE_MARKER.decode('ascii') not in head_commit['message']:
+            raise _Skip('not_merge')
+
+        # Skip deliveries github is retrying because we were slow to answer,
+        # or pushes already emailed. Keys are only recorded for pushes that
+        # need an email, so skipped pushes add nothing to the dedup state.
+        if delivery is not None:
+            key = 'delivery:{0}'.format(delivery)
+        else:
+            key = 'push:{0}:{1}'.format(
+                json_dict['repository']['full_name'], json_dict['after'])
+        if not _dedup.add(key):
+            raise _Skip('duplicate')
+        dedup_key = key
+
+        changes = '\n'.join(_changed_files(head_commit, config.max_files,
+                                           config.max_dirs))
+
+        pusher_email = '{0} <{1}>'.format(json_dict['pusher']['name'],
+                                          json_dict['pusher']['email'])
+
+        route = config.route
+        if config.rules is not None:
+            with _metrics.timer('route'):
+                route = config.rules.route(
+                    json_dict['repository']['full_name'], json_dict['ref'],
+                    itertools.chain(head_commit['added'],
+                                    head_commit['removed'],
+                                    head_commit['modified']))
+
+        msg_info = {
+            'repo': json_dict['repository']['full_name'],
+            'branch': json_dict['ref'],
+            'revision': head_commit['id'][:7],
+            'message': head_commit['message'],
+            'changed_files': changes,
+            'pusher': json_dict['pusher']['name'],
+            'pusher_email': pusher_email,
+            'compare_url': json_dict['compare'],
+            'sha': json_dict['after'],
+            'pr_url': _pr_url_from_message(
+                json_dict['repository']['full_name'], head_commit['message']),
+            'route': route,
+            'deadline': time.monotonic() + config.deadline,
+        }
+        return msg_info, dedup_key
+    except _Skip:
+        raise
+    except Exception:
+        # Let github's redelivery, or a replay, try again.
+        if dedup_key is not None:
+            _dedup.discard(dedup_key)
+        raise
+
+
+def _deliver(msg_info):
+    """Look up the PR url for msg_info and send the notification email."""
+    decision = 'failed'
     try:
-        response = requests.get(url=githubUrl,
-                                headers={"Accept":
-                                         "application/vnd.github.v3+json"},
-                                timeout=10)
-        logging.info(f"Response: {response}")
-        logging.info(f"Status: {response.status_code}")
+        if msg_info['pr_url'] is None:
+            msg_info['pr_url'] = _get_pr_url(
+                msg_info['repo'], msg_info['sha'], msg_info.get('deadline'))
+        sent = _send_email(msg_info)
+        decision = _delivered(sent)
+    finally:
+        _log_webhook(decision)
+
+
+def _delivered(sent):
+    """Returns the decision to log for a webhook whose email was handed
+    on, given what _send_email() returned."""
+    if _digest is not None:
+        return 'digested'
+    return 'sent' if sent else 'retrying'
+
+
+def _changed_files(head_commit, max_files, max_dirs):
+    """Yields "A path", "R path" and "M path" lines for the files changed
+    by head_commit.
+
+    After max_files lines, the remaining files are summarized as a count per
+    directory, sorted by directory, and at most max_dirs directories are
+    listed. The output is bounded however many files the commit touches.
+    """
+    changes = itertools.chain(
+        (('A', f) for f in head_commit['added']),
+        (('R', f) for f in head_commit['removed']),
+        (('M', f) for f in head_commit['modified']))
+    for kind, path in itertools.islice(changes, max_files):
+        yield '{0} {1}'.format(kind, path)
+
+    dirs = collections.Counter(posixpath.dirname(path) or '.'
+                               for _, path in changes)
+    if not dirs:
+        return
+    yield '... and {0} more files in:'.format(sum(dirs.values()))
+    for d in sorted(dirs)[:max_dirs]:
+        yield '  {0:>5} {1}'.format(dirs[d], d)
+    if len(dirs) > max_dirs:
+        yield '  ... and {0} more directories'.format(len(dirs) - max_dirs)
+
+
+def _pr_url_from_message(repo, message):
+    """Returns html url of the PR named in a github merge commit message,
+    e.g. "Merge pull request #1234 from ...", or None if there isn't one."""
+    match = _PR_NUMBER_RE.match(message)
+    if match is None:
+        return None
+    return 'https://github.com/{0}/pull/{1}'.format(repo, match.group(1))
+
+
+def _get_pr_url(repo, sha, deadline=None):
+    """Returns html url of the PR that introduced sha, or "Unavailable" if
+    github cannot tell us by deadline, a time.monotonic() value. Successful
+    lookups are cached."""
+    prURL = _pr_url_cache.get((repo, sha))
+    if prURL is not None:
+        return prURL
+
+    reservation = _reserve_github_lookup(deadline)
+    if reservation is None:
+        return "Unavailable"
+    wait, timeout = reservation
+    time.sleep(wait)
+
+    githubUrl = _pr_lookup_url(repo, sha)
+    try:
+        with _metrics.timer('pr_lookup'):
+            try:
+                response = _github_session.get(
+                    url=githubUrl,
+                    headers=_github_headers(),
+                    timeout=timeout)
+            except Exception:
+                _github_breaker.record(False)
+                raise
+        _github_breaker.record(response.status_code < 500)
+        _github_limiter.observe(response.status_code, response.headers)
         responseJSON = response.json()
-        logging.info(f"Response JSON: {responseJSON}")
+        _log_payload('github_pulls', responseJSON)
         prURL = responseJSON[0]['html_url']
-        logging.info(f"PR URL: {prURL}")
     except Exception as e:
         prURL = "Unavailable"
-        logging.error(f'Could not getch PR url from github: {e}')
-
-    msg_info = {
-        'repo': json_dict['repository']['full_name'],
-        'branch': json_dict['ref'],
-        'revision': json_dict['head_commit']['id'][:7],
-        'message': json_dict['head_commit']['message'],
-        'changed_files': changes,
-        'pusher': json_dict['pusher']['name'],
-        'pusher_email': pusher_email,
-        'compare_url': json_dict['compare'],
-        'pr_url': prURL,
+        logging.error('Could not fetch PR url from github: %r', e)
+    else:
+        _pr_url_cache.put((repo, sha), prURL)
+    return prURL
+
+
+def _pr_lookup_url(repo, sha):
+    """Returns github API url listing the PRs that introduced sha."""
+    return "{}/repos/{}/commits/{}/pulls".format(_GITHUB_API, repo, sha)
+
+
+def _github_headers():
+    """Returns headers for github API requests, with the configured
+    token, if any."""
+    token = _get_config().github_token
+    if token is None:
+        return _GITHUB_HEADERS
+    return dict(_GITHUB_HEADERS, Authorization='token {0}'.format(token))
+
+
+def _reserve_github_lookup(deadline=None):
+    """Returns (wait, timeout), the seconds to wait before the next github
+    API request and its timeout, so that it is over by deadline, if given.
+
+    Returns None to skip the request instead, if there is too little time
+    left before deadline, the circuit breaker is open, or the rate limit
+    budget will not allow it soon enough.
+    """
+    max_wait = _get_config().github_max_wait
+    left = float('inf')
+    if deadline is not None:
+        left = deadline - time.monotonic()
+        if left < _GITHUB_MIN_TIMEOUT:
+            logging.warn('No time left for PR lookup, skipping it.')
+            return _skip_github_lookup('deadline')
+        max_wait = min(max_wait, left - _GITHUB_MIN_TIMEOUT)
+    if not _github_breaker.allow():
+        return _skip_github_lookup('circuit_open')
+    wait = _github_limiter.reserve(max_wait)
+    if wait is None:
+        logging.warn('Github rate limit reached, skipping PR lookup.')
+        return _skip_github_lookup('rate_limit')
+    return wait, min(_GITHUB_TIMEOUT, left - wait)
+
+
+def _skip_github_lookup(reason):
+    _metrics.inc('commit_emailer_github_lookups_skipped_total', reason=reason)
+    return None
+
+
+class _CircuitBreaker(object):
+    """Thread safe circuit breaker for calls to a service.
+
+    After failures failures in a row it opens, and allow() refuses calls
+    without waiting on the service. Once it has been open for reset_timeout
+    seconds, it lets a single probe call through: a success closes it, a
+    failure keeps it open for another reset_timeout. If the probe's result
+    is never recorded, another probe is let through after reset_timeout.
+    """
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._failed = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        """Returns whether a call may be made."""
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            # Half open: the probe holds the breaker open until it reports.
+            self._opened_at = now
+            return True
+
+    def record(self, success):
+        """Record the outcome of a call."""
+        with self._lock:
+            if success:
+                if self._opened_at is not None:
+                    logging.info('Github is answering, closing circuit.')
+                self._failed = 0
+                self._opened_at = None
+                return
+            self._failed += 1
+            if self._opened_at is not None or self._failed >= self.failures:
+                if self._opened_at is None:
+                    logging.error('Github is failing, opening circuit.')
+                self._opened_at = time.monotonic()
+
+
+class _TokenBucket(object):
+    """Thread safe token bucket holding up to capacity tokens, refilled at
+    rate tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait=float('inf')):
+        """Takes a token. Returns seconds to wait until it is available, or
+        None, without taking it, if that is longer than max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            wait = self._time_until(1 - self.tokens, now)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def acquire(self, max_wait=float('inf')):
+        """Takes a token, waiting up to max_wait seconds for it. Returns
+        False if the wait would be longer."""
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        time.sleep(wait)
+        return True
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _time_until(self, tokens, now):
+        """Returns seconds until tokens more tokens have been added."""
+        if self.rate <= 0:
+            return float('inf')
+        return tokens / self.rate
+
+
+class _GitHubLimiter(_TokenBucket):
+    """Token bucket for the github API that follows github's rate limit.
+
+    It starts out allowing limit requests an hour. After each response, the
+    tokens are set to the requests github says remain, and the rate to
+    spread them evenly until github resets the limit, when the bucket is
+    refilled. A Retry-After answer stops requests until it has passed.
+
+    If state is given (see _open_state()), the requests github said remain
+    are also stored there, and requests made by every process sharing it
+    since then are counted against them.
+    """
+
+    def __init__(self, limit, state=None):
+        _TokenBucket.__init__(self, limit / 3600.0, limit)
+        self.state = state
+        self._reset_at = None
+
+    def configure(self, limit):
+        """Allow limit requests an hour instead, e.g. once a token is
+        configured, unless github has already said what its limit is."""
+        with self._lock:
+            if self._reset_at is not None or limit == self.capacity:
+                return
+            self._refill(time.monotonic())
+            self.tokens = max(0.0, min(
+                float(limit), self.tokens + limit - self.capacity))
+            self.capacity = float(limit)
+            self.rate = limit / 3600.0
+
+    def reserve(self, max_wait=float('inf')):
+        wait = _TokenBucket.reserve(self, max_wait)
+        if wait is None or self.state is None:
+            return wait
+        try:
+            quota = self.state.get('github:quota')
+            if quota is None:
+                return wait
+            remaining, reset, observation = json.loads(quota)
+            spent = self.state.incr('github:spent:' + observation, 1,
+                                    ttl=max(reset - time.time(), 1.0))
+        except sharedstate.StateError as e:
+            _state_failed('github_quota', e)
+            return wait
+        if spent > remaining:
+            # Other processes have used up what github said was left.
+            return None
+        return wait
+
+    def observe(self, status, headers):
+        """Adapt to the rate limit headers of a github API response."""
+        try:
+            retry_after = headers.get('retry-after')
+            if status in (403, 429) and retry_after is not None:
+                remaining, limit = 0, None
+                until_reset = float(retry_after)
+            else:
+                remaining = int(headers['x-ratelimit-remaining'])
+                limit = int(headers.get('x-ratelimit-limit') or
+                            self.capacity)
+                until_reset = float(headers['x-ratelimit-reset']) - time.time()
+        except (KeyError, TypeError, ValueError):
+            return
+        until_reset = max(until_reset, 0.0)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit is not None:
+                self.capacity = float(limit)
+            self.tokens = float(remaining)
+            self.rate = remaining / until_reset if until_reset else 0.0
+            self._reset_at = now + until_reset
+        if self.state is not None:
+            quota = [remaining, time.time() + until_reset,
+                     os.urandom(8).hex()]
+            try:
+                self.state.set('github:quota', json.dumps(quota),
+                               ttl=until_reset + 1)
+            except sharedstate.StateError as e:
+                _state_failed('github_quota', e)
+
+    def _refill(self, now):
+        if self._reset_at is not None and now >= self._reset_at:
+            self._reset_at = None
+            self.tokens = self.capacity
+            self.rate = self.capacity / 3600.0
+            self._updated = now
+            return
+        _TokenBucket._refill(self, now)
+
+    def _time_until(self, tokens, now):
+        wait = _TokenBucket._time_until(self, tokens, now)
+        if self._reset_at is not None:
+            wait = min(wait, self._reset_at - now)
+        return wait
+
+
+class _SharedRateLimiter(object):
+    """Limits a rate across every process sharing state (see
+    _open_state()), with the same reserve() and acquire() as _TokenBucket.
+
+    At most capacity tokens are taken in each window of capacity / rate
+    seconds, counted in state. Once a window's are gone, tokens are taken
+    from the next. If state cannot be reached, a _TokenBucket in this
+    process is used instead.
+    """
+
+    def __init__(self, state, name, rate, capacity):
+        self.state = state
+        self.name = name
+        self.capacity = max(1, int(capacity))
+        self.window = self.capacity / float(rate)
+        self._local = _TokenBucket(rate, capacity)
+
+    def reserve(self, max_wait=float('inf')):
+        """Takes a token. Returns seconds to wait until it is available, or
+        None, without taking it, if that is longer than max_wait."""
+        now = time.time()
+        index = int(now // self.window)
+        while True:
+            wait = max(0.0, index * self.window - now)
+            if wait > max_wait:
+                return None
+            key = '{0}:{1}'.format(self.name, index)
+            try:
+                taken = self.state.incr(key, 1, ttl=wait + self.window + 1)
+            except sharedstate.StateError as e:
+                _state_failed('rate_limit', e)
+                return self._local.reserve(max_wait)
+            if taken <= self.capacity:
+                return wait
+            index += 1
+
+    def acquire(self, max_wait=float('inf')):
+        """Takes a token, waiting up to max_wait seconds for it. Returns
+        False if the wait would be longer."""
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        time.sleep(wait)
+        return True
+
+
+class _TTLCache(object):
+    """Thread safe LRU cache whose entries expire after ttl seconds.
+
+    If state is given (see _open_state()), entries are also stored there,
+    under namespace, so that every process sharing it finds them. Keys and
+    values must then be strings, or for keys, tuples of strings.
+    """
+
+    def __init__(self, maxsize, ttl, state=None, namespace=''):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.state = state
+        self.namespace = namespace
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns cached value for key, or None if missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires >= time.monotonic():
+                    self._data.move_to_end(key)
+                    return value
+                del self._data[key]
+        if self.state is None:
+            return None
+        try:
+            value = self.state.get(self._shared_key(key))
+        except sharedstate.StateError as e:
+            _state_failed('cache', e)
+            return None
+        if value is not None:
+            self._put(key, value)
+        return value
+
+    def put(self, key, value):
+        """Cache value under key, evicting the least recently used entry if
+        the cache is full."""
+        self._put(key, value)
+        if self.state is not None:
+            try:
+                self.state.set(self._shared_key(key), value, ttl=self.ttl)
+            except sharedstate.StateError as e:
+                _state_failed('cache', e)
+
+    def clear(self):
+        """Remove all entries held by this process."""
+        with self._lock:
+            self._data.clear()
+
+    def _put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def _shared_key(self, key):
+        if isinstance(key, tuple):
+            key = ':'.join(key)
+        return '{0}:{1}'.format(self.namespace, key)
+
+
+def _state_failed(use, error):
+    """Count and log a shared state operation for use that failed, and
+    which the caller is carrying on without."""
+    logging.error('Shared state unavailable for %s: %r', use, error)
+    _metrics.inc('commit_emailer_state_errors_total', use=use)
+
+
+def _open_state(url):
+    """Returns shared state backend for url: "memory:", "sqlite:///path",
+    or "redis://[:password@]host[:port][/db]" ("rediss://" for TLS).
+    Raises ValueError for any other url."""
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme == 'memory':
+        return sharedstate.MemoryState()
+    if parsed.scheme == 'sqlite' and parsed.path:
+        return sharedstate.SQLiteState(parsed.path)
+    if parsed.scheme in ('redis', 'rediss') and parsed.hostname:
+        db = parsed.path.strip('/')
+        return sharedstate.RedisState(
+            parsed.hostname, parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=(urllib.parse.unquote(parsed.password)
+                      if parsed.password is not None else None),
+            ssl_context=(ssl.create_default_context()
+                         if parsed.scheme == 'rediss' else None))
+    raise ValueError('Unsupported shared state url: {0}'.format(url))
+
+
+# Shared by the processes using it, if configured.
+_state = None
+if 'GITHUB_COMMIT_EMAILER_STATE_URL' in os.environ:
+    _state = _open_state(os.environ['GITHUB_COMMIT_EMAILER_STATE_URL'])
+
+
+_GITHUB_API = os.environ.get('GITHUB_COMMIT_EMAILER_GITHUB_API',
+                             'https://api.github.com')
+_GITHUB_HEADERS = {"Accept": "application/vnd.github.v3+json"}
+_GITHUB_TIMEOUT = 10
+# Lookups are not started with less time than this left before the deadline.
+_GITHUB_MIN_TIMEOUT = 0.5
+_PR_NUMBER_RE = re.compile(r'Merge pull request #(\d+)\b')
+
+
+def _github_limit(token):
+    """Returns the requests an hour github allows with token, which may be
+    None."""
+    return 5000 if token else 60
+
+
+# Keep-alive session and cache for the github PR lookup fallback.
+_github_session = requests.Session()
+_pr_url_cache = _TTLCache(maxsize=1024, ttl=3600, state=_state,
+                          namespace='pr_url')
+# The config snapshot may set the token, and so the limit, once it is
+# loaded (see reload_config()).
+_github_limiter = _GitHubLimiter(
+    _github_limit(os.environ.get('GITHUB_COMMIT_EMAILER_GITHUB_TOKEN')),
+    state=_state)
+_github_breaker = _CircuitBreaker(
+    int(os.environ.get('GITHUB_COMMIT_EMAILER_GITHUB_BREAKER_FAILURES', 5)),
+    float(os.environ.get('GITHUB_COMMIT_EMAILER_GITHUB_BREAKER_RESET', 30)))
+
+
+class _DedupIndex(object):
+    """Remembers which webhook deliveries have already been handled.
+
+    Keys are kept in a bounded in-memory LRU. If state is given (see
+    _open_state()), they are also stored there for ttl seconds, so they
+    survive restarts and are shared by every process using it. If state
+    cannot be reached, keys not in the LRU are taken to be new: an email
+    may be sent twice, rather than not at all.
+    """
+
+    def __init__(self, maxsize, state=None, ttl=3 * 86400):
+        self.maxsize = maxsize
+        self.state = state
+        self.ttl = ttl
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Record key. Returns False if key had already been recorded."""
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                return False
+            self._recent[key] = None
+            while len(self._recent) > self.maxsize:
+                self._recent.popitem(last=False)
+        if self.state is None:
+            return True
+        try:
+            return self.state.add('dedup:' + key, '1', ttl=self.ttl)
+        except sharedstate.StateError as e:
+            _state_failed('dedup', e)
+            return True
+
+    def discard(self, key):
+        """Forget key, so a later delivery with it is handled."""
+        with self._lock:
+            self._recent.pop(key, None)
+        if self.state is not None:
+            try:
+                self.state.delete('dedup:' + key)
+            except sharedstate.StateError as e:
+                _state_failed('dedup', e)
+
+    def clear(self):
+        """Forget all keys."""
+        with self._lock:
+            self._recent.clear()
+        if self.state is not None:
+            self.state.clear('dedup:')
+
+
+_dedup_state = _state
+if 'GITHUB_COMMIT_EMAILER_DEDUP_DB' in os.environ:
+    _dedup_state = sharedstate.SQLiteState(
+        os.environ['GITHUB_COMMIT_EMAILER_DEDUP_DB'])
+_dedup = _DedupIndex(
+    int(os.environ.get('GITHUB_COMMIT_EMAILER_DEDUP_SIZE', 10000)),
+    state=_dedup_state,
+    ttl=float(os.environ.get('GITHUB_COMMIT_EMAILER_DEDUP_TTL', 3 * 86400)))
+
+
+class _StageTimer(object):
+    """Context manager that records its duration in a stage histogram."""
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.stage, seconds)
+        log = _webhook_log.get()
+        if log is not None:
+            log.stage(self.stage, seconds)
+
+
+class _Metrics(object):
+    """Counters, gauges and per-stage latency histograms, rendered in
+    Prometheus text format.
+
+    Recording a value costs a lock and a dict update. If directory is set,
+    each process also writes its values there every interval seconds, and
+    render() adds up every process's file, so /metrics covers all gunicorn
+    workers whichever one answers. Counters and histograms of exited
+    processes are kept; their gauges are not. Gauges are not added up, since
+    some read state every process shares, such as the outbox; each live
+    process's value is rendered with a pid label instead.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    HELP = {
+        'commit_emailer_stage_seconds':
+            ('histogram', 'Time spent in each stage of sending an email.'),
+        'commit_emailer_emails_skipped_total':
+            ('counter', 'Webhooks that did not need an email, by reason.'),
+        'commit_emailer_emails_sent_total':
+            ('counter', 'Emails accepted by the SMTP server.'),
+        'commit_emailer_emails_failed_total':
+            ('counter', 'Attempts to send an email that failed.'),
+        'commit_emailer_recipients_refused_total':
+            ('counter', 'Recipients the SMTP server refused for good.'),
+        'commit_emailer_github_lookups_skipped_total':
+            ('counter', 'PR lookups skipped without asking github, by '
+                        'reason.'),
+        'commit_emailer_errors_total':
+            ('counter', 'Exceptions queued to be reported to rollbar.'),
+        'commit_emailer_errors_reported_total':
+            ('counter', 'Distinct exceptions reported to rollbar.'),
+        'commit_emailer_errors_dropped_total':
+            ('counter', 'Exceptions not reported because too many distinct '
+                        'ones were waiting.'),
+        'commit_emailer_state_errors_total':
+            ('counter', 'Shared state operations that failed, by use.'),
+        'commit_emailer_log_records_dropped_total':
+            ('counter', 'Log records dropped because too many were waiting '
+                        'to be written.'),
+        'commit_emailer_webhooks_rejected_total':
+            ('counter', 'Webhooks answered 503 because the queue was full.'),
+        'commit_emailer_delivery_queue_depth':
+            ('gauge', 'Emails waiting for a delivery thread.'),
+        'commit_emailer_deliveries_in_flight':
+            ('gauge', 'Emails being delivered by the async server.'),
+        'commit_emailer_outbox_pending':
+            ('gauge', 'Emails waiting in the outbox to be sent or retried.'),
+        'commit_emailer_digest_pending':
+            ('gauge', 'Emails collected for digests not yet sent.'),
+        'commit_emailer_github_circuit_open':
+            ('gauge', '1 while PR lookups are off because github is '
+                      'failing.'),
+        'commit_emailer_errors_pending':
+            ('gauge', 'Distinct exceptions waiting to be reported.'),
     }
-    _send_email(msg_info)
 
-    return 'yep'
+    def __init__(self, directory=None, interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._pid = None
+
+    def inc(self, name, value=1, **labels):
+        """Add value to the counter name with labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self.directory is not None and self._pid != os.getpid():
+            self._start_writer()
+
+    def observe(self, stage, seconds):
+        """Record that stage took seconds."""
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            h = self._histograms.get(stage)
+            if h is None:
+                # One count per bucket, then +Inf, then the sum.
+                h = self._histograms[stage] = [0] * (len(self.BUCKETS) + 1)
+                h.append(0.0)
+            h[i] += 1
+            h[-1] += seconds
+        if self.directory is not None and self._pid != os.getpid():
+            self._start_writer()
+
+    def timer(self, stage):
+        """Returns context manager that records its duration for stage."""
+        return _StageTimer(self, stage)
+
+    def gauge(self, name, func):
+        """Report the value returned by func as gauge name."""
+        self._gauges[name] = func
+
+    def snapshot(self):
+        """Returns this process's values as a JSON-able dict."""
+        with self._lock:
+            counters = [[name, list(labels), value]
+                        for (name, labels), value in self._counters.items()]
+            histograms = dict((stage, list(h))
+                              for stage, h in self._histograms.items())
+        gauges = {}
+        for name, func in self._gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                logging.exception('Could not read gauge %s.', name)
+        return {'pid': os.getpid(), 'counters': counters,
+                'histograms': histograms, 'gauges': gauges}
+
+    def render(self):
+        """Returns all processes' values in Prometheus text format."""
+        snapshot = self.snapshot()
+        snapshots = [snapshot]
+        if self.directory is not None:
+            self._write(snapshot)
+            snapshots = self._read_all()
+
+        counters = collections.OrderedDict()
+        histograms = {}
+        gauges = {}
+        for snap in snapshots:
+            for name, labels, value in snap['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for stage, h in snap['histograms'].items():
+                total = histograms.setdefault(stage, [0] * len(h))
+                for i, value in enumerate(h):
+                    total[i] += value
+            if snap is snapshot or _pid_alive(snap['pid']):
+                labels = ()
+                if self.directory is not None:
+                    labels = (('pid', str(snap['pid'])),)
+                for name, value in snap['gauges'].items():
+                    gauges[(name, labels)] = value
+
+        lines = []
+        values = sorted(list(counters.items()) + list(gauges.items()))
+        for name in sorted(set(name for (name, _), _ in values)):
+            self._header(lines, name)
+            for (n, labels), value in values:
+                if n == name:
+                    lines.append('{0}{1} {2}'.format(
+                        name, _labels(labels), value))
+        if histograms:
+            name = 'commit_emailer_stage_seconds'
+            self._header(lines, name)
+            for stage in sorted(histograms):
+                h = histograms[stage]
+                cumulative = 0
+                bounds = [repr(b) for b in self.BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, h):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, _labels((('stage', stage), ('le', bound))),
+                        cumulative))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, _labels((('stage', stage),)), h[-1]))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, _labels((('stage', stage),)), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name):
+        kind, text = self.HELP.get(name, ('untyped', name))
+        lines.append('# HELP {0} {1}'.format(name, text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    def _write(self, snapshot):
+        path = os.path.join(self.directory, '{0}.json'.format(os.getpid()))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    def _read_all(self):
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or replaced while we read it.
+                continue
+        return snapshots
+
+    def _start_writer(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run_writer, name='metrics-writer',
+                         daemon=True).start()
+
+    def _run_writer(self):
+        while True:
+            try:
+                self._write(self.snapshot())
+            except OSError:
+                logging.exception('Could not write metrics.')
+            time.sleep(self.interval)
+
+
+def _labels(labels):
+    """Returns Prometheus label set for a sequence of (name, value)."""
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def _pid_alive(pid):
+    """Returns True if process pid is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_metrics = _Metrics(os.environ.get('GITHUB_COMMIT_EMAILER_METRICS_DIR'))
+_metrics.gauge('commit_emailer_delivery_queue_depth',
+               lambda: _delivery_queue.qsize())
+_metrics.gauge('commit_emailer_outbox_pending',
+               lambda: _outbox.pending() if _outbox is not None else 0)
+_metrics.gauge('commit_emailer_digest_pending',
+               lambda: _digest.pending() if _digest is not None else 0)
+_metrics.gauge('commit_emailer_github_circuit_open',
+               lambda: int(_github_breaker.is_open))
+_metrics.gauge('commit_emailer_errors_pending', lambda: _errors.pending())
+
+
+class _DeliveryQueue(object):
+    """Bounded in-process queue drained by a pool of delivery threads.
+
+    Threads are started lazily, and restarted after a fork, so that each
+    gunicorn worker gets its own pool.
+    """
+
+    def __init__(self, handler, workers, maxsize):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._closed = False
+
+    def submit(self, item):
+        """Queue item for delivery, to be handled in a copy of the current
+        context. Returns False if the queue is full, or draining."""
+        if self._closed:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((contextvars.copy_context(), item))
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        """Block until every queued item has been handled."""
+        self._queue.join()
+
+    def drain(self, timeout):
+        """Stop taking new items, and wait up to timeout seconds for the
+        queued ones to be handled. Returns the number still unhandled."""
+        self._closed = True
+        if self._pid != os.getpid():
+            return 0
+        deadline = time.monotonic() + timeout
+        q = self._queue
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                q.all_tasks_done.wait(left)
+            return q.unfinished_tasks
+
+    def qsize(self):
+        """Returns approximate number of items waiting for delivery."""
+        return self._queue.qsize()
 
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Anything queued in a parent process has no threads to run it.
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run,
+                                     name='delivery-{0}'.format(i),
+                                     daemon=True)
+                t.start()
+            self._pid = os.getpid()
 
-def _get_secret():
-    """Returns secret from environment. Raises ValueError if not set
-    in environment."""
-    if 'GITHUB_COMMIT_EMAILER_SECRET' not in os.environ:
+    def _run(self):
+        while True:
+            context, item = self._queue.get()
+            try:
+                context.run(self.handler, item)
+            except Exception:
+                logging.exception('Failed to deliver commit email.')
+                _errors.report()
+            finally:
+                self._queue.task_done()
+
+
+_delivery_queue = _DeliveryQueue(
+    _deliver,
+    workers=int(os.environ.get('GITHUB_COMMIT_EMAILER_DELIVERY_WORKERS', 2)),
+    maxsize=int(os.environ.get('GITHUB_COMMIT_EMAILER_QUEUE_SIZE', 100)))
+
+
+class _ErrorReporter(object):
+    """Reports exceptions to rollbar in batches from a background thread,
+    so that a failure is never slowed down by reporting it.
+
+    Exceptions are deduplicated by fingerprint (see _fingerprint()). Every
+    interval seconds, each fingerprint seen since the last batch is reported
+    once, with how many times it occurred. At most maxsize fingerprints wait
+    for a batch; exceptions with new fingerprints past that are dropped and
+    counted. The thread is started lazily, and restarted after a fork.
+    """
+
+    def __init__(self, maxsize, interval):
+        self.maxsize = maxsize
+        self.interval = interval
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def report(self, exc_info=None, request=None):
+        """Queue exc_info, or the exception being handled, to be reported
+        with the next batch. request is the flask request, if any, that
+        raised it. Returns False if it was dropped."""
+        if exc_info is None:
+            exc_info = sys.exc_info()
+        fingerprint = _fingerprint(exc_info)
+        summary = _request_summary(request)
+        now = time.time()
+        _metrics.inc('commit_emailer_errors_total')
+        with self._lock:
+            pending = self._pending.get(fingerprint)
+            if pending is None and len(self._pending) >= self.maxsize:
+                pending = False
+            elif pending is None:
+                # Only the first occurrence's traceback is kept.
+                self._pending[fingerprint] = pending = {
+                    'exc_info': exc_info,
+                    'request': summary,
+                    'occurrences': 0,
+                    'first_seen': now,
+                }
+            if pending:
+                pending['occurrences'] += 1
+                pending['last_seen'] = now
+        if pending is False:
+            _metrics.inc('commit_emailer_errors_dropped_total')
+            return False
+        self._ensure_started()
+        return True
+
+    def pending(self):
+        """Returns number of fingerprints waiting to be reported."""
+        return len(self._pending)
+
+    def flush(self):
+        """Report everything pending now. Returns number of items sent."""
+        with self._lock:
+            batch, self._pending = self._pending, collections.OrderedDict()
+        for fingerprint, pending in batch.items():
+            payload_data = {'fingerprint': fingerprint}
+            if pending['request'] is not None:
+                payload_data['request'] = pending['request']
+            rollbar.report_exc_info(
+                pending['exc_info'],
+                extra_data={'occurrences': pending['occurrences'],
+                            'first_seen': pending['first_seen'],
+                            'last_seen': pending['last_seen']},
+                payload_data=payload_data)
+        if batch:
+            _metrics.inc('commit_emailer_errors_reported_total', len(batch))
+        return len(batch)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='error-reporter',
+                             daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Failed to report errors.')
+
+
+def _fingerprint(exc_info):
+    """Returns hex digest of exc_info's exception type and the code
+    location of each frame in its traceback. The message is left out, as
+    it often holds values, like a delivery id, that differ every time."""
+    exc_type, _, tb = exc_info
+    h = hashlib.sha1('{0.__module__}.{0.__qualname__}'.format(
+        exc_type).encode('utf-8'))
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        h.update('\n{0}:{1}:{2}'.format(
+            code.co_filename, code.co_name, tb.tb_lineno).encode('utf-8'))
+        tb = tb.tb_next
+    return h.hexdigest()
+
+
+def _request_summary(request):
+    """Returns rollbar's request data for a flask request, or None. It is
+    taken now, as the request is gone by the time the batch is sent, and
+    leaves out the body and headers, which hold the webhook signature."""
+    if request is None:
+        return None
+    return {'url': request.url, 'method': request.method,
+            'GET': request.args.to_dict(),
+            'headers': {'X-GitHub-Event': request.headers.get(
+                            'X-GitHub-Event', ''),
+                        'X-GitHub-Delivery': request.headers.get(
+                            'X-GitHub-Delivery', '')}}
+
+
+_errors = _ErrorReporter(
+    maxsize=int(os.environ.get('GITHUB_COMMIT_EMAILER_ERROR_BUFFER', 100)),
+    interval=float(os.environ.get('GITHUB_COMMIT_EMAILER_ERROR_INTERVAL',
+                                  10)))
+
+
+_Config = collections.namedtuple('_Config', [
+    'secret',            # bytes
+    'secret_macs',       # dict of algorithm to HMAC keyed with secret
+    'max_body',          # int, largest webhook body accepted, in bytes
+    'max_files',         # int, changed files listed in an email
+    'max_dirs',          # int, directories listed after max_files
+    'sender',            # str or None, if send_from_author
+    'send_from_author',  # bool
+    'recipient',         # str
+    'recipient_cc',      # tuple of str
+    'recipients',        # tuple of str, CCs followed by recipient
+    'subject_prefix',    # str
+    'route',             # _Route used when no rule matches
+    'rules',             # _Rules or None
+    'templates',         # _Templates
+    'github_token',      # str or None
+    'github_max_wait',   # float, seconds to wait for the github rate limit
+    'deadline',          # float, seconds a webhook has for the PR lookup
+    'reply_to',          # str or None
+    'approved',          # str or None
+    'mailgun_login',     # str or None
+    'mailgun_password',  # str or None
+])
+
+
+# The config vars _load_config reads, which the config file can set, and
+# which are reloaded with it. The others are only read from the environment
+# at startup.
+_CONFIG_FILE_VARS = frozenset('GITHUB_COMMIT_EMAILER_' + name for name in [
+    'SECRET', 'SENDER', 'SEND_FROM_AUTHOR', 'RECIPIENT', 'RECIPIENT_CC',
+    'SUBJECT_PREFIX', 'RULES', 'TEMPLATES', 'HTML', 'MAX_BODY', 'MAX_FILES',
+    'MAX_DIRS', 'GITHUB_TOKEN', 'GITHUB_MAX_WAIT', 'DEADLINE', 'REPLY_TO',
+    'APPROVED_HEADER']) | frozenset(['MAILGUN_LOGIN', 'MAILGUN_PASSWORD'])
+
+
+def _load_config(env):
+    """Returns validated _Config built from env, a dict of config vars.
+    Raises ValueError if required config vars are missing."""
+    if 'GITHUB_COMMIT_EMAILER_SECRET' not in env:
         logging.error('No secret configured in environment.')
         raise ValueError('No secret configured in environment.')
-    return os.environ.get('GITHUB_COMMIT_EMAILER_SECRET')
-
 
-def _send_email(msg_info):
-    """Create and send commit notification email."""
-    sender = _get_sender(msg_info['pusher_email'])
-    recipient = os.environ.get('GITHUB_COMMIT_EMAILER_RECIPIENT')
-    if sender is None or recipient is None:
+    send_from_author = 'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in env
+    sender = env.get('GITHUB_COMMIT_EMAILER_SENDER')
+    recipient = env.get('GITHUB_COMMIT_EMAILER_RECIPIENT')
+    if (sender is None and not send_from_author) or recipient is None:
         logging.error('sender and recipient config vars must be set.')
         raise ValueError('sender and recipient config vars must be set.')
 
-    recipient_ccs = os.environ.get('GITHUB_COMMIT_EMAILER_RECIPIENT_CC', None)
+    recipient_ccs = env.get('GITHUB_COMMIT_EMAILER_RECIPIENT_CC', None)
     if recipient_ccs is not None:
-        recipient_cc = recipient_ccs.split(",")
+        recipient_cc = tuple(cc.strip() for cc in recipient_ccs.split(",")
+                             if cc.strip())
     else:
-        recipient_cc = None
-    reply_to = os.environ.get('GITHUB_COMMIT_EMAILER_REPLY_TO', None)
-    approved = os.environ.get('GITHUB_COMMIT_EMAILER_APPROVED_HEADER', None)
-    subject = _get_subject(msg_info['repo'], msg_info['message'])
-    if recipient_cc is not None:
-        recipients = recipient_cc + [recipient]
+        recipient_cc = ()
+
+    subject_prefix = env.get('GITHUB_COMMIT_EMAILER_SUBJECT_PREFIX',
+                             '[Chapel Merge]')
+    route = _Route((recipient,), recipient_cc, subject_prefix)
+    rules = None
+    if 'GITHUB_COMMIT_EMAILER_RULES' in env:
+        rules = _load_rules(env['GITHUB_COMMIT_EMAILER_RULES'], route)
+
+    templates = _Templates(env.get('GITHUB_COMMIT_EMAILER_TEMPLATES'),
+                           html='GITHUB_COMMIT_EMAILER_HTML' in env)
+
+    secret = env['GITHUB_COMMIT_EMAILER_SECRET'].encode('utf-8')
+    return _Config(
+        secret=secret,
+        secret_macs={algorithm: hmac.new(secret, digestmod=algorithm)
+                     for _, algorithm in _SIGNATURE_HEADERS},
+        max_body=int(env.get('GITHUB_COMMIT_EMAILER_MAX_BODY',
+                             25 * 1024 * 1024)),
+        max_files=int(env.get('GITHUB_COMMIT_EMAILER_MAX_FILES', 100)),
+        max_dirs=int(env.get('GITHUB_COMMIT_EMAILER_MAX_DIRS', 50)),
+        sender=sender,
+        send_from_author=send_from_author,
+        recipient=recipient,
+        recipient_cc=recipient_cc,
+        recipients=recipient_cc + (recipient,),
+        subject_prefix=subject_prefix,
+        route=route,
+        rules=rules,
+        templates=templates,
+        github_token=env.get('GITHUB_COMMIT_EMAILER_GITHUB_TOKEN'),
+        github_max_wait=float(env.get('GITHUB_COMMIT_EMAILER_GITHUB_MAX_WAIT',
+                                      5)),
+        deadline=float(env.get('GITHUB_COMMIT_EMAILER_DEADLINE', 10)),
+        reply_to=env.get('GITHUB_COMMIT_EMAILER_REPLY_TO', None),
+        approved=env.get('GITHUB_COMMIT_EMAILER_APPROVED_HEADER', None),
+        mailgun_login=env.get('MAILGUN_LOGIN', None),
+        mailgun_password=env.get('MAILGUN_PASSWORD', None),
+    )
+
+
+class _Route(collections.namedtuple('_Route', [
+        'to',              # tuple of str
+        'cc',              # tuple of str
+        'subject_prefix',  # str
+        ])):
+    """Where an email is sent, and the prefix of its subject."""
+
+    __slots__ = ()
+
+    @property
+    def recipients(self):
+        """Returns list of envelope recipients, CCs followed by To."""
+        return list(self.cc + self.to)
+
+
+def _load_rules(path, default):
+    """Returns _Rules compiled from the JSON file at path. Raises ValueError
+    if the file cannot be read or the rules are not valid."""
+    try:
+        with open(path) as f:
+            rules = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error('Could not load rules from %s: %s', path, e)
+        raise ValueError('Could not load rules from {0}: {1}'.format(
+            path, e))
+    return _Rules(rules, default)
+
+
+class _Rules(object):
+    """Routing rules, compiled once into indexes so that routing a merge
+    costs a few dict lookups per changed file, however many rules there are.
+
+    rules is a list of dicts. Each may have a "repo" name and a "branch"
+    name, either of which may be a glob, and a list of "paths" prefixes, and
+    matches merges to that repo and branch changing a file under one of the
+    paths. Missing keys match anything. Path prefixes are matched a whole
+    path component at a time, so "doc" matches "doc/README" but not
+    "docs/README". A matching rule adds its "recipients" and "cc" addresses,
+    and the first matching rule with a "subject_prefix" sets the prefix.
+    Anything no matching rule sets comes from the default _Route.
+    """
+
+    _KEYS = frozenset(['repo', 'branch', 'paths', 'recipients', 'cc',
+                       'subject_prefix'])
+
+    def __init__(self, rules, default):
+        self.default = default
+        # Per rule: (to, cc, subject_prefix, has paths).
+        self._rules = []
+        # Rule ids by repo, then by branch pattern (None for any branch).
+        self._by_repo = {}
+        self._repo_globs = []
+        self._any_repo = {}
+        self._branch_res = {}
+        # Path component trie. A node's None key lists the ids of rules with
+        # a prefix ending there.
+        self._trie = {}
+
+        if not isinstance(rules, list):
+            raise ValueError('Rules must be a list.')
+        globs = collections.OrderedDict()
+        for i, rule in enumerate(rules):
+            self._check(i, rule)
+            repo = rule.get('repo')
+            if repo is None:
+                by_branch = self._any_repo
+            elif _is_glob(repo):
+                by_branch = globs.setdefault(repo, {})
+            else:
+                by_branch = self._by_repo.setdefault(repo, {})
+            branch = rule.get('branch')
+            by_branch.setdefault(branch, []).append(i)
+            if branch is not None and branch not in self._branch_res:
+                self._branch_res[branch] = _compile_glob(branch)
+
+            paths = rule.get('paths', [])
+            for prefix in paths:
+                node = self._trie
+                for part in prefix.strip('/').split('/'):
+                    node = node.setdefault(part, {})
+                node.setdefault(None, []).append(i)
+            self._rules.append((tuple(rule.get('recipients', ())),
+                                tuple(rule.get('cc', ())),
+                                rule.get('subject_prefix'),
+                                bool(paths)))
+        self._repo_globs = [(_compile_glob(pattern), by_branch)
+                            for pattern, by_branch in globs.items()]
+
+    def _check(self, i, rule):
+        def fail(problem):
+            raise ValueError('Rule {0} {1}.'.format(i, problem))
+
+        if not isinstance(rule, dict):
+            fail('is not an object')
+        unknown = set(rule) - self._KEYS
+        if unknown:
+            fail('has unknown keys {0}'.format(', '.join(sorted(unknown))))
+        for key in ('repo', 'branch', 'subject_prefix'):
+            if not isinstance(rule.get(key, ''), str):
+                fail('{0} is not a string'.format(key))
+        for key in ('paths', 'recipients', 'cc'):
+            values = rule.get(key, [])
+            if (not isinstance(values, list) or
+                    not all(isinstance(v, str) and v.strip('/')
+                            for v in values)):
+                fail('{0} is not a list of strings'.format(key))
+
+    def route(self, repo, branch, paths):
+        """Returns _Route for a merge to repo's branch, a ref, changing
+        paths, an iterable of file paths."""
+        if branch.startswith('refs/heads/'):
+            branch = branch[len('refs/heads/'):]
+        groups = [self._any_repo, self._by_repo.get(repo, {})]
+        groups.extend(by_branch for repo_re, by_branch in self._repo_globs
+                      if repo_re.match(repo))
+        candidates = set()
+        for by_branch in groups:
+            for pattern, ids in by_branch.items():
+                if pattern is None or self._branch_res[pattern].match(branch):
+                    candidates.update(ids)
+
+        matched = set(i for i in candidates if not self._rules[i][3])
+        wanted = candidates - matched
+        if wanted:
+            matched.update(self._match_paths(paths, wanted))
+        if not matched:
+            return self.default
+
+        to = collections.OrderedDict()
+        cc = collections.OrderedDict()
+        subject_prefix = None
+        for i in sorted(matched):
+            rule_to, rule_cc, rule_prefix, _ = self._rules[i]
+            to.update((address, None) for address in rule_to)
+            cc.update((address, None) for address in rule_cc)
+            if subject_prefix is None:
+                subject_prefix = rule_prefix
+        if not to:
+            to.update((address, None) for address in self.default.to)
+            cc = collections.OrderedDict(
+                itertools.chain(((address, None)
+                                 for address in self.default.cc),
+                                cc.items()))
+        return _Route(tuple(to), tuple(cc),
+                      subject_prefix or self.default.subject_prefix)
+
+    def _match_paths(self, paths, wanted):
+        """Returns the ids in wanted of rules with a prefix of one of
+        paths. Stops reading paths once every wanted rule has matched."""
+        found = set()
+        # Files in the same directory share the trie walk.
+        dirs = {}
+        for path in paths:
+            dirname, _, basename = path.rpartition('/')
+            entry = dirs.get(dirname)
+            if entry is None:
+                ids = set()
+                node = self._trie
+                for part in dirname.split('/') if dirname else ():
+                    node = node.get(part)
+                    if node is None:
+                        break
+                    ids.update(node.get(None, ()))
+                entry = dirs[dirname] = (ids & wanted, node)
+            ids, node = entry
+            found.update(ids)
+            leaf = node.get(basename) if node is not None else None
+            if leaf is not None:
+                found.update(i for i in leaf.get(None, ()) if i in wanted)
+            if len(found) == len(wanted):
+                break
+        return found
+
+
+def _is_glob(pattern):
+    """Returns True if pattern has fnmatch wildcards."""
+    return any(c in pattern for c in '*?[')
+
+
+def _compile_glob(pattern):
+    """Returns compiled regex matching the strings fnmatch pattern does."""
+    return re.compile(fnmatch.translate(pattern))
+
+
+class _Templates(object):
+    """Subject and body templates, compiled when the config is loaded.
+
+    Templates are looked up in directory, if set, and then in the templates
+    directory of this app. body.html is only used if html is True. A changed
+    template file is recompiled the next time a template is rendered,
+    checking at most once every check_interval seconds; if it no longer
+    compiles, the old templates are kept.
+    """
+
+    NAMES = ('subject.txt', 'digest_subject.txt', 'body.txt', 'body.html')
+
+    def __init__(self, directory=None, html=False, check_interval=1.0):
+        self.html = html
+        self.check_interval = check_interval
+        dirs = [_TEMPLATES_DIR]
+        if directory is not None:
+            dirs.insert(0, directory)
+        self._env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(dirs),
+            autoescape=jinja2.select_autoescape(['html']),
+            undefined=jinja2.StrictUndefined,
+            keep_trailing_newline=True,
+            auto_reload=False)
+        self._lock = threading.Lock()
+        self._templates = self._compile()
+        self._checked = time.monotonic()
+
+    def render(self, name, **context):
+        """Returns template name rendered with context."""
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            self._refresh(now)
+        return self._templates[name].render(**context)
+
+    def _compile(self):
+        templates = {}
+        for name in self.NAMES:
+            if name.endswith('.html') and not self.html:
+                continue
+            try:
+                templates[name] = self._env.get_template(name)
+            except jinja2.TemplateError as e:
+                logging.error('Could not compile template %s: %s', name, e)
+                raise ValueError('Could not compile template {0}: {1}'.format(
+                    name, e))
+        return templates
+
+    def _refresh(self, now):
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            if all(t.is_up_to_date for t in self._templates.values()):
+                return
+            self._env.cache.clear()
+            try:
+                self._templates = self._compile()
+            except ValueError:
+                logging.error('Keeping the previous templates.')
+
+
+_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'templates')
+
+
+def _read_config_file(path):
+    """Returns dict of config vars from a file of KEY=value lines, in the
+    format written by "heroku config --shell"."""
+    env = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+                value = value[1:-1]
+            env[key.strip()] = value
+    return env
+
+
+def reload_config():
+    """Build a new config snapshot from the environment, overlaid with the
+    file named by GITHUB_COMMIT_EMAILER_CONFIG if set, and swap it in.
+
+    Raises ValueError, and keeps the current snapshot, if the new config is
+    not valid, or OSError if the file cannot be read.
+    """
+    global _config, _config_mtime
+    env = dict(os.environ)
+    path = env.get('GITHUB_COMMIT_EMAILER_CONFIG')
+    mtime = None
+    if path is not None:
+        mtime = os.stat(path).st_mtime
+        file_env = _read_config_file(path)
+        for key in sorted(file_env):
+            if (key.startswith('GITHUB_COMMIT_EMAILER_') and
+                    key not in _CONFIG_FILE_VARS):
+                logging.warn('Ignoring %s in %s, it is only read from the '
+                             'environment at startup.', key, path)
+        env.update(file_env)
+    config = _load_config(env)
+    _config, _config_mtime = config, mtime
+    _github_limiter.configure(_github_limit(config.github_token))
+    return config
+
+
+def _get_config():
+    """Returns the current config snapshot. It is loaded on first use, and
+    reloaded when the config file has changed."""
+    global _config_checked
+    config = _config
+    if config is None:
+        return reload_config()
+
+    path = os.environ.get('GITHUB_COMMIT_EMAILER_CONFIG')
+    now = time.monotonic()
+    if path is not None and now - _config_checked >= 1:
+        _config_checked = now
+        try:
+            if os.stat(path).st_mtime != _config_mtime:
+                config = reload_config()
+                logging.info('Reloaded config from %s.', path)
+        except (OSError, ValueError):
+            logging.exception('Could not reload config, keeping old one.')
+    return config
+
+
+def _reload_config_on_signal(signum, frame):
+    try:
+        reload_config()
+        logging.info('Reloaded config on signal %s.', signum)
+    except (OSError, ValueError):
+        logging.exception('Could not reload config, keeping old one.')
+
+
+_config = None
+_config_mtime = None
+_config_checked = 0.0
+
+if threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, _reload_config_on_signal)
+
+
+def preload():
+    """Do the startup work that forked processes can share: load and
+    validate the config, and answer a first request, so that flask's first
+    request setup, including init_rollbar(), is done. Raises ValueError if
+    the config is invalid, or OSError if the config file cannot be read.
+
+    gunicorn's master calls this when preload_app is set, so workers start
+    with it done. See gunicorn.conf.py.
+    """
+    reload_config()
+    with app.test_client() as client:
+        client.get('/')
+
+
+def warm_up():
+    """Get this process ready for its first webhook: do the preload() work
+    if it has not been done, handle SIGHUP, start the delivery threads and
+    the outbox, and, in a background thread, open connections to the SMTP
+    server and github. Returns that thread. Raises like preload() if the
+    config is invalid.
+
+    gunicorn calls this in each worker as it starts. See gunicorn.conf.py.
+    """
+    if _config is None or not app.got_first_request:
+        preload()
+    if threading.current_thread() is threading.main_thread():
+        # gunicorn resets signal handlers in its workers.
+        signal.signal(signal.SIGHUP, _reload_config_on_signal)
+    if _delivery_queue.workers:
+        _delivery_queue._ensure_started()
+    if _outbox is not None:
+        # Replay anything a previous process left behind.
+        _outbox._ensure_started()
+    thread = threading.Thread(target=_open_connections, name='warm-up',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def _open_connections():
+    """Open a pooled SMTP connection and a github API connection, and
+    learn the github rate limit. Failures are logged; the first email will
+    try again."""
+    try:
+        with _metrics.timer('warm_up_smtp'):
+            _smtp_pool.warm()
+    except Exception as e:
+        logging.warn('Could not open SMTP connection: %r', e)
+    try:
+        # Asking for the rate limit does not count against it.
+        with _metrics.timer('warm_up_github'):
+            response = _github_session.get(
+                url='{0}/rate_limit'.format(_GITHUB_API),
+                headers=_github_headers(),
+                timeout=_GITHUB_TIMEOUT)
+        _github_limiter.observe(response.status_code, response.headers)
+    except Exception as e:
+        logging.warn('Could not open github connection: %r', e)
+
+
+def flush_pending(drain_timeout=None):
+    """Stop taking webhooks, and wait up to drain_timeout seconds (default
+    GITHUB_COMMIT_EMAILER_DRAIN_TIMEOUT) for the emails already accepted to
+    be delivered. Then send the digests still being collected, write out the
+    outbox's sent batch, and report errors still waiting for a batch, before
+    this process exits.
+
+    gunicorn calls this as each worker exits (see gunicorn.conf.py), the
+    async server as it stops, and it is also registered with atexit.
+    Calling it more than once is harmless.
+    """
+    if drain_timeout is None:
+        drain_timeout = _DRAIN_TIMEOUT
+    left = _delivery_queue.drain(drain_timeout)
+    if left:
+        logging.error('Exiting with %d emails not delivered.', left)
+    if _digest is not None:
+        _digest.flush_all()
+    if _outbox is not None:
+        _outbox.flush()
+    _errors.flush()
+
+
+_DRAIN_TIMEOUT = float(os.environ.get('GITHUB_COMMIT_EMAILER_DRAIN_TIMEOUT',
+                                      20))
+atexit.register(flush_pending)
+
+
+def _send_email(msg_info):
+    """Create and send commit notification email. Returns False if the
+    outbox kept it to retry later, otherwise True."""
+    if _digest is not None:
+        _digest.add(_get_route(msg_info), msg_info)
+        return True
+
+    return _send_message(*_email_for(msg_info))
+
+
+def _email_for(msg_info):
+    """Returns (sender, route, subject, body, html_body) of the email for
+    msg_info. html_body is None unless HTML emails are configured."""
+    route = _get_route(msg_info)
+    sender = _get_sender(msg_info['pusher_email'])
+    subject = _get_subject(msg_info['repo'], msg_info['message'],
+                           route.subject_prefix)
+    return (sender, route, subject, _get_body(msg_info),
+            _get_html_body(msg_info))
+
+
+def _get_route(msg_info):
+    """Returns _Route the rules chose for msg_info, or the configured
+    default."""
+    return msg_info.get('route') or _get_config().route
+
+
+def _send_digest(route, batch):
+    """Send one email for a batch of msg_infos collected in digest mode."""
+    if len(batch) == 1:
+        subject = _get_subject(batch[0]['repo'], batch[0]['message'],
+                               route.subject_prefix)
+    else:
+        subject = _get_digest_subject(batch, route.subject_prefix)
+    senders = set(_get_sender(m['pusher_email']) for m in batch)
+    if len(senders) == 1:
+        sender = senders.pop()
     else:
-        recipients = [recipient]
+        sender = (_get_config().sender or
+                  _get_sender(batch[0]['pusher_email']))
+    body = '\n{0}\n\n'.format('-' * 72).join(
+        _get_body(m) for m in batch)
+    html_body = None
+    if _get_config().templates.html:
+        html_body = '\n<hr>\n'.join(_get_html_body(m) for m in batch)
+    _send_message(sender, route, subject, body, html_body)
 
-    port = 587
-    smtp_server = "smtp.mailgun.org"
-    login = os.environ.get('MAILGUN_LOGIN', None)
-    password = os.environ.get('MAILGUN_PASSWORD', None)
 
-    body = """Branch: {branch}
-    Revision: {revision}
-    Author: {pusher}
-    Link: {pr_url}
-    Log Message:
+def _get_body(msg_info):
+    """Returns plain text email body for msg_info."""
+    return _get_config().templates.render('body.txt', **msg_info)
 
-    {message}
 
-    Modified Files:
-    {changed_files}
+def _get_html_body(msg_info):
+    """Returns HTML email body for msg_info, or None if HTML emails are not
+    configured."""
+    templates = _get_config().templates
+    if not templates.html:
+        return None
+    return templates.render('body.html', **msg_info)
 
-    Compare: {compare_url}
-    """.format(**msg_info)
+
+def _send_message(sender, route, subject, body, html_body=None):
+    """Build MIME message with configured headers and send it to route.
+    Returns False if the outbox kept it to retry later, otherwise True."""
+    message = _build_message(sender, route, subject, body, html_body)
+    if _outbox is not None:
+        return _outbox.deliver(sender, route.recipients, message)
+    _smtp_pool.sendmail(sender, route.recipients, message)
+    return True
+
+
+def _build_message(sender, route, subject, body, html_body=None):
+    """Returns MIME message, as a string, with configured headers. If
+    html_body is given, the message is multipart with plain text and HTML
+    alternatives."""
+    config = _get_config()
 
     message = MIMEText(body, "plain", "utf-8")
+    if html_body is not None:
+        text = message
+        message = MIMEMultipart("alternative")
+        message.attach(text)
+        message.attach(MIMEText(html_body, "html", "utf-8"))
     message["Subject"] = subject
     message["From"] = sender
-    message["To"] = recipient
-    message["Cc"] = recipient_ccs
-    if reply_to is not None:
-        message["reply-to"] = reply_to
-    if approved is not None:
-        message["approved"] = approved
+    message["To"] = ",".join(route.to)
+    if route.cc:
+        message["Cc"] = ",".join(route.cc)
+    if config.reply_to is not None:
+        message["reply-to"] = config.reply_to
+    if config.approved is not None:
+        message["approved"] = config.approved
+    return message.as_string()
+
+
+class _Digest(object):
+    """Collects msg_infos per route and sends each route's as a single
+    email once window seconds have passed since its first msg_info, or once
+    max_batch msg_infos have been collected.
+
+    Collected msg_infos are only held in memory until they are flushed,
+    unless state is given (see _open_state()). They are then queued there,
+    so that merges handled by every process using it share digests. Each
+    process that queues a route's first msg_info in a window flushes the
+    route when the window ends.
+    """
+
+    def __init__(self, window, max_batch, flush, state=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.flush = flush
+        self.state = state
+        # Route to its batch or, with state, shared batch key to route.
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, msg_info):
+        """Add msg_info to the batch for route."""
+        if self.state is not None:
+            self._add_shared(route, msg_info)
+            return
+        with self._lock:
+            batch = self._batches.get(route)
+            if batch is None:
+                batch = self._batches[route] = []
+                timer = threading.Timer(self.window, self._flush_batch,
+                                        (route, batch))
+                timer.daemon = True
+                timer.start()
+            batch.append(msg_info)
+            full = len(batch) >= self.max_batch
+        if full:
+            self._flush_batch(route, batch)
+
+    def pending(self):
+        """Returns number of msg_infos collected but not yet sent, in the
+        batches this process is to flush."""
+        with self._lock:
+            if self.state is None:
+                return sum(len(batch) for batch in self._batches.values())
+            keys = list(self._batches)
+        try:
+            return sum(self.state.length(key) for key in keys)
+        except sharedstate.StateError as e:
+            _state_failed('digest', e)
+            return 0
+
+    def flush_all(self):
+        """Send all collected batches now."""
+        with self._lock:
+            items = list(self._batches.items())
+        for item in items:
+            if self.state is None:
+                self._flush_batch(*item)
+            else:
+                self._flush_shared(*item)
+
+    def _add_shared(self, route, msg_info):
+        key = 'digest:' + json.dumps(route)
+        item = dict((k, v) for k, v in msg_info.items() if k != 'route')
+        try:
+            length = self.state.push(key, json.dumps(item))
+        except sharedstate.StateError as e:
+            _state_failed('digest', e)
+            self._send(route, [msg_info])
+            return
+        with self._lock:
+            start = key not in self._batches
+            if start:
+                self._batches[key] = route
+        if length >= self.max_batch:
+            self._flush_shared(key, route)
+        elif start:
+            timer = threading.Timer(self.window, self._flush_shared,
+                                    (key, route))
+            timer.daemon = True
+            timer.start()
+
+    def _flush_shared(self, key, route):
+        with self._lock:
+            self._batches.pop(key, None)
+        batch = []
+        try:
+            while len(batch) < self.max_batch:
+                item = self.state.pop(key)
+                if item is None:
+                    break
+                batch.append(json.loads(item))
+        except sharedstate.StateError as e:
+            _state_failed('digest', e)
+        if batch:
+            self._send(route, batch)
+
+    def _send(self, route, batch):
+        try:
+            self.flush(route, batch)
+        except Exception:
+            logging.exception('Failed to send digest of %d emails.',
+                              len(batch))
+
+    def _flush_batch(self, route, batch):
+        with self._lock:
+            # The batch may already have been flushed for being full.
+            if self._batches.get(route) is not batch:
+                return
+            del self._batches[route]
+        self._send(route, batch)
+
+
+_digest = None
+if 'GITHUB_COMMIT_EMAILER_DIGEST_WINDOW' in os.environ:
+    _digest = _Digest(
+        float(os.environ['GITHUB_COMMIT_EMAILER_DIGEST_WINDOW']),
+        int(os.environ.get('GITHUB_COMMIT_EMAILER_DIGEST_MAX', 50)),
+        _send_digest, state=_state)
+
+
+class _SMTPPool(object):
+    """Pool of logged in SMTP connections that are reused between emails.
+
+    At most size connections are open at once. Idle connections are closed
+    after idle_timeout seconds, and are checked with NOOP before reuse if
+    they have been idle for more than keepalive seconds. A connection the
+    server has dropped is replaced and the send retried once.
+
+    Emails to more than max_recipients are sent in chunks, in parallel over
+    the pool's connections.
+    """
+
+    def __init__(self, host, port, size=2, idle_timeout=60, keepalive=5,
+                 debuglevel=0, limiter=None, max_recipients=1000):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_recipients = max_recipients
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.debuglevel = debuglevel
+        self.limiter = limiter
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def sendmail(self, sender, recipients, message):
+        """Send message to recipients over pooled connections. Returns the
+        dict of refused recipients, like smtplib.SMTP.sendmail.
+
+        Recipients are sent in chunks of at most max_recipients, at most
+        size at a time. Chunks that could not be sent are retried once as a
+        whole, and the recipients of a chunk the server refused for now
+        (4xx) once together. Recipients refused for good (5xx) are logged
+        and returned. Raises like smtplib.SMTP.sendmail if no recipient
+        could be sent to, and _SMTPIncomplete if some still could not be
+        after the retry.
+        """
+        chunks = _chunks(recipients, self.max_recipients)
+        retry, refused = _fan_out_retries(
+            chunks, self._send_chunks(sender, chunks, message))
+        return _fan_out_refused(
+            retry, self._send_chunks(sender, retry, message), refused)
+
+    def _send_chunks(self, sender, chunks, message):
+        """Returns (refused, error) of sending message to each chunk of
+        recipients."""
+        if len(chunks) <= 1:
+            return [self._try_send(sender, chunk, message)
+                    for chunk in chunks]
+        with concurrent.futures.ThreadPoolExecutor(
+                min(self.size, len(chunks))) as pool:
+            return list(pool.map(
+                lambda chunk: self._try_send(sender, chunk, message),
+                chunks))
+
+    def _try_send(self, sender, recipients, message):
+        """Returns (refused, error) of sending message to recipients,
+        where error is the exception raised, if any, other than all the
+        recipients being refused."""
+        try:
+            return self._send(sender, recipients, message), None
+        except smtplib.SMTPRecipientsRefused as e:
+            return e.recipients, None
+        except Exception as e:
+            return {}, e
+
+    def _send(self, sender, recipients, message):
+        """Send message over a pooled connection. Returns the dict of
+        refused recipients."""
+        if self.limiter is not None:
+            self.limiter.acquire()
+        with self._slots:
+            for attempt in range(2):
+                try:
+                    server = self._checkout()
+                except Exception:
+                    _metrics.inc('commit_emailer_emails_failed_total')
+                    raise
+                try:
+                    with _metrics.timer('sendmail'):
+                        result = _sendmail(server, sender, recipients,
+                                           message)
+                except smtplib.SMTPServerDisconnected:
+                    self._discard(server)
+                    if attempt:
+                        _metrics.inc('commit_emailer_emails_failed_total')
+                        raise
+                    logging.warn('SMTP connection dropped, reconnecting.')
+                    continue
+                except Exception:
+                    self._discard(server)
+                    _metrics.inc('commit_emailer_emails_failed_total')
+                    raise
+                self._checkin(server)
+                _metrics.inc('commit_emailer_emails_sent_total')
+                return result
+
+    def warm(self):
+        """Open a connection, unless one is idle already, so that the next
+        send need not wait for it."""
+        with self._slots:
+            self._checkin(self._checkout())
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._discard(server)
+
+    def _checkout(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Connections opened before a fork belong to the parent.
+                    self._idle = []
+                    self._pid = os.getpid()
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            idle_for = now - last_used
+            if idle_for > self.idle_timeout:
+                self._discard(server)
+            elif idle_for > self.keepalive and not self._alive(server):
+                self._discard(server)
+            else:
+                return server
+        return self._connect()
+
+    def _checkin(self, server):
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+
+    def _connect(self):
+        with _metrics.timer('smtp_login'):
+            server = smtplib.SMTP(self.host, self.port)
+            server.set_debuglevel(self.debuglevel)
+            config = _get_config()
+            server.login(config.mailgun_login, config.mailgun_password)
+        return server
+
+    @staticmethod
+    def _alive(server):
+        try:
+            return server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+
+    @staticmethod
+    def _discard(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+def _sendmail(server, sender, recipients, message):
+    """Like server.sendmail, but if the server supports PIPELINING (RFC
+    2920), the MAIL and RCPT commands are sent together, rather than waiting
+    for the reply to each, which saves a round trip per recipient."""
+    server.ehlo_or_helo_if_needed()
+    if 'pipelining' not in server.esmtp_features:
+        return server.sendmail(sender, recipients, message)
 
-    server = smtplib.SMTP(smtp_server, port)
-    server.set_debuglevel(1)
-    server.login(login, password)
-    server.sendmail(sender, recipients, message.as_string())
-    server.quit()
+    lines = ['mail FROM:{0}'.format(smtplib.quoteaddr(sender))]
+    if 'size' in server.esmtp_features:
+        lines[0] += ' size={0}'.format(len(message.encode('utf-8')))
+    lines.extend('rcpt TO:{0}'.format(smtplib.quoteaddr(r))
+                 for r in recipients)
+    server.send(''.join(line + '\r\n' for line in lines))
+    code, resp = server.getreply()
+    if code == 421:
+        server.close()
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    refused = {}
+    for recipient in recipients:
+        rcpt_code, rcpt_resp = server.getreply()
+        if rcpt_code not in (250, 251):
+            refused[recipient] = (rcpt_code, rcpt_resp)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    if len(refused) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, resp = server.data(message)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _chunks(recipients, size):
+    """Returns list of lists of at most size recipients."""
+    recipients = list(recipients)
+    return [recipients[i:i + size] for i in range(0, len(recipients), size)]
+
+
+class _SMTPIncomplete(smtplib.SMTPException):
+    """Raised by _SMTPPool.sendmail when the email was sent to some of the
+    recipients, but not yet to others. recipients lists the ones to send it
+    to again, refused is the dict of the ones refused for good, and error is
+    the last error sending to the others."""
+
+    def __init__(self, recipients, refused, error):
+        smtplib.SMTPException.__init__(
+            self, 'Could not send email to {0} recipients: {1!r}'.format(
+                len(recipients), error))
+        self.recipients = recipients
+        self.refused = refused
+        self.error = error
+
+
+def _transient(code):
+    """Returns whether an SMTP reply code means to try again later."""
+    return 400 <= code < 500
+
+
+def _fan_out_retries(chunks, results):
+    """Returns (retry, refused) after sending to chunks of recipients gave
+    results, a (refused, error) pair per chunk. retry lists the chunks to
+    send again: those that could not be sent, and the recipients of each
+    chunk refused for now, in chunks no larger than the number the server
+    accepted of it (e.g. past a per message limit), or one at a time if it
+    accepted none. refused is the dict of those refused for good.
+    If no recipient was sent to, raises the first error, or
+    SMTPRecipientsRefused if they were all refused."""
+    retry = []
+    refused = {}
+    errors = []
+    for chunk, (chunk_refused, error) in zip(chunks, results):
+        if error is not None:
+            errors.append(error)
+            retry.append(chunk)
+            continue
+        for recipient, reply in chunk_refused.items():
+            if not _transient(reply[0]):
+                refused[recipient] = reply
+        again = [r for r in chunk
+                 if r in chunk_refused and r not in refused]
+        retry.extend(_chunks(again, max(1, len(chunk) - len(chunk_refused))))
+    unsent = len(refused) + sum(len(chunk) for chunk in retry)
+    if unsent == sum(len(chunk) for chunk in chunks):
+        if errors:
+            raise errors[0]
+        for chunk, (chunk_refused, _) in zip(chunks, results):
+            refused.update(chunk_refused)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return retry, refused
+
+
+def _fan_out_refused(chunks, results, refused):
+    """Returns dict of the recipients refused for good, with (code,
+    message), after retrying chunks gave results, and reports them. Raises
+    _SMTPIncomplete if a chunk still could not be sent, or recipients were
+    still refused for now."""
+    refused = dict(refused)
+    again = []
+    error = None
+    for chunk, (chunk_refused, chunk_error) in zip(chunks, results):
+        if chunk_error is not None:
+            again.extend(chunk)
+            error = chunk_error
+            continue
+        for recipient, (code, message) in chunk_refused.items():
+            if _transient(code):
+                again.append(recipient)
+                error = smtplib.SMTPRecipientsRefused(
+                    {recipient: (code, message)})
+            else:
+                refused[recipient] = (code, message)
+    if refused:
+        logging.error('Could not send email to %d recipients: %s',
+                      len(refused), refused)
+        _metrics.inc('commit_emailer_recipients_refused_total', len(refused))
+    if again:
+        raise _SMTPIncomplete(again, refused, error)
+    return refused
+
+
+_smtp_limiter = None
+if 'GITHUB_COMMIT_EMAILER_SMTP_RATE' in os.environ:
+    if _state is not None:
+        _smtp_limiter = _SharedRateLimiter(
+            _state, 'smtp_rate',
+            float(os.environ['GITHUB_COMMIT_EMAILER_SMTP_RATE']),
+            float(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_BURST', 1)))
+    else:
+        _smtp_limiter = _TokenBucket(
+            float(os.environ['GITHUB_COMMIT_EMAILER_SMTP_RATE']),
+            float(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_BURST', 1)))
+
+_smtp_pool = _SMTPPool(
+    os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_HOST', "smtp.mailgun.org"),
+    int(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_PORT', 587)),
+    size=int(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE', 2)),
+    idle_timeout=int(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_IDLE_TIMEOUT',
+                                    60)),
+    debuglevel=int(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_DEBUG', 0)),
+    limiter=_smtp_limiter,
+    max_recipients=int(os.environ.get(
+        'GITHUB_COMMIT_EMAILER_SMTP_MAX_RECIPIENTS', 1000)))
+
+
+class _Outbox(object):
+    """Durable SQLite (WAL mode) outbox for rendered emails.
+
+    Every message is recorded before it is sent and removed once sent, so
+    nothing is lost if the process dies mid-send. Failed sends are retried
+    with jittered exponential backoff by a background thread, which also
+    replays anything left pending by a previous process. Rows are claimed
+    with a lease, so several processes can share one outbox file.
+
+    Removal of sent messages is batched; a crash before a batch is written
+    means those messages are sent again, never that they are dropped.
+    """
+
+    def __init__(self, path, send, max_attempts=8, backoff_base=2.0,
+                 backoff_cap=900.0, lease=60.0, batch_size=32,
+                 poll_interval=1.0):
+        self.path = path
+        self.send = send
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.lease = lease
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._sent = []
+        self._pid = None
+        self._conn = None
+        self._conn_pid = None
+
+    @property
+    def _db(self):
+        """This process's connection to the outbox. It is opened on first
+        use, so that forked processes do not share one."""
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY,
+                    sender TEXT NOT NULL,
+                    recipients TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    failed INTEGER NOT NULL DEFAULT 0
+                )""")
+            self._conn.commit()
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def deliver(self, sender, recipients, message):
+        """Record message in the outbox, then try to send it. If sending
+        fails, the message stays in the outbox to be retried later. Returns
+        whether it was sent."""
+        self._ensure_started()
+        with self._lock:
+            cur = self._db.execute(
+                'INSERT INTO outbox (sender, recipients, message,'
+                ' next_attempt) VALUES (?, ?, ?, ?)',
+                (sender, json.dumps(recipients), message,
+                 time.time() + self.lease))
+            self._db.commit()
+        return self._attempt(cur.lastrowid, sender, recipients, message, 0)
+
+    def retry_due(self):
+        """Send every pending message whose retry time has come. Returns the
+        number of messages attempted."""
+        now = time.time()
+        with self._lock:
+            self._flush_sent()
+            rows = self._db.execute(
+                'SELECT id, sender, recipients, message, attempts'
+                ' FROM outbox WHERE NOT failed AND next_attempt <= ?',
+                (now,)).fetchall()
+            claimed = []
+            for row in rows:
+                cur = self._db.execute(
+                    'UPDATE outbox SET next_attempt = ?'
+                    ' WHERE id = ? AND next_attempt <= ?',
+                    (now + self.lease, row[0], now))
+                if cur.rowcount:
+                    claimed.append(row)
+            self._db.commit()
+        for id_, sender, recipients, message, attempts in claimed:
+            self._attempt(id_, sender, json.loads(recipients), message,
+                          attempts)
+        return len(claimed)
+
+    def pending(self):
+        """Returns number of messages waiting to be sent."""
+        with self._lock:
+            self._flush_sent()
+            return self._db.execute(
+                'SELECT COUNT(*) FROM outbox WHERE NOT failed').fetchone()[0]
+
+    def flush(self):
+        """Write out the batch of sent messages."""
+        with self._lock:
+            self._flush_sent()
+
+    def _attempt(self, id_, sender, recipients, message, attempts):
+        try:
+            self.send(sender, recipients, message)
+        except (smtplib.SMTPException, OSError) as e:
+            if isinstance(e, _SMTPIncomplete):
+                # Only send it again to those it was not sent to.
+                self._update_recipients(id_, e.recipients)
+            attempts += 1
+            if attempts >= self.max_attempts:
+                logging.error('Giving up on email %s after %d attempts: %s',
+                              id_, attempts, e)
+                self._update(id_, attempts, time.time(), failed=1)
+            else:
+                delay = self._backoff(attempts)
+                logging.warn('Could not send email %s, retrying in %.1fs: %s',
+                             id_, delay, e)
+                self._update(id_, attempts, time.time() + delay)
+            return False
+        with self._lock:
+            self._sent.append((id_,))
+            if len(self._sent) >= self.batch_size:
+                self._flush_sent()
+        return True
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** attempts)
+        return random.uniform(delay / 2, delay)
+
+    def _update(self, id_, attempts, next_attempt, failed=0):
+        with self._lock:
+            self._db.execute(
+                'UPDATE outbox SET attempts = ?, next_attempt = ?, failed = ?'
+                ' WHERE id = ?', (attempts, next_attempt, failed, id_))
+            self._db.commit()
+
+    def _update_recipients(self, id_, recipients):
+        with self._lock:
+            self._db.execute('UPDATE outbox SET recipients = ? WHERE id = ?',
+                             (json.dumps(recipients), id_))
+            self._db.commit()
+
+    def _flush_sent(self):
+        if self._sent:
+            self._db.executemany('DELETE FROM outbox WHERE id = ?',
+                                 self._sent)
+            self._db.commit()
+            self._sent = []
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='outbox-retry',
+                             daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                self.retry_due()
+            except Exception:
+                logging.exception('Failed to process outbox.')
+            time.sleep(self.poll_interval)
+
+
+_outbox = None
+if 'GITHUB_COMMIT_EMAILER_OUTBOX' in os.environ:
+    _outbox = _Outbox(os.environ['GITHUB_COMMIT_EMAILER_OUTBOX'],
+                      _smtp_pool.sendmail)
 
 
 def _get_sender(pusher_email):
     """Returns "From" address based on env config and default from."""
-    use_author = 'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in os.environ
-    if use_author:
+    config = _get_config()
+    if config.send_from_author:
         sender = pusher_email
     else:
-        sender = os.environ.get('GITHUB_COMMIT_EMAILER_SENDER')
+        sender = config.sender
     return sender
 
 
-def _get_subject(repo, message):
-    """Returns subject line from repo name and commit message."""
+def _get_subject(repo, message, prefix=None):
+    """Returns subject line from repo name and commit message. prefix
+    defaults to the configured subject prefix."""
     message_lines = message.splitlines()
 
     # For github merge commit messages, the first line is "Merged pull request
@@ -205,23 +2696,85 @@ def _get_subject(repo, message):
     else:
         subject_msg = message_lines[0]
     subject_msg = subject_msg[:50]
-    subject = '[Chapel Merge] {0}'.format(subject_msg)
-    return subject
+    config = _get_config()
+    if prefix is None:
+        prefix = config.subject_prefix
+    subject = config.templates.render('subject.txt', prefix=prefix,
+                                      summary=subject_msg, repo=repo,
+                                      message=message)
+    return _one_line(subject)
 
 
-def _valid_signature(gh_signature, body, secret):
-    """Returns True if GitHub signature is valid. False, otherwise."""
-    def to_str(s):
-        if isinstance(s, str):
-            return bytes(s, encoding='utf-8')
-        else:
-            return s
+def _get_digest_subject(batch, prefix=None):
+    """Returns subject line for a digest of several merges."""
+    config = _get_config()
+    if prefix is None:
+        prefix = config.subject_prefix
+    repos = sorted(set(m['repo'] for m in batch))
+    subject = config.templates.render('digest_subject.txt', prefix=prefix,
+                                      count=len(batch), repos=repos)
+    return _one_line(subject)
+
+
+def _one_line(text):
+    """Returns text with its lines joined, for use in a header."""
+    return ' '.join(text.splitlines())
+
+
+def _read_signed_body(request, config):
+    """Returns request body if it is signed with the configured secret. None,
+    otherwise.
+
+    X-Hub-Signature-256 is preferred over X-Hub-Signature. The HMAC is
+    updated as the body is read, starting from a copy of the keyed HMAC in
+    config. Unsigned requests are rejected without reading the body, and
+    oversized ones with a 413 as soon as they pass config.max_body.
+    """
+    gh_signature, algorithm = _signature_header(request.headers)
+    if gh_signature is None:
+        return None
+
+    if (request.content_length or 0) > config.max_body:
+        flask.abort(413)
+
+    mac = config.secret_macs[algorithm].copy()
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.stream.read(_BODY_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > config.max_body:
+            flask.abort(413)
+        mac.update(chunk)
+        chunks.append(chunk)
+
+    if not _signature_matches(gh_signature, algorithm, mac):
+        return None
+    return b''.join(chunks)
+
+
+def _signature_header(headers):
+    """Returns (signature, algorithm) from the preferred signature header
+    present in headers, or (None, None) if the request is unsigned."""
+    for header, algorithm in _SIGNATURE_HEADERS:
+        gh_signature = headers.get(header)
+        if gh_signature:
+            return gh_signature, algorithm
+    return None, None
+
+
+def _signature_matches(gh_signature, algorithm, mac):
+    """Returns True if gh_signature is the signature mac has computed."""
+    expected_signature = '{0}={1}'.format(algorithm, mac.hexdigest())
+    return hmac.compare_digest(expected_signature.encode('utf-8'),
+                               gh_signature.encode('utf-8'))
 
-    gh_signature = to_str(gh_signature)
-    body = to_str(body)
-    secret = to_str(secret)
 
-    expected_hmac = hmac.new(secret,
-                             body, digestmod="sha1")
-    expected_signature = to_str('sha1=' + expected_hmac.hexdigest())
-    return hmac.compare_digest(expected_signature, gh_signature)
+# Signature headers github sends, most preferred first.
+_SIGNATURE_HEADERS = (
+    ('x-hub-signature-256', 'sha256'),
+    ('x-hub-signature', 'sha1'),
+)
+_BODY_CHUNK_SIZE = 64 * 1024
@@ -0,0 +1,39 @@
+"""Gunicorn settings for the commit emailer. See Procfile."""
+
+import sys
+
+from gunicorn.arbiter import Arbiter
+
+# Import the app, and do its shared startup work, once in the master, so
+# that workers are forked ready to go.
+preload_app = True
+
+
+def when_ready(server):
+    """Load and validate emailer config before starting workers, so a bad
+    config stops gunicorn instead of failing every webhook."""
+    if not server.cfg.preload_app:
+        return
+    import emailer
+    try:
+        emailer.preload()
+    except (OSError, ValueError) as e:
+        server.log.error('Invalid config: %s', e)
+        sys.exit(1)
+
+
+def post_worker_init(worker):
+    """Get each worker ready for its first webhook as it starts: load the
+    config, if the master did not, and open connections."""
+    import emailer
+    try:
+        emailer.warm_up()
+    except (OSError, ValueError):
+        sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+def worker_exit(server, worker):
+    """Deliver the emails already accepted, send pending digests, and report
+    errors still waiting for a batch, before the worker exits."""
+    import emailer
+    emailer.flush_pending()
@@ -0,0 +1,254 @@
+"""Replay recorded github webhook deliveries, to backfill missed emails.
+
+Reads a JSONL file, or stdin with "-", with one recorded delivery per line:
+
+    {"headers": {"X-GitHub-Event": "push", ...}, "body": "{...}"}
+
+where body is the payload exactly as github sent it, so its signature can
+be checked. Each delivery goes through the same checks and message building
+as the webhook: non-push events, bad signatures, non-merges, deleted
+branches and deliveries already handled are skipped. The rest are emailed
+through the pooled SMTP connections (or the outbox, if configured), or, with
+--mbox or --eml-dir, written out for inspection instead of sent. Digest mode
+is not used; each delivery gets its own email.
+
+The app's config vars are used as they are by the webhook. If
+GITHUB_COMMIT_EMAILER_DEDUP_DB is shared with the running app, deliveries
+it already emailed are skipped.
+
+    python replay.py deliveries.jsonl --workers 4
+    python replay.py deliveries.jsonl --mbox backfill.mbox
+
+The file is streamed in batches of --batch-size deliveries, handed to a pool
+of --workers processes with at most two batches per process in flight, so
+files of any size replay in bounded memory. --workers 0 replays in this
+process. Progress is logged every --progress seconds, and a JSON summary
+with throughput is printed at the end.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import mailbox
+import multiprocessing
+import os
+import sys
+import time
+
+import emailer
+
+
+def read_deliveries(lines, batch_size):
+    """Yields lists of up to batch_size (line number, line) pairs from
+    lines, skipping blank lines."""
+    numbered = ((n, line) for n, line in enumerate(lines, 1) if line.strip())
+    while True:
+        batch = list(itertools.islice(numbered, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def replay_batch(batch, dry_run):
+    """Returns list of (line number, outcome, message) for a batch of
+    recorded deliveries. message is the email, as a string, if dry_run is
+    set and one was built, None otherwise."""
+    results = []
+    for lineno, line in batch:
+        try:
+            outcome, message = _replay(line, dry_run)
+        except Exception:
+            logging.exception('Could not replay line %d.', lineno)
+            outcome, message = 'error', None
+        results.append((lineno, outcome, message))
+    if emailer._outbox is not None:
+        emailer._outbox.flush()
+    return results
+
+
+def _replay(line, dry_run):
+    """Returns (outcome, message) for one recorded delivery."""
+    try:
+        record = json.loads(line)
+        headers = dict((k.lower(), v) for k, v in record['headers'].items())
+        body = record['body'].encode('utf-8')
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        logging.error('Invalid delivery record: %r', e)
+        return 'invalid', None
+
+    if headers.get('x-github-event') != 'push':
+        return 'not_push', None
+
+    config = emailer._get_config()
+    gh_signature, algorithm = emailer._signature_header(headers)
+    if gh_signature is None or len(body) > config.max_body:
+        return 'bad_signature', None
+    mac = config.secret_macs[algorithm].copy()
+    mac.update(body)
+    if not emailer._signature_matches(gh_signature, algorithm, mac):
+        return 'bad_signature', None
+
+    try:
+        msg_info, dedup_key = emailer._push_msg_info(
+            headers.get('x-github-delivery'), body, config)
+    except emailer._Skip as e:
+        return e.reason, None
+
+    sent = False
+    try:
+        # Backfills are not in a hurry, so the lookup has no deadline.
+        if msg_info['pr_url'] is None:
+            msg_info['pr_url'] = emailer._get_pr_url(msg_info['repo'],
+                                                     msg_info['sha'])
+        email = emailer._email_for(msg_info)
+        if not dry_run:
+            emailer._send_message(*email)
+            sent = True
+            return 'sent', None
+        return 'written', emailer._build_message(*email)
+    finally:
+        # Leave it to be replayed again, unless it has been sent.
+        if not sent:
+            emailer._dedup.discard(dedup_key)
+
+
+def _init_worker(log_level):
+    logging.basicConfig(level=log_level)
+
+
+class _Writer(object):
+    """Writes dry run emails to an mbox file or a directory of .eml files
+    named by line number."""
+
+    def __init__(self, mbox_path=None, eml_dir=None):
+        self.mbox = None
+        self.eml_dir = eml_dir
+        if mbox_path is not None:
+            self.mbox = mailbox.mbox(mbox_path)
+            self.mbox.lock()
+        if eml_dir is not None:
+            os.makedirs(eml_dir, exist_ok=True)
+
+    def write(self, lineno, message):
+        if self.mbox is not None:
+            self.mbox.add(message)
+        if self.eml_dir is not None:
+            path = os.path.join(self.eml_dir, '{0:08d}.eml'.format(lineno))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(message)
+
+    def close(self):
+        if self.mbox is not None:
+            self.mbox.flush()
+            self.mbox.unlock()
+            self.mbox.close()
+
+
+def replay(lines, workers, batch_size=100, writer=None, progress=10.0,
+           log_level=logging.WARNING):
+    """Replay the recorded deliveries in lines, in workers processes, or in
+    this one if workers is 0. Emails are written with writer if given, sent
+    otherwise. Returns collections.Counter of outcomes."""
+    dry_run = writer is not None
+    outcomes = collections.Counter()
+    start = last_report = time.perf_counter()
+
+    def collect(results):
+        nonlocal last_report
+        for lineno, outcome, message in results:
+            outcomes[outcome] += 1
+            if message is not None:
+                writer.write(lineno, message)
+        now = time.perf_counter()
+        if now - last_report >= progress:
+            last_report = now
+            done = sum(outcomes.values())
+            logging.warning('Replayed %d deliveries, %.1f/s.',
+                            done, done / (now - start))
+
+    batches = read_deliveries(lines, batch_size)
+    if workers == 0:
+        for batch in batches:
+            collect(replay_batch(batch, dry_run))
+        return outcomes
+
+    # Spawned workers load their own config, SMTP pool and databases,
+    # rather than inheriting this process's.
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(log_level,)) as pool:
+        pending = set()
+        for batch in batches:
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+            pending.add(pool.submit(replay_batch, batch, dry_run))
+        for future in concurrent.futures.as_completed(pending):
+            collect(future.result())
+    return outcomes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('deliveries', help='JSONL file of recorded '
+                        'deliveries, or - for stdin')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes to replay with, 0 for this one')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--mbox', help='write emails to this mbox file '
+                        'instead of sending them')
+    parser.add_argument('--eml-dir', help='write emails to .eml files in '
+                        'this directory instead of sending them')
+    parser.add_argument('--progress', type=float, default=10.0,
+                        help='seconds between progress reports')
+    args = parser.parse_args(argv)
+
+    log_level = getattr(logging, os.environ.get(
+        'GITHUB_COMMIT_EMAILER_LOG_LEVEL', 'WARNING').upper())
+    logging.basicConfig(level=log_level)
+    try:
+        emailer.reload_config()
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    writer = None
+    if args.mbox is not None or args.eml_dir is not None:
+        writer = _Writer(args.mbox, args.eml_dir)
+    if args.deliveries == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args.deliveries, encoding='utf-8')
+
+    start = time.perf_counter()
+    try:
+        outcomes = replay(lines, args.workers, args.batch_size, writer,
+                          args.progress, log_level)
+    finally:
+        lines.close()
+        if writer is not None:
+            writer.close()
+    elapsed = time.perf_counter() - start
+
+    deliveries = sum(outcomes.values())
+    emails = outcomes['sent'] + outcomes['written']
+    print(json.dumps({
+        'deliveries': deliveries,
+        'outcomes': dict(outcomes),
+        'emails': emails,
+        'elapsed_s': round(elapsed, 3),
+        'deliveries_per_s': (round(deliveries / elapsed, 1)
+                             if elapsed else 0),
+        'emails_per_s': round(emails / elapsed, 1) if elapsed else 0,
+    }, indent=2, sort_keys=True))
+    return 1 if outcomes['error'] or outcomes['invalid'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
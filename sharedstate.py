@@ -0,0 +1,429 @@
+"""Shared state backends for the commit emailer.
+
+Caches, counters and queues that the emailer's processes share, so that
+scaling out to more gunicorn workers or dynos does not weaken them. Every
+backend implements MemoryState's interface; emailer._open_state() picks one
+from GITHUB_COMMIT_EMAILER_STATE_URL.
+"""
+
+import collections
+import contextlib
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+
+class StateError(Exception):
+    """Raised by a shared state backend that cannot be reached."""
+
+
+class MemoryState(object):
+    """Shared state held in this process, so shared only by its threads.
+
+    This is the reference for the interface every backend implements.
+    Keys and values are strings. Entries expire after ttl seconds, or never
+    if ttl is None; lists of values do not expire. Backends raise
+    StateError if they cannot be reached. At most maxsize entries are kept,
+    evicting the least recently written.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lists = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns value of key, or None."""
+        with self._lock:
+            return self._live(key, time.monotonic())
+
+    def set(self, key, value, ttl=None):
+        """Set key to value."""
+        with self._lock:
+            self._write(key, value, ttl, time.monotonic())
+
+    def add(self, key, value, ttl=None):
+        """Set key to value, unless it is set. Returns False if it was."""
+        with self._lock:
+            now = time.monotonic()
+            if self._live(key, now) is not None:
+                return False
+            self._write(key, value, ttl, now)
+            return True
+
+    def incr(self, key, amount=1, ttl=None):
+        """Add amount to the integer value of key, which starts at 0 and
+        expires after ttl. Returns the new value."""
+        with self._lock:
+            now = time.monotonic()
+            value = self._live(key, now)
+            if value is None:
+                value = amount
+                self._write(key, str(value), ttl, now)
+            else:
+                value = int(value) + amount
+                self._data[key] = (str(value), self._data[key][1])
+            return value
+
+    def delete(self, key):
+        """Remove key."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def push(self, key, value):
+        """Append value to the list key. Returns the list's length."""
+        with self._lock:
+            self._lists[key].append(value)
+            return len(self._lists[key])
+
+    def pop(self, key):
+        """Remove and return the first value of the list key, or None."""
+        with self._lock:
+            values = self._lists.get(key)
+            if not values:
+                return None
+            value = values.popleft()
+            if not values:
+                del self._lists[key]
+            return value
+
+    def length(self, key):
+        """Returns length of the list key."""
+        with self._lock:
+            return len(self._lists.get(key, ()))
+
+    def clear(self, prefix=''):
+        """Remove keys and lists starting with prefix."""
+        with self._lock:
+            for d in (self._data, self._lists):
+                for key in [k for k in d if k.startswith(prefix)]:
+                    del d[key]
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= now:
+            del self._data[key]
+            return None
+        return value
+
+    def _write(self, key, value, ttl, now):
+        self._data[key] = (value, None if ttl is None else now + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class SQLiteState(object):
+    """Shared state in a SQLite database (WAL mode), shared by the
+    processes on one host that open the same path. Same interface as
+    MemoryState.
+
+    Each process opens its own connection on first use. Expired entries
+    are deleted every 100 writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._writes = 0
+
+    @property
+    def _db(self):
+        if self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                               'key TEXT PRIMARY KEY, value TEXT NOT NULL,'
+                               ' expires REAL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS lists ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                               ' key TEXT NOT NULL, value TEXT NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS lists_key'
+                               ' ON lists (key, id)')
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._transaction(write=False) as db:
+            row = db.execute(
+                'SELECT value FROM state WHERE key = ? AND'
+                ' (expires IS NULL OR expires > ?)',
+                (key, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key, value, ttl=None):
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                       (key, value, _expires(ttl)))
+
+    def add(self, key, value, ttl=None):
+        with self._transaction() as db:
+            db.execute('DELETE FROM state WHERE key = ? AND expires <= ?',
+                       (key, time.time()))
+            cur = db.execute('INSERT OR IGNORE INTO state VALUES (?, ?, ?)',
+                             (key, value, _expires(ttl)))
+        return bool(cur.rowcount)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT value, expires FROM state WHERE key = ? AND'
+                ' (expires IS NULL OR expires > ?)',
+                (key, time.time())).fetchone()
+            if row is None:
+                value, expires = amount, _expires(ttl)
+            else:
+                value, expires = int(row[0]) + amount, row[1]
+            db.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                       (key, str(value), expires))
+        return value
+
+    def delete(self, key):
+        with self._transaction() as db:
+            db.execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def push(self, key, value):
+        with self._transaction() as db:
+            db.execute('INSERT INTO lists (key, value) VALUES (?, ?)',
+                       (key, value))
+            return db.execute('SELECT COUNT(*) FROM lists WHERE key = ?',
+                              (key,)).fetchone()[0]
+
+    def pop(self, key):
+        with self._transaction() as db:
+            row = db.execute('SELECT id, value FROM lists WHERE key = ?'
+                             ' ORDER BY id LIMIT 1', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute('DELETE FROM lists WHERE id = ?', (row[0],))
+        return row[1]
+
+    def length(self, key):
+        with self._transaction(write=False) as db:
+            return db.execute('SELECT COUNT(*) FROM lists WHERE key = ?',
+                              (key,)).fetchone()[0]
+
+    def clear(self, prefix=''):
+        with self._transaction() as db:
+            for table in ('state', 'lists'):
+                db.execute('DELETE FROM {0} WHERE substr(key, 1, ?) = ?'
+                           .format(table), (len(prefix), prefix))
+
+    @contextlib.contextmanager
+    def _transaction(self, write=True):
+        """Yields the connection in a transaction, taking the database's
+        write lock up front if write is set. sqlite3 errors are raised as
+        StateError."""
+        with self._lock:
+            try:
+                db = self._db
+                db.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+                try:
+                    yield db
+                    if write:
+                        self._writes += 1
+                        if self._writes % 100 == 0:
+                            db.execute('DELETE FROM state WHERE'
+                                       ' expires <= ?', (time.time(),))
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+            except sqlite3.Error as e:
+                raise StateError(e)
+
+
+def _expires(ttl):
+    """Returns time.time() value ttl seconds from now, or None."""
+    return None if ttl is None else time.time() + ttl
+
+
+class RedisState(object):
+    """Shared state in a Redis compatible server, shared by every process
+    and host that uses it. Same interface as MemoryState.
+
+    Keys are prefixed with prefix. Commands are sent over a pool of at most
+    pool_size idle connections, which is emptied after a fork. Connection
+    and command errors are raised as StateError.
+    """
+
+    def __init__(self, host, port=6379, db=0, password=None,
+                 prefix='commit_emailer:', ssl_context=None, timeout=5.0,
+                 pool_size=4):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def get(self, key):
+        return self._call(('GET', self.prefix + key))
+
+    def set(self, key, value, ttl=None):
+        self._call(('SET', self.prefix + key, value) + _px(ttl))
+
+    def add(self, key, value, ttl=None):
+        return self._call(
+            ('SET', self.prefix + key, value, 'NX') + _px(ttl)) is not None
+
+    def incr(self, key, amount=1, ttl=None):
+        key = self.prefix + key
+        # INCRBY keeps the expiry set when the key is created.
+        return self._call(('SET', key, 0, 'NX') + _px(ttl),
+                          ('INCRBY', key, amount))
+
+    def delete(self, key):
+        self._call(('DEL', self.prefix + key))
+
+    def push(self, key, value):
+        return self._call(('RPUSH', self.prefix + key, value))
+
+    def pop(self, key):
+        return self._call(('LPOP', self.prefix + key))
+
+    def length(self, key):
+        return self._call(('LLEN', self.prefix + key))
+
+    def clear(self, prefix=''):
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.prefix + prefix)
+        keys = self._call(('KEYS', pattern + '*'))
+        if keys:
+            self._call(('DEL',) + tuple(keys))
+
+    def _call(self, *commands):
+        """Sends commands in one write, and returns the reply to the last.
+        """
+        conn = self._checkout()
+        try:
+            conn.sendall(b''.join(_redis_command(c) for c in commands))
+            replies = [_redis_reply(conn.rfile) for _ in commands]
+        except (OSError, ValueError) as e:
+            conn.close()
+            raise StateError(e)
+        self._checkin(conn)
+        for reply in replies:
+            if isinstance(reply, _RedisReplyError):
+                raise StateError(reply)
+        return replies[-1]
+
+    def _checkout(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections opened before a fork belong to the parent.
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except (OSError, ValueError) as e:
+            raise StateError(e)
+
+    def _checkin(self, conn):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock,
+                                                server_hostname=self.host)
+        conn = _RedisConnection(sock)
+        setup = []
+        if self.password is not None:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            conn.sendall(b''.join(_redis_command(c) for c in setup))
+            for _ in setup:
+                reply = _redis_reply(conn.rfile)
+                if isinstance(reply, _RedisReplyError):
+                    conn.close()
+                    raise ValueError(str(reply))
+        return conn
+
+
+class _RedisConnection(object):
+    """A socket to a Redis server, with a buffered reader for replies."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class _RedisReplyError(str):
+    """An error reply from a Redis server."""
+
+
+def _px(ttl):
+    """Returns SET arguments that expire a key after ttl seconds."""
+    if ttl is None:
+        return ()
+    return ('PX', max(1, int(ttl * 1000)))
+
+
+def _redis_command(args):
+    """Returns args encoded as a RESP array of bulk strings."""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def _redis_reply(rfile):
+    """Returns the next RESP reply read from rfile: str, int, list, None,
+    or _RedisReplyError. Raises ConnectionError if the connection closed.
+    """
+    line = rfile.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('Redis connection closed')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        return _RedisReplyError(rest.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        if int(rest) < 0:
+            return None
+        data = rfile.read(int(rest) + 2)
+        if len(data) != int(rest) + 2:
+            raise ConnectionError('Redis connection closed')
+        return data[:-2].decode('utf-8')
+    if kind == b'*':
+        if int(rest) < 0:
+            return None
+        return [_redis_reply(rfile) for _ in range(int(rest))]
+    raise ValueError('Bad Redis reply: {0!r}'.format(line))
@@ -0,0 +1,434 @@
+"""Local stand-ins for the services the emailer talks to, for the unittests
+and bench.py. Each server listens on an ephemeral port on 127.0.0.1 and runs
+in a daemon thread until stop() is called.
+"""
+
+import collections
+import http.server
+import json
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server that records the messages it receives.
+
+    latency is slept before answering each message's DATA. error_rate is the
+    fraction of MAIL commands answered with a transient error. Set fail_next
+    to answer that many MAIL commands with a transient error. Recipients in
+    refuse are refused, as are those past max_recipients in a message.
+    PIPELINING is advertised if pipelining is set.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0.0, error_rate=0.0, pipelining=True):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), _StubSMTPHandler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pipelining = pipelining
+        self.refuse = set()
+        self.max_recipients = None
+        self.messages = []
+        self.fail_next = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        _ignore_disconnects(request, client_address)
+
+    def _should_fail(self):
+        with self._lock:
+            if self.fail_next:
+                self.fail_next -= 1
+                return True
+        return random.random() < self.error_rate
+
+
+class _StubSMTPHandler(socketserver.StreamRequestHandler):
+
+    # Replies to pipelined commands are written one at a time, so don't let
+    # Nagle's algorithm hold them back waiting for the client's ACK.
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server._lock:
+            server.connections += 1
+        sender, recipients = None, []
+        self.reply('220 stub ESMTP')
+        for raw in self.rfile:
+            cmd = raw.decode('utf-8').rstrip('\r\n')
+            verb = cmd.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.reply('250-stub')
+                if server.pipelining:
+                    self.reply('250-PIPELINING')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'AUTH':
+                self.reply('235 ok')
+            elif verb == 'MAIL':
+                if server._should_fail():
+                    self.reply('451 try again later')
+                    continue
+                sender, recipients = cmd[10:].strip('<>'), []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                recipient = cmd[8:].strip('<>')
+                if recipient in server.refuse:
+                    self.reply('550 no such user')
+                elif (server.max_recipients is not None and
+                      len(recipients) >= server.max_recipients):
+                    self.reply('452 too many recipients')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    if line.startswith(b'.'):
+                        line = line[1:]
+                    data.append(line)
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    server.messages.append(
+                        (sender, recipients, b''.join(data).decode('utf-8')))
+                self.reply('250 queued')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class StubGitHubServer(http.server.ThreadingHTTPServer):
+    """Answers github's GET /repos/{repo}/commits/{sha}/pulls with a single
+    PR. latency is slept before each answer, and error_rate is the fraction
+    of requests answered with a 500. requests counts the requests served,
+    and authorization is the last Authorization header received. Like
+    github's, GET /rate_limit is answered without counting as a request.
+
+    If rate_limit is set, answers carry github's X-RateLimit headers, with
+    the limit resetting reset_after seconds after the server starts, and
+    requests past the limit are answered with a 403.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=None,
+                 reset_after=3600):
+        http.server.ThreadingHTTPServer.__init__(
+            self, ('127.0.0.1', 0), _StubGitHubHandler)
+        self.port = self.server_address[1]
+        self.url = 'http://127.0.0.1:{0}'.format(self.port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.reset_at = int(time.time() + reset_after)
+        self.requests = 0
+        self.authorization = None
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        _ignore_disconnects(request, client_address)
+
+
+class _StubGitHubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    _PULLS_RE = re.compile(r'^/repos/([^/]+/[^/]+)/commits/([^/]+)/pulls$')
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/rate_limit':
+            self.send_json(200, {'resources': {}})
+            return
+        server.requests += 1
+        server.authorization = self.headers.get('Authorization')
+        if server.latency:
+            time.sleep(server.latency)
+        match = self._PULLS_RE.match(self.path)
+        if match is None:
+            self.send_json(404, {'message': 'Not Found'})
+        elif (server.rate_limit is not None and
+              server.requests > server.rate_limit):
+            self.send_json(403, {'message': 'API rate limit exceeded'})
+        elif random.random() < server.error_rate:
+            self.send_json(500, {'message': 'Server Error'})
+        else:
+            self.send_json(200, [{'html_url': 'https://github.com/{0}/pull/1'
+                                  .format(match.group(1))}])
+
+    def send_json(self, status, obj):
+        server = self.server
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if server.rate_limit is not None:
+            remaining = max(0, server.rate_limit - server.requests)
+            self.send_header('X-RateLimit-Limit', str(server.rate_limit))
+            self.send_header('X-RateLimit-Remaining', str(remaining))
+            self.send_header('X-RateLimit-Reset', str(server.reset_at))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubRollbarServer(http.server.ThreadingHTTPServer):
+    """Collects the items POSTed to rollbar's /api/1/item/ in items, as
+    decoded JSON. Point rollbar's endpoint setting at endpoint. latency is
+    slept before each answer, and error_rate is the fraction of items
+    answered with a 502, which rollbar drops.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        http.server.ThreadingHTTPServer.__init__(
+            self, ('127.0.0.1', 0), _StubRollbarHandler)
+        self.port = self.server_address[1]
+        self.endpoint = 'http://127.0.0.1:{0}/api/1/'.format(self.port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.items = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        _ignore_disconnects(request, client_address)
+
+
+class _StubRollbarHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        item = json.loads(self.rfile.read(length))
+        if server.latency:
+            time.sleep(server.latency)
+        if self.path != '/api/1/item/':
+            self.send_json(404, {'err': 1, 'message': 'Not Found'})
+        elif random.random() < server.error_rate:
+            self.send_json(502, {'err': 1, 'message': 'Bad Gateway'})
+        else:
+            server.items.append(item)
+            self.send_json(200, {'err': 0, 'result': {
+                'uuid': item['data'].get('uuid')}})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubRedisServer(socketserver.ThreadingTCPServer):
+    """Redis stand-in that speaks RESP and implements the commands the
+    emailer's shared state uses: AUTH, SELECT, PING, GET, SET (with NX, EX
+    and PX), DEL, INCRBY, RPUSH, LPOP, LLEN and KEYS. If password is set,
+    commands other than AUTH are refused until it is given. connections
+    counts connections accepted, and commands the commands received. Set
+    fail_next to close that many connections on their next command.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, password=None):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), _StubRedisHandler)
+        self.port = self.server_address[1]
+        self.url = 'redis://127.0.0.1:{0}'.format(self.port)
+        self.password = password
+        self.connections = 0
+        self.commands = 0
+        self.fail_next = 0
+        self.values = {}
+        self.lists = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        _ignore_disconnects(request, client_address)
+
+    def live(self, key):
+        """Returns value of key, or None if missing or expired. Call with
+        _lock held."""
+        item = self.values.get(key)
+        if item is not None and item[1] is not None and \
+                item[1] <= time.monotonic():
+            del self.values[key]
+            item = None
+        return None if item is None else item[0]
+
+
+class _StubRedisHandler(socketserver.StreamRequestHandler):
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        server = self.server
+        with server._lock:
+            server.connections += 1
+        authenticated = server.password is None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            with server._lock:
+                server.commands += 1
+                if server.fail_next:
+                    server.fail_next -= 1
+                    return
+                name = args[0].upper()
+                if name == b'AUTH':
+                    authenticated = args[-1].decode() == server.password
+                    reply = b'+OK' if authenticated else \
+                        b'-WRONGPASS invalid password'
+                elif not authenticated:
+                    reply = b'-NOAUTH Authentication required.'
+                else:
+                    reply = self.execute(name, args[1:])
+            self.wfile.write(reply + b'\r\n')
+
+    def read_command(self):
+        """Returns list of the next command's arguments, as bytes, or None
+        if the client hung up."""
+        line = self.rfile.readline()
+        if not line.startswith(b'*'):
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def execute(self, name, args):
+        """Returns RESP reply to command name with args. Call with the
+        server's _lock held."""
+        server = self.server
+        if name in (b'PING', b'SELECT'):
+            return b'+PONG' if name == b'PING' else b'+OK'
+        if name == b'GET':
+            return _bulk(server.live(args[0]))
+        if name == b'SET':
+            key, value = args[0], args[1]
+            options = [a.upper() for a in args[2:]]
+            if b'NX' in options and server.live(key) is not None:
+                return b'$-1'
+            expires = None
+            for unit, scale in ((b'EX', 1.0), (b'PX', 0.001)):
+                if unit in options:
+                    ttl = float(args[2 + options.index(unit) + 1]) * scale
+                    expires = time.monotonic() + ttl
+            server.values[key] = (value, expires)
+            return b'+OK'
+        if name == b'DEL':
+            deleted = 0
+            for key in args:
+                deleted += server.values.pop(key, None) is not None
+                deleted += server.lists.pop(key, None) is not None
+            return b':%d' % deleted
+        if name == b'INCRBY':
+            value = server.live(args[0])
+            try:
+                value = int(value or 0) + int(args[1])
+            except ValueError:
+                return b'-ERR value is not an integer or out of range'
+            expires = server.values.get(args[0], (None, None))[1]
+            server.values[args[0]] = (b'%d' % value, expires)
+            return b':%d' % value
+        if name == b'RPUSH':
+            server.lists[args[0]].extend(args[1:])
+            return b':%d' % len(server.lists[args[0]])
+        if name == b'LPOP':
+            values = server.lists.get(args[0])
+            if not values:
+                return b'$-1'
+            value = values.popleft()
+            if not values:
+                del server.lists[args[0]]
+            return _bulk(value)
+        if name == b'LLEN':
+            return b':%d' % len(server.lists.get(args[0], ()))
+        if name == b'KEYS':
+            pattern = _glob_re(args[0].decode('utf-8'))
+            keys = [k for k in list(server.values) + list(server.lists)
+                    if pattern.match(k.decode('utf-8')) and
+                    (k in server.lists or server.live(k) is not None)]
+            return b'\r\n'.join([b'*%d' % len(keys)] +
+                                [_bulk(k) for k in keys])
+        return b'-ERR unknown command'
+
+
+def _bulk(value):
+    """Returns RESP bulk string reply for bytes value, or None."""
+    if value is None:
+        return b'$-1'
+    return b'$%d\r\n%s' % (len(value), value)
+
+
+def _glob_re(pattern):
+    """Returns compiled regex for a Redis KEYS pattern, supporting *, ?
+    and backslash escapes."""
+    parts, chars = [], iter(pattern)
+    for c in chars:
+        if c == '\\':
+            parts.append(re.escape(next(chars, '\\')))
+        elif c == '*':
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(c))
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+
+def _ignore_disconnects(request, client_address):
+    """Server error handler that stays quiet when a client hangs up."""
+    exc = sys.exc_info()[1]
+    if not isinstance(exc, (ConnectionError, EOFError)):
+        socketserver.BaseServer.handle_error(None, request, client_address)
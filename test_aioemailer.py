@@ -0,0 +1,340 @@
+import asyncio
+import functools
+import hmac
+import json
+import os
+import smtplib
+import threading
+import time
+import unittest
+import mock
+import requests
+
+import aioemailer
+import emailer
+import sharedstate
+import stubs
+
+
+@mock.patch('logging.error', new=mock.Mock())
+@mock.patch('logging.warn', new=mock.Mock())
+@mock.patch('logging.info', new=mock.Mock())
+class AsyncEmailerTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        """Start the async server, with stub SMTP and github servers."""
+        os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = 'sekret'
+        os.environ['GITHUB_COMMIT_EMAILER_SENDER'] = 'noreply@fake.fake'
+        os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT'] = 'list@fake.fake'
+        os.environ.pop('GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR', None)
+        os.environ.pop('GITHUB_COMMIT_EMAILER_RECIPIENT_CC', None)
+        emailer.reload_config()
+        emailer._pr_url_cache.clear()
+        emailer._dedup.clear()
+
+        self.smtp = stubs.StubSMTPServer()
+        self.addCleanup(self.smtp.stop)
+        self.github = stubs.StubGitHubServer()
+        self.addCleanup(self.github.stop)
+        self.pool = aioemailer._AsyncSMTPPool('127.0.0.1', self.smtp.port)
+        for name, value in [('aioemailer._smtp_pool', self.pool),
+                            ('emailer._GITHUB_API', self.github.url),
+                            ('emailer._github_limiter',
+                             emailer._GitHubLimiter(60)),
+                            ('emailer._github_breaker',
+                             emailer._CircuitBreaker(5, 30))]:
+            patcher = mock.patch(name, new=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.server = await aioemailer.start_server('127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:{0}'.format(port)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.pool.close()
+
+    async def request(self, method, path, **kwargs):
+        """Returns response to a request made from a thread."""
+        kwargs.setdefault('allow_redirects', False)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            requests.request, method, self.url + path, **kwargs))
+
+    async def post_push(self, message, event='push', secret=b'sekret'):
+        """POST a signed push event for a merge with message."""
+        body = json.dumps({
+            'ref': 'the/master',
+            'deleted': False,
+            'compare': 'http://the-url.it',
+            'repository': {'full_name': 'testing/test'},
+            'pusher': {'name': 'the-tester', 'email': 'the@example.com'},
+            'after': 'some-sha',
+            'head_commit': {
+                'id': 'some-sha1',
+                'message': message,
+                'added': ['a.chpl'], 'removed': [], 'modified': ['.b'],
+            },
+        }).encode('utf-8')
+        h = hmac.new(secret, body, digestmod='sha256')
+        headers = {'x-github-event': event,
+                   'content-type': 'application/json',
+                   'x-hub-signature-256': 'sha256=' + h.hexdigest()}
+        return await self.request('POST', '/commit-email', headers=headers,
+                                  data=body)
+
+    async def wait_for_tasks(self):
+        if aioemailer._tasks:
+            await asyncio.wait(aioemailer._tasks, timeout=5)
+
+    async def test_commit_email__background(self):
+        """Verify a merge is answered with 202 and emailed, with the PR url
+        from github."""
+        r = await self.post_push('Merge pull request from a/b\n\nThe TEST.')
+        self.assertEqual(202, r.status_code)
+        await self.wait_for_tasks()
+
+        self.assertEqual(1, len(self.smtp.messages))
+        sender, recipients, data = self.smtp.messages[0]
+        self.assertEqual('noreply@fake.fake', sender)
+        self.assertEqual(['list@fake.fake'], recipients)
+        self.assertIn('Subject: [Chapel Merge] The TEST.', data)
+        self.assertEqual(1, self.github.requests)
+
+    async def test_commit_email__logged(self):
+        """Verify the webhook's record is logged by its delivery task."""
+        with self.assertLogs('emailer.webhooks') as logs:
+            await self.post_push('Merge pull request from a/b')
+            await self.wait_for_tasks()
+        record, = logs.records
+        self.assertEqual(('testing/test', 'sent'),
+                         (record.fields['repo'], record.fields['decision']))
+        self.assertIn('pr_lookup', record.fields['stages_ms'])
+
+    async def test_commit_email__logged_retrying(self):
+        """Verify an email the outbox kept to retry is not logged as
+        sent."""
+        outbox = mock.Mock()
+        outbox.deliver.return_value = False
+        with mock.patch('emailer._outbox', new=outbox), \
+                self.assertLogs('emailer.webhooks') as logs:
+            await self.post_push('Merge pull request from a/b')
+            await self.wait_for_tasks()
+        record, = logs.records
+        self.assertEqual('retrying', record.fields['decision'])
+        self.assertEqual(1, outbox.deliver.call_count)
+
+    async def test_commit_email__outbox_context(self):
+        """Verify emails sent through the outbox are sent in the webhook's
+        context, so they are timed and logged with it."""
+        logs = []
+
+        def deliver(*args):
+            logs.append(emailer._webhook_log.get())
+            return True
+        outbox = mock.Mock()
+        outbox.deliver.side_effect = deliver
+        with mock.patch('emailer._outbox', new=outbox):
+            await self.post_push('Merge pull request from a/b')
+            await self.wait_for_tasks()
+        log, = logs
+        self.assertIsNotNone(log)
+        self.assertEqual('testing/test', log.fields['repo'])
+
+    async def test_commit_email__inline(self):
+        """Verify the email is sent before responding with no workers."""
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            r = await self.post_push('Merge pull request #7 from a/b')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('yep', r.text)
+        self.assertEqual(1, len(self.smtp.messages))
+        self.assertEqual(0, self.github.requests)
+
+    async def test_commit_email__shared_state(self):
+        """Verify shared state is used from the thread pool, not the event
+        loop's thread."""
+        state = sharedstate.MemoryState()
+        threads = set()
+        for name in ['get', 'set', 'add', 'incr']:
+            def record(*args, _method=getattr(state, name), **kwargs):
+                threads.add(threading.current_thread())
+                return _method(*args, **kwargs)
+            setattr(state, name, record)
+        with mock.patch('emailer._dedup',
+                        new=emailer._DedupIndex(10, state=state)), \
+                mock.patch('emailer._pr_url_cache',
+                           new=emailer._TTLCache(10, 60, state=state)), \
+                mock.patch('emailer._github_limiter',
+                           new=emailer._GitHubLimiter(60, state=state)):
+            r = await self.post_push('Merge pull request from a/b')
+            await self.wait_for_tasks()
+        self.assertEqual(202, r.status_code)
+        self.assertEqual(1, len(self.smtp.messages))
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    async def test_commit_email__skipped(self):
+        """Verify non-push events, bad signatures, non-merges and duplicate
+        deliveries are not emailed."""
+        responses = [
+            await self.post_push('Merge pull request #1', event='issues'),
+            await self.post_push('Merge pull request #1', secret=b'bad'),
+            await self.post_push('Fix a typo'),
+            await self.post_push('Merge pull request #1'),
+            await self.post_push('Merge pull request #1'),
+        ]
+        await self.wait_for_tasks()
+        self.assertEqual(['nope', 'nope', 'nope', 'yep', 'nope'],
+                         [r.text for r in responses])
+        self.assertEqual(1, len(self.smtp.messages))
+
+    async def test_commit_email__busy(self):
+        """Verify the webhook is answered with 503 when too many emails are
+        in flight, and github's retry is let through."""
+        with mock.patch.object(emailer._delivery_queue, 'maxsize', 0):
+            r = await self.post_push('Merge pull request #1')
+        self.assertEqual(503, r.status_code)
+        r = await self.post_push('Merge pull request #1')
+        self.assertEqual(202, r.status_code)
+
+    async def test_routes(self):
+        """Verify index redirect, metrics, and unknown routes."""
+        r = await self.request('GET', '/')
+        self.assertEqual(301, r.status_code)
+        self.assertEqual('http://chapel-lang.org/', r.headers['location'])
+        r = await self.request('GET', '/metrics')
+        self.assertIn('commit_emailer_deliveries_in_flight 0', r.text)
+        r = await self.request('GET', '/nope')
+        self.assertEqual(404, r.status_code)
+        r = await self.request('GET', '/commit-email')
+        self.assertEqual(405, r.status_code)
+
+    async def test_get_pr_url__unavailable(self):
+        """Verify github errors give "Unavailable", which is not cached."""
+        self.github.error_rate = 1
+        self.assertEqual('Unavailable',
+                         await aioemailer._get_pr_url('a/b', 'sha'))
+        self.github.error_rate = 0
+        self.assertEqual('https://github.com/a/b/pull/1',
+                         await aioemailer._get_pr_url('a/b', 'sha'))
+        await aioemailer._get_pr_url('a/b', 'sha')
+        self.assertEqual(2, self.github.requests)
+
+    async def test_get_pr_url__rate_limited(self):
+        """Verify lookups stop once github says the budget is spent."""
+        self.github.rate_limit = 1
+        urls = [await aioemailer._get_pr_url('a/b', sha) for sha in 'xy']
+        self.assertEqual(['https://github.com/a/b/pull/1', 'Unavailable'],
+                         urls)
+        self.assertEqual(1, self.github.requests)
+
+    async def test_get_pr_url__circuit_open(self):
+        """Verify github is not asked while it keeps failing, and slow
+        answers are cut off at the deadline."""
+        self.github.error_rate = 1
+        for _ in range(7):
+            self.assertEqual('Unavailable',
+                             await aioemailer._get_pr_url('a/b', 'sha'))
+        self.assertEqual(5, self.github.requests)
+
+        emailer._github_breaker.record(True)
+        self.github.error_rate = 0
+        self.github.latency = 2
+        start = time.monotonic()
+        self.assertEqual('Unavailable', await aioemailer._get_pr_url(
+            'a/b', 'sha', start + 1))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    async def test_smtp_pool__reuses_connection(self):
+        """Verify emails are sent over one logged in connection."""
+        for _ in range(2):
+            await self.pool.sendmail('from@fake.fake', ['to@fake.fake'],
+                                     'Subject: hi\n\n.dot\n')
+        self.assertEqual(1, self.smtp.connections)
+        self.assertEqual('Subject: hi\r\n\r\n.dot\r\n',
+                         self.smtp.messages[1][2])
+
+    async def test_smtp_pool__fan_out(self):
+        """Verify long recipient lists are pipelined in chunks, and
+        recipients refused for now retried."""
+        self.smtp.max_recipients = 2
+        self.smtp.refuse.add('bad@fake.fake')
+        self.pool.max_recipients = 3
+        recipients = ['a@fake.fake', 'bad@fake.fake', 'b@fake.fake',
+                      'c@fake.fake', 'd@fake.fake']
+        refused = await self.pool.sendmail('from@fake.fake', recipients,
+                                           'Subject: hi\n')
+        self.assertEqual({'bad@fake.fake': (550, b'no such user')}, refused)
+        sent = sorted(r for _, rs, _ in self.smtp.messages for r in rs)
+        self.assertEqual(['a@fake.fake', 'b@fake.fake', 'c@fake.fake',
+                          'd@fake.fake'], sent)
+
+    async def test_smtp_pool__server_limit(self):
+        """Verify recipients over the server's per message limit are retried
+        in chunks it accepts."""
+        self.smtp.max_recipients = 3
+        self.pool.max_recipients = 10
+        recipients = ['u{0}@fake.fake'.format(i) for i in range(10)]
+        refused = await self.pool.sendmail('from@fake.fake', recipients,
+                                           'Subject: hi\n')
+        self.assertEqual({}, refused)
+        self.assertEqual(recipients,
+                         sorted(r for _, rs, _ in self.smtp.messages
+                                for r in rs))
+
+    async def test_smtp_pool__display_names(self):
+        """Verify addresses with display names are sent bare, like
+        smtplib."""
+        await self.pool.sendmail('Some One <one@fake.fake>',
+                                 ['Other <to@fake.fake>'], 'Subject: hi\n')
+        sender, recipients, _ = self.smtp.messages[0]
+        self.assertEqual('one@fake.fake', sender)
+        self.assertEqual(['to@fake.fake'], recipients)
+
+    async def test_smtp_pool__refused(self):
+        """Verify a refused sender raises like smtplib."""
+        self.smtp.fail_next = 1
+        with self.assertRaises(smtplib.SMTPSenderRefused):
+            await self.pool.sendmail('from@fake.fake', ['to@fake.fake'],
+                                     'Subject: hi\n')
+
+    def test_smtp_data(self):
+        """Verify DATA uses CRLF, is dot stuffed and terminated."""
+        self.assertEqual(b'a\r\n..b\r\nc\r\n.\r\n',
+                         aioemailer._smtp_data('a\n.b\r\nc'))
+
+
+class MainTests(unittest.TestCase):
+
+    @mock.patch('logging.error')
+    def test_main__missing_config_file(self, mock_error):
+        """Verify a config file that cannot be read fails startup cleanly."""
+        with mock.patch.dict(os.environ,
+                             GITHUB_COMMIT_EMAILER_CONFIG='/no/such.env'):
+            self.assertEqual(1, aioemailer.main(['--port', '0']))
+        self.assertEqual('Invalid config: %s', mock_error.call_args[0][0])
+
+
+class AsyncSMTPPoolTests(unittest.TestCase):
+
+    def test_event_loops(self):
+        """Verify a pool created outside an event loop can be used from
+        one, and then from another."""
+        smtp = stubs.StubSMTPServer()
+        self.addCleanup(smtp.stop)
+        pool = aioemailer._AsyncSMTPPool('127.0.0.1', smtp.port)
+
+        async def send():
+            await pool.sendmail('from@fake.fake', ['to@fake.fake'],
+                                'Subject: hi\n')
+            await pool.close()
+
+        for _ in range(2):
+            asyncio.run(send())
+        self.assertEqual(2, len(smtp.messages))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import hmac
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import bench
+import emailer
+
+
+class BenchTests(unittest.TestCase):
+
+    def test_percentile(self):
+        """Verify nearest-rank percentiles."""
+        values = list(range(1, 101))
+        self.assertEqual(50, bench.percentile(values, 50))
+        self.assertEqual(99, bench.percentile(values, 99))
+        self.assertEqual(1, bench.percentile([1], 95))
+        self.assertEqual(0.0, bench.percentile([], 50))
+
+    def test_make_corpus(self):
+        """Verify corpus payloads are signed and sized as asked."""
+        corpus = bench.make_corpus(4, [3, 30], 0.5)
+        self.assertEqual(4, len(corpus))
+        for i, (headers, body) in enumerate(corpus):
+            mac = hmac.new(bench.SECRET.encode('utf-8'), body,
+                           digestmod='sha256')
+            self.assertTrue(emailer._signature_matches(
+                headers['X-Hub-Signature-256'], 'sha256', mac))
+            head_commit = json.loads(body)['head_commit']
+            files = sum(len(head_commit[k])
+                        for k in ('added', 'removed', 'modified'))
+            self.assertEqual([3, 30][i % 2], files)
+        messages = [json.loads(b)['head_commit']['message'] for _, b in corpus]
+        self.assertEqual(2, sum('#' not in m for m in messages))
+
+    def test_startup_report(self):
+        """Verify startup timings are summarized as median milliseconds."""
+        timings = [{'first_response_s': s, 'warm_response_s': s / 10}
+                   for s in (0.3, 0.1, 0.2)]
+        self.assertEqual({'import_ms': 250.0, 'runs': 3,
+                          'first_response_ms': 200.0,
+                          'warm_response_ms': 20.0},
+                         bench.startup_report(0.25, timings))
+
+    def test_client_mode(self):
+        """Verify a small client mode run delivers every email."""
+        here = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.check_output(
+            [sys.executable, 'bench.py', '--requests', '10', '--files', '3'],
+            cwd=here, stderr=subprocess.DEVNULL)
+        summary = json.loads(out)
+        self.assertEqual(10, summary['requests'])
+        self.assertEqual(10, summary['emails'])
+        self.assertEqual(1, summary['github_requests'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,28 @@
 from __future__ import unicode_literals
 
+import copy
 import hmac
+import io
 import json
+import logging
 import os
+import shutil
+import signal
+import smtplib
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 import mock
+import requests
+import rollbar
+import werkzeug.exceptions
 
 import emailer
+import sharedstate
+import stubs
 
 
 @mock.patch('logging.error', new=mock.Mock())
@@ -19,6 +34,9 @@ class EmailerTests(unittest.TestCase):
         """Setup flask app for testing."""
         super(EmailerTests, self).setUp()
         emailer.app.config['TESTING'] = True
+        emailer._smtp_pool.clear()
+        emailer._pr_url_cache.clear()
+        emailer._dedup.clear()
         self.app = emailer.app.test_client()
         self.headers = {
             'x-github-event': 'push',
@@ -46,6 +64,20 @@ class EmailerTests(unittest.TestCase):
         self.reply_to = 'reply-to-me@fake.fake'
         self.send_grid_header = json.dumps(
             {'filters': {'clicktrack': {'settings': {'enable': 0}}}})
+        self.prep_env()
+        # Never ask the real github for PR urls.
+        patcher = mock.patch('emailer._github_session.get',
+                             side_effect=IOError)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('emailer._github_limiter',
+                             new=emailer._GitHubLimiter(60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('emailer._github_breaker',
+                             new=emailer._CircuitBreaker(5, 30))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @mock.patch('flask.got_request_exception.connect')
     @mock.patch('rollbar.init')
@@ -67,7 +99,8 @@ class EmailerTests(unittest.TestCase):
             'fakefakefake',
             'github-email-notifications',
             root=os.path.abspath(os.path.dirname(__file__)),
-            allow_logging_basic_config=False
+            allow_logging_basic_config=False,
+            handler='blocking'
         )
         mock_exc.assert_called_once_with(mock.ANY, emailer.app)
 
@@ -84,10 +117,20 @@ class EmailerTests(unittest.TestCase):
             'fakefakefake',
             'my-TEST-env',
             root=os.path.abspath(os.path.dirname(__file__)),
-            allow_logging_basic_config=False
+            allow_logging_basic_config=False,
+            handler='blocking'
         )
         mock_exc.assert_called_once_with(mock.ANY, emailer.app)
 
+    @mock.patch('rollbar.init')
+    def test_rollbar_init__endpoint(self, mock_init):
+        """Verify rollbar can be pointed at another endpoint."""
+        env = {'ROLLBAR_ACCESS_TOKEN': 'fake',
+               'GITHUB_COMMIT_EMAILER_ROLLBAR_ENDPOINT': 'http://x/'}
+        with mock.patch.dict(os.environ, env):
+            emailer._init_rollbar()
+        self.assertEqual('http://x/', mock_init.call_args[1]['endpoint'])
+
     def test_index_redirects(self):
         """Verify index page redirects to chapel-lang.org."""
         r = self.app.get('/')
@@ -102,17 +145,16 @@ class EmailerTests(unittest.TestCase):
         self.assertEqual(200, r.status_code)
         self.assertEqual(0, mock_send.call_count)
 
-    @mock.patch('emailer._get_secret')
     @mock.patch('emailer._send_email')
-    def test_push_invalid_signature(self, mock_send, mock_secret):
+    def test_push_invalid_signature(self, mock_send):
         """Verify push event with invalid sig is skipped."""
-        mock_secret.return_value = 'asdf'
         headers = {'x-github-event': 'push',
                    'x-hub-signature': 'sha1=bogus'}
         r = self.app.post('/commit-email', headers=headers)
         self.assertEqual(200, r.status_code)
         self.assertEqual(0, mock_send.call_count)
 
+    @mock.patch('emailer._config', new=None)
     def test_no_secret_in_env(self):
         """Verify raises error when secret is not in environment."""
         if 'GITHUB_COMMIT_EMAILER_SECRET' in os.environ:
@@ -124,28 +166,173 @@ class EmailerTests(unittest.TestCase):
             headers=self.headers
         )
 
-    @mock.patch('emailer._valid_signature')
-    @mock.patch('emailer._get_secret')
     @mock.patch('emailer._send_email')
-    def test_deleted_branch(self, mock_send, mock_sec, mock_sig):
+    def test_deleted_branch(self, mock_send):
         """Verify deleted branch notification are skipped."""
-        mock_sec.return_value = 'asdf'
-        mock_sig.return_value = True
-        r = self.app.post('/commit-email',
-                          headers=self.headers,
-                          data=json.dumps({'head_commit': {'message': 'Test'},
-                                           'deleted': True}))
+        r = self.post_signed(json.dumps({'head_commit': {'message': 'Test'},
+                                         'deleted': True}))
         self.assertEqual(200, r.status_code)
         self.assertEqual(0, mock_send.call_count)
 
-    @mock.patch('emailer._valid_signature')
-    @mock.patch('emailer._get_secret')
+    def post_signed(self, data, headers=None):
+        """POST data to /commit-email, signed with the configured secret."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        h = hmac.new(b'sekret', data, digestmod='sha256')
+        headers = dict(headers or self.headers)
+        headers['x-hub-signature-256'] = 'sha256=' + h.hexdigest()
+        return self.app.post('/commit-email', headers=headers, data=data)
+
+    @mock.patch('json.loads')
     @mock.patch('emailer._send_email')
-    def test_test_send_mail(self, mock_send, mock_sec, mock_sig):
-        """Verify correct message info is passed to _send_email."""
-        mock_sec.return_value = 'adsf'
-        mock_sig.return_value = True
-        body = {
+    def test_non_merge_push__not_decoded(self, mock_send, mock_loads):
+        """Verify pushes that are not merges are skipped before the body is
+        decoded."""
+        body = self.push_body()
+        body['head_commit']['message'] = 'Fix a typo'
+        r = self.post_signed(json.dumps(body))
+        self.assertEqual(b'nope', r.data)
+        self.assertEqual(0, mock_loads.call_count)
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_deleted_branch__no_head_commit(self, mock_send):
+        """Verify deleted branch pushes, which have no head commit, are
+        skipped."""
+        body = self.push_body()
+        body['deleted'] = True
+        body['head_commit'] = None
+        body['commits'] = [{'message': 'Merge pull request #1 from a/b'}]
+        r = self.post_signed(json.dumps(body))
+        self.assertEqual(b'nope', r.data)
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_webhook_logged(self, mock_send):
+        """Verify one record is logged per webhook, with its decision and
+        stage timings, including for emails sent by a delivery thread."""
+        body = self.push_body()
+        with self.assertLogs('emailer.webhooks') as logs:
+            self.post_signed(json.dumps(body), dict(
+                self.headers, **{'x-github-delivery': 'd1'}))
+            emailer._delivery_queue.join()
+            body['head_commit']['message'] = 'Fix a typo'
+            self.post_signed(json.dumps(body), dict(
+                self.headers, **{'x-github-delivery': 'd2'}))
+        sent, skipped = [r.fields for r in logs.records]
+        self.assertEqual(
+            {'delivery': 'd1', 'event': 'push', 'repo': 'testing/test',
+             'sha': 'some-sha', 'decision': 'sent'},
+            dict((k, sent[k]) for k in ('delivery', 'event', 'repo', 'sha',
+                                        'decision')))
+        self.assertEqual({'signature', 'parse', 'pr_lookup'},
+                         set(sent['stages_ms']))
+        self.assertEqual(('d2', 'not_merge'),
+                         (skipped['delivery'], skipped['decision']))
+        self.assertNotIn('repo', skipped)
+
+    def test_webhook_logged__error(self):
+        """Verify a webhook that raises before a decision is made is
+        logged as an error."""
+        body = self.push_body()
+        del body['repository']
+        with self.assertLogs('emailer.webhooks') as logs, \
+                self.assertRaises(KeyError):
+            self.post_signed(json.dumps(body), dict(
+                self.headers, **{'x-github-delivery': 'd3'}))
+        record, = logs.records
+        self.assertEqual(('d3', 'error', logging.WARNING),
+                         (record.fields['delivery'], record.fields['decision'],
+                          record.levelno))
+
+    @mock.patch('emailer._send_email')
+    def test_webhook_logged__retrying(self, mock_send):
+        """Verify an email the outbox kept to retry is logged as
+        retrying, not sent."""
+        mock_send.return_value = False
+        with self.assertLogs('emailer.webhooks') as logs:
+            self.post_signed(json.dumps(self.push_body()))
+            emailer._delivery_queue.join()
+        record, = logs.records
+        self.assertEqual(('retrying', logging.WARNING),
+                         (record.fields['decision'], record.levelno))
+
+    @mock.patch('emailer._send_email')
+    def test_payload_logged__sampled(self, mock_send):
+        """Verify sampled webhooks have their payloads logged with emails
+        redacted, and others are not logged or redacted."""
+        data = json.dumps(self.push_body())
+        with mock.patch('emailer._payload_sample_rate', new=1), \
+                mock.patch.object(emailer._delivery_queue, 'workers', 0), \
+                self.assertLogs('emailer.payloads') as logs:
+            self.post_signed(data, dict(
+                self.headers, **{'x-github-delivery': 'd1'}))
+        record, = logs.records
+        self.assertEqual('push', record.fields['kind'])
+        self.assertEqual('d1', record.fields['delivery'])
+        self.assertEqual({'name': 'the-tester', 'email': '[redacted]'},
+                         record.fields['payload']['pusher'])
+
+        with mock.patch('emailer._redact') as mock_redact, \
+                mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            self.post_signed(data, dict(
+                self.headers, **{'x-github-delivery': 'd2'}))
+        self.assertEqual(0, mock_redact.call_count)
+
+    def test_redact(self):
+        """Verify named members are redacted at any depth."""
+        self.assertEqual(
+            {'a': [{'email': '[redacted]', 'b': 1}], 'token': '[redacted]'},
+            emailer._redact({'a': [{'email': 'x@y.z', 'b': 1}],
+                             'token': {'c': 2}}, {'email', 'token'}))
+
+    def test_queue_log_handler(self):
+        """Verify records are written by a background thread, formatted
+        there, and dropped and counted when too many are waiting."""
+        writing = threading.Event()
+        release = threading.Event()
+        written = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                writing.set()
+                release.wait(5)
+                written.append(self.format(record))
+
+        handler = emailer._QueueLogHandler([Handler()], maxsize=2)
+        logger = logging.getLogger('test_queue_log_handler')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        metrics = emailer._Metrics()
+        with mock.patch('emailer._metrics', new=metrics):
+            logger.warning('record %d', 1)
+            self.assertTrue(writing.wait(5))
+            for i in range(2, 5):
+                logger.warning('record %d', i)
+            release.set()
+            handler.flush()
+        self.assertEqual(['record 1', 'record 2', 'record 3'], written)
+        self.assertIn('commit_emailer_log_records_dropped_total 1',
+                      metrics.render())
+
+    def test_json_formatter(self):
+        """Verify records are formatted as a line of JSON, with fields."""
+        record = logging.makeLogRecord({
+            'name': 'emailer.webhooks', 'levelname': 'INFO', 'msg': 'a %s',
+            'args': ('b',), 'fields': {'delivery': 'd1'}})
+        entry = json.loads(emailer._JSONFormatter().format(record))
+        self.assertEqual({'level': 'INFO', 'logger': 'emailer.webhooks',
+                          'message': 'a b', 'delivery': 'd1'},
+                         dict((k, v) for k, v in entry.items()
+                              if k != 'time'))
+        self.assertEqual('INFO:emailer.webhooks:a b {"delivery":"d1"}',
+                         emailer._TextFormatter(logging.BASIC_FORMAT)
+                         .format(record))
+
+    def push_body(self):
+        """Returns a merge push event payload."""
+        return {
             'ref': 'the/master',
             'deleted': False,
             'compare': 'http://the-url.it',
@@ -160,6 +347,11 @@ class EmailerTests(unittest.TestCase):
                 'modified': ['README.md', 'README', 'LICENSE'],
             },
         }
+
+    @mock.patch('emailer._send_email')
+    def test_test_send_mail(self, mock_send):
+        """Verify correct message info is passed to _send_email."""
+        body = self.push_body()
         expected_msg_info = {
             'repo': 'testing/test',
             'branch': 'the/master',
@@ -173,41 +365,762 @@ class EmailerTests(unittest.TestCase):
             'pusher': 'the-tester',
             'pusher_email': 'the-tester <the@example.com>',
             'compare_url': 'http://the-url.it',
-            'pr_url': 'Unavailable'
+            'sha': 'some-sha',
+            'pr_url': 'Unavailable',
+            'route': emailer._get_config().route,
+            'deadline': mock.ANY,
         }
-        r = self.app.post('/commit-email',
-                          headers=self.headers,
-                          data=json.dumps(body))
-        self.assertEqual(200, r.status_code)
+        r = self.post_signed(json.dumps(body))
+        self.assertEqual(202, r.status_code)
+        emailer._delivery_queue.join()
         mock_send.assert_called_once_with(expected_msg_info)
 
-    def test_send_email__no_sender(self):
+    @mock.patch('emailer._send_email')
+    def test_send_mail__inline(self, mock_send):
+        """Verify email is sent before responding when there are no
+        delivery workers."""
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            r = self.post_signed(json.dumps(self.push_body()))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(1, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_send_mail__queue_full(self, mock_send):
+        """Verify 503 is returned when the delivery queue is full."""
+        with mock.patch.object(emailer._delivery_queue, 'submit',
+                               return_value=False):
+            r = self.post_signed(json.dumps(self.push_body()))
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(0, mock_send.call_count)
+
+    def test_delivery_queue__bounded(self):
+        """Verify submit refuses items once the queue is full."""
+        release = threading.Event()
+        q = emailer._DeliveryQueue(lambda item: release.wait(),
+                                   workers=1, maxsize=1)
+        self.assertTrue(q.submit('first'))
+        # Wait for the worker to pick up the first item.
+        while q.qsize():
+            time.sleep(0.01)
+        self.assertTrue(q.submit('second'))
+        self.assertFalse(q.submit('third'))
+        release.set()
+        q.join()
+
+    @mock.patch('emailer._github_session.get')
+    @mock.patch('emailer._send_email')
+    def test_pr_url__from_message(self, mock_send,
+                                  mock_get):
+        """Verify PR url is taken from the merge message without asking
+        github."""
+        body = self.push_body()
+        body['head_commit']['message'] = (
+            'Merge pull request #1234 from the/branch\n\nA lovely message.')
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            self.post_signed(json.dumps(body))
+        msg_info = mock_send.call_args[0][0]
+        self.assertEqual('https://github.com/testing/test/pull/1234',
+                         msg_info['pr_url'])
+        self.assertEqual(0, mock_get.call_count)
+
+    def test_pr_url_from_message__no_number(self):
+        """Verify None is returned when the message names no PR."""
+        self.assertIsNone(
+            emailer._pr_url_from_message('a/b', 'Merge pull request: x'))
+
+    @mock.patch('emailer._github_session.get')
+    def test_get_pr_url__cached(self, mock_get):
+        """Verify successful github lookups are cached by repo and sha."""
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [
+            {'html_url': 'https://github.com/a/b/pull/1'}]
+        for _ in range(2):
+            self.assertEqual('https://github.com/a/b/pull/1',
+                             emailer._get_pr_url('a/b', 'sha'))
+        self.assertEqual(1, mock_get.call_count)
+        emailer._get_pr_url('a/b', 'other-sha')
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('emailer._github_session.get')
+    def test_get_pr_url__failure_not_cached(self, mock_get):
+        """Verify failed github lookups are retried next time."""
+        mock_get.side_effect = IOError
+        for _ in range(2):
+            self.assertEqual('Unavailable', emailer._get_pr_url('a/b', 'sha'))
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_get_pr_url__stub_github(self):
+        """Verify PR url lookup against a local github stand-in."""
+        github = stubs.StubGitHubServer()
+        self.addCleanup(github.stop)
+        with mock.patch('emailer._GITHUB_API', new=github.url), \
+                mock.patch('emailer._github_session', new=requests.Session()):
+            self.assertEqual('https://github.com/a/b/pull/1',
+                             emailer._get_pr_url('a/b', 'sha'))
+        self.assertEqual(1, github.requests)
+
+    def test_get_pr_url__rate_limited(self):
+        """Verify lookups follow github's rate limit headers, and are
+        skipped without a request once the budget is spent."""
+        github = stubs.StubGitHubServer(rate_limit=2)
+        self.addCleanup(github.stop)
+        metrics = emailer._Metrics()
+        session = requests.Session()
+        with mock.patch('emailer._GITHUB_API', new=github.url), \
+                mock.patch('emailer._github_session', new=session), \
+                mock.patch('emailer._metrics', new=metrics):
+            urls = [emailer._get_pr_url('a/b', sha) for sha in 'xyz']
+        self.assertEqual(['https://github.com/a/b/pull/1'] * 2 +
+                         ['Unavailable'], urls)
+        self.assertEqual(2, github.requests)
+        self.assertIn('commit_emailer_github_lookups_skipped_total'
+                      '{reason="rate_limit"} 1\n', metrics.render())
+
+    @mock.patch('emailer._github_session.get')
+    def test_get_pr_url__circuit_open(self, mock_get):
+        """Verify lookups stop after repeated failures, and start again
+        once a probe succeeds."""
+        mock_get.side_effect = IOError
+        metrics = emailer._Metrics()
+        with mock.patch('emailer._metrics', new=metrics):
+            for _ in range(7):
+                self.assertEqual('Unavailable',
+                                 emailer._get_pr_url('a/b', 'sha'))
+        self.assertEqual(5, mock_get.call_count)
+        self.assertIn('commit_emailer_github_lookups_skipped_total'
+                      '{reason="circuit_open"} 2\n', metrics.render())
+        self.assertIn('commit_emailer_github_circuit_open 1\n',
+                      emailer._metrics.render())
+
+        mock_get.side_effect = None
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [
+            {'html_url': 'https://github.com/a/b/pull/1'}]
+        emailer._github_breaker.reset_timeout = 0
+        self.assertEqual('https://github.com/a/b/pull/1',
+                         emailer._get_pr_url('a/b', 'sha'))
+        self.assertFalse(emailer._github_breaker.is_open)
+
+    @mock.patch('emailer._github_session.get')
+    def test_get_pr_url__deadline(self, mock_get):
+        """Verify the lookup times out by the deadline, and is skipped
+        when too little time is left."""
+        mock_get.side_effect = IOError
+        now = time.monotonic()
+        emailer._get_pr_url('a/b', 'sha', now + 3)
+        self.assertLessEqual(mock_get.call_args[1]['timeout'], 3)
+        self.assertGreater(mock_get.call_args[1]['timeout'], 2)
+        emailer._get_pr_url('a/b', 'sha', now + 100)
+        self.assertEqual(emailer._GITHUB_TIMEOUT,
+                         mock_get.call_args[1]['timeout'])
+        self.assertEqual('Unavailable',
+                         emailer._get_pr_url('a/b', 'sha', now + 0.1))
+        self.assertEqual(2, mock_get.call_count)
+
+    @mock.patch('time.monotonic')
+    def test_circuit_breaker(self, mock_time):
+        """Verify the breaker opens after failures in a row, lets one probe
+        through after reset_timeout, and closes when a probe succeeds."""
+        mock_time.return_value = 0
+        breaker = emailer._CircuitBreaker(failures=2, reset_timeout=10)
+        breaker.record(False)
+        breaker.record(True)
+        breaker.record(False)
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+
+        mock_time.return_value = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        mock_time.return_value = 15
+        self.assertFalse(breaker.allow())
+        mock_time.return_value = 20
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.is_open)
+
+    def test_get_pr_url__token(self):
+        """Verify the configured github token is sent."""
+        github = stubs.StubGitHubServer()
+        self.addCleanup(github.stop)
+        os.environ['GITHUB_COMMIT_EMAILER_GITHUB_TOKEN'] = 'tok'
+        self.addCleanup(os.environ.pop, 'GITHUB_COMMIT_EMAILER_GITHUB_TOKEN')
+        self.prep_env()
+        self.addCleanup(self.prep_env)
+        with mock.patch('emailer._GITHUB_API', new=github.url), \
+                mock.patch('emailer._github_session', new=requests.Session()):
+            emailer._get_pr_url('a/b', 'sha')
+        self.assertEqual('token tok', github.authorization)
+
+    @mock.patch('time.monotonic')
+    def test_token_bucket(self, mock_time):
+        """Verify tokens are taken, refilled at rate, and waits past
+        max_wait are refused."""
+        mock_time.return_value = 0
+        bucket = emailer._TokenBucket(rate=10, capacity=2)
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertIsNone(bucket.reserve(max_wait=0.05))
+        self.assertAlmostEqual(0.1, bucket.reserve(max_wait=0.5))
+        mock_time.return_value = 0.25
+        self.assertEqual(0, bucket.reserve())
+        self.assertAlmostEqual(0.05, bucket.reserve())
+
+    @mock.patch('time.time')
+    @mock.patch('time.monotonic')
+    def test_github_limiter(self, mock_monotonic, mock_time):
+        """Verify the github limiter spreads the remaining budget until the
+        reset, and refills at the reset."""
+        mock_monotonic.return_value = 0
+        mock_time.return_value = 1000
+        limiter = emailer._GitHubLimiter(60)
+        limiter.observe(200, {'x-ratelimit-limit': '5000',
+                              'x-ratelimit-remaining': '10',
+                              'x-ratelimit-reset': '1100'})
+        self.assertAlmostEqual(0.1, limiter.rate)
+        limiter.observe(200, {'x-ratelimit-remaining': '0',
+                              'x-ratelimit-reset': '1100'})
+        self.assertIsNone(limiter.reserve(max_wait=5))
+        self.assertAlmostEqual(100, limiter.reserve(max_wait=200))
+        mock_monotonic.return_value = 100
+        self.assertEqual(0, limiter.reserve())
+        self.assertEqual(4999, limiter.tokens)
+
+        limiter.observe(429, {'retry-after': '30'})
+        self.assertIsNone(limiter.reserve(max_wait=5))
+        limiter.observe(200, mock.Mock())
+
+    def test_smtp_pool__rate_limited(self):
+        """Verify sends are spaced out by the SMTP rate limit."""
+        server = self.start_smtp_server()
+        pool = emailer._SMTPPool('127.0.0.1', server.port,
+                                 limiter=emailer._TokenBucket(20, 1))
+        self.addCleanup(pool.clear)
+        start = time.monotonic()
+        for _ in range(3):
+            pool.sendmail('from@fake.fake', ['to@fake.fake'], 'Subject: hi\n')
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(3, len(server.messages))
+
+    @mock.patch('time.monotonic')
+    def test_ttl_cache(self, mock_time):
+        """Verify cache entries expire and least recently used entries are
+        evicted."""
+        mock_time.return_value = 0
+        cache = emailer._TTLCache(maxsize=2, ttl=10)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        mock_time.return_value = 11
+        self.assertIsNone(cache.get('a'))
+
+    @mock.patch('emailer._deliver')
+    def test_duplicate_delivery(self, mock_deliver):
+        """Verify a redelivered webhook is skipped."""
+        headers = dict(self.headers, **{'x-github-delivery': 'guid-1'})
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            self.post_signed(json.dumps(self.push_body()), headers)
+            r = self.post_signed(json.dumps(self.push_body()), headers)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(b'nope', r.data)
+        self.assertEqual(1, mock_deliver.call_count)
+
+    @mock.patch('emailer._deliver')
+    def test_duplicate__skipped_not_recorded(self, mock_deliver):
+        """Verify pushes that need no email leave no dedup keys."""
+        body = self.push_body()
+        body['deleted'] = True
+        with mock.patch.object(emailer._dedup, 'add') as mock_add:
+            self.post_signed(json.dumps(body), dict(
+                self.headers, **{'x-github-delivery': 'guid-3'}))
+            body['head_commit']['message'] = 'Fix a typo'
+            self.post_signed(json.dumps(body))
+        self.assertEqual(0, mock_add.call_count)
+        self.assertEqual(0, mock_deliver.call_count)
+
+    @mock.patch('emailer._deliver')
+    def test_duplicate_push(self, mock_deliver):
+        """Verify the same push is only emailed once when there is no
+        delivery header."""
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            for _ in range(2):
+                self.post_signed(json.dumps(self.push_body()))
+        self.assertEqual(1, mock_deliver.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_duplicate__after_queue_full(self, mock_send):
+        """Verify a delivery rejected with 503 is accepted on retry."""
+        headers = dict(self.headers, **{'x-github-delivery': 'guid-2'})
+        with mock.patch.object(emailer._delivery_queue, 'submit',
+                               return_value=False):
+            r = self.post_signed(json.dumps(self.push_body()), headers)
+        self.assertEqual(503, r.status_code)
+        with mock.patch.object(emailer._delivery_queue, 'submit',
+                               return_value=True):
+            r = self.post_signed(json.dumps(self.push_body()), headers)
+        self.assertEqual(202, r.status_code)
+
+    @mock.patch('emailer._send_email')
+    def test_duplicate__after_error(self, mock_send):
+        """Verify a delivery that failed before it was queued is accepted
+        on retry."""
+        headers = dict(self.headers, **{'x-github-delivery': 'guid-3'})
+        body = self.push_body()
+        del body['pusher']
+        with self.assertRaises(KeyError):
+            self.post_signed(json.dumps(body), headers)
+        with mock.patch.object(emailer._delivery_queue, 'submit',
+                               return_value=True):
+            r = self.post_signed(json.dumps(self.push_body()), headers)
+        self.assertEqual(202, r.status_code)
+
+    def test_dedup_index__bounded(self):
+        """Verify least recently seen keys are forgotten."""
+        dedup = emailer._DedupIndex(2)
+        self.assertTrue(dedup.add('a'))
+        self.assertTrue(dedup.add('b'))
+        self.assertFalse(dedup.add('a'))
+        self.assertTrue(dedup.add('c'))
+        self.assertTrue(dedup.add('b'))
+
+    def test_dedup_index__persistent(self):
+        """Verify keys survive a restart when stored on disk."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'dedup.db')
+        dedup = emailer._DedupIndex(10, state=sharedstate.SQLiteState(path))
+        self.assertTrue(dedup.add('a'))
+        restarted = emailer._DedupIndex(10,
+                                        state=sharedstate.SQLiteState(path))
+        self.assertFalse(restarted.add('a'))
+        restarted.discard('a')
+        self.assertTrue(restarted.add('a'))
+
+    def test_dedup_index__state_unavailable(self):
+        """Verify keys are taken to be new if shared state is down."""
+        redis = stubs.StubRedisServer()
+        redis.stop()
+        metrics = emailer._Metrics()
+        dedup = emailer._DedupIndex(10, state=emailer._open_state(redis.url))
+        with mock.patch('emailer._metrics', new=metrics):
+            self.assertTrue(dedup.add('a'))
+            self.assertFalse(dedup.add('a'))
+        self.assertIn('commit_emailer_state_errors_total{use="dedup"} 1',
+                      metrics.render())
+
+    def test_open_state(self):
+        """Verify shared state urls select their backend."""
+        self.assertIsInstance(emailer._open_state('memory:'),
+                              sharedstate.MemoryState)
+        self.assertIsInstance(emailer._open_state('sqlite:///tmp/state.db'),
+                              sharedstate.SQLiteState)
+        state = emailer._open_state('redis://:p%40ss@host:1234/2')
+        self.assertIsInstance(state, sharedstate.RedisState)
+        self.assertEqual(('host', 1234, 2, 'p@ss'),
+                         (state.host, state.port, state.db, state.password))
+
+    def test_open_state__invalid(self):
+        """Verify unknown shared state urls are rejected."""
+        for url in ('memcache://host', 'sqlite://', 'redis:///0'):
+            with self.assertRaises(ValueError):
+                emailer._open_state(url)
+
+    def test_ttl_cache__shared(self):
+        """Verify caches sharing state find each other's entries."""
+        state = sharedstate.MemoryState()
+        a = emailer._TTLCache(maxsize=2, ttl=10, state=state, namespace='c')
+        b = emailer._TTLCache(maxsize=2, ttl=10, state=state, namespace='c')
+        a.put(('a/b', 'sha'), 'url')
+        self.assertEqual('url', b.get(('a/b', 'sha')))
+        self.assertEqual('url', state.get('c:a/b:sha'))
+
+    @mock.patch('time.time', return_value=1000.25)
+    def test_shared_rate_limiter(self, mock_time):
+        """Verify limiters sharing state share one rate, and take tokens
+        from the next window once the current one's are gone."""
+        state = sharedstate.MemoryState()
+        a = emailer._SharedRateLimiter(state, 'r', rate=2, capacity=2)
+        b = emailer._SharedRateLimiter(state, 'r', rate=2, capacity=2)
+        self.assertEqual(0.0, a.reserve())
+        self.assertEqual(0.0, b.reserve())
+        self.assertIsNone(a.reserve(max_wait=0.5))
+        self.assertEqual(0.75, b.reserve())
+        self.assertEqual(0.75, a.reserve())
+        self.assertEqual(1.75, a.reserve())
+
+    def test_github_limiter__shared(self):
+        """Verify requests by every limiter sharing state count against
+        the requests github said remain."""
+        state = sharedstate.MemoryState()
+        a = emailer._GitHubLimiter(60, state=state)
+        b = emailer._GitHubLimiter(60, state=state)
+        a.observe(200, {'x-ratelimit-remaining': '2',
+                        'x-ratelimit-reset': str(time.time() + 3600)})
+        self.assertEqual(0.0, b.reserve(max_wait=0))
+        self.assertEqual(0.0, b.reserve(max_wait=0))
+        self.assertIsNone(a.reserve(max_wait=0))
+
+    def report_errors(self, reporter, *errors):
+        """Raise and report each of errors, from the same place."""
+        for error in errors:
+            try:
+                raise error
+            except Exception:
+                reporter.report()
+
+    def test_error_reporter(self):
+        """Verify exceptions are reported in a batch, once per fingerprint
+        with a count, and that new ones past the limit are dropped."""
+        collector = stubs.StubRollbarServer()
+        self.addCleanup(collector.stop)
+        self.init_rollbar(collector.endpoint)
+        reporter = emailer._ErrorReporter(maxsize=2, interval=3600)
+        metrics = emailer._Metrics()
+        with mock.patch('emailer._metrics', new=metrics):
+            self.report_errors(reporter, ValueError('a'), ValueError('b'),
+                               KeyError('c'))
+            self.assertFalse(reporter.report((IOError, IOError(), None)))
+            self.assertEqual(2, reporter.pending())
+            self.assertEqual([], collector.items)
+            self.assertEqual(2, reporter.flush())
+        self.assertEqual(0, reporter.pending())
+        self.assertEqual(0, reporter.flush())
+
+        data = [item['data'] for item in collector.items]
+        self.assertEqual(['ValueError', 'KeyError'],
+                         [d['body']['trace']['exception']['class']
+                          for d in data])
+        self.assertEqual([2, 1], [d['custom']['occurrences'] for d in data])
+        self.assertNotEqual(data[0]['fingerprint'], data[1]['fingerprint'])
+        text = metrics.render()
+        self.assertIn('commit_emailer_errors_total 4', text)
+        self.assertIn('commit_emailer_errors_reported_total 2', text)
+        self.assertIn('commit_emailer_errors_dropped_total 1', text)
+
+    def init_rollbar(self, endpoint):
+        """Initialize rollbar to send items to endpoint, like _init_rollbar,
+        and restore its module state after the test. rollbar ignores init
+        once initialized, so it is marked uninitialized first."""
+        state = {'SETTINGS': copy.deepcopy(rollbar.SETTINGS),
+                 '_initialized': False}
+        for name in ['_transforms', '_serialize_transform',
+                     '_scrub_redact_transform', '_threads']:
+            state[name] = getattr(rollbar, name, None)
+        patcher = mock.patch.multiple(rollbar, create=True, **state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        rollbar.init('fake', 'test', endpoint=endpoint, handler='blocking',
+                     allow_logging_basic_config=False)
+
+    def test_error_reporter__request(self):
+        """Verify request exceptions are queued with the url and github
+        headers, but not the signature."""
+        reporter = emailer._ErrorReporter(maxsize=2, interval=3600)
+        headers = {'X-GitHub-Delivery': 'the-id',
+                   'X-Hub-Signature-256': 'sha256=sekret'}
+        with mock.patch('emailer._errors', new=reporter), \
+                emailer.app.test_request_context(
+                    '/commit-email?a=b', method='POST', headers=headers):
+            try:
+                raise ValueError
+            except ValueError as e:
+                emailer._report_request_exception(emailer.app, exception=e)
+        pending, = reporter._pending.values()
+        self.assertEqual({'url': 'http://localhost/commit-email?a=b',
+                          'method': 'POST', 'GET': {'a': 'b'},
+                          'headers': {'X-GitHub-Event': '',
+                                      'X-GitHub-Delivery': 'the-id'}},
+                         pending['request'])
+
+    def test_fingerprint(self):
+        """Verify fingerprints differ by type and place, not message."""
+        def fingerprint(error):
+            try:
+                raise error
+            except Exception:
+                return emailer._fingerprint(sys.exc_info())
+
+        self.assertEqual(fingerprint(ValueError('a')),
+                         fingerprint(ValueError('b')))
+        self.assertNotEqual(fingerprint(ValueError()),
+                            fingerprint(KeyError()))
+        try:
+            raise ValueError
+        except ValueError:
+            self.assertNotEqual(fingerprint(ValueError()),
+                                emailer._fingerprint(sys.exc_info()))
+
+    def test_warm_up(self):
+        """Verify warm up opens an SMTP connection, learns the github rate
+        limit without using it, and handles SIGHUP again."""
+        smtp = self.start_smtp_server()
+        github = stubs.StubGitHubServer(rate_limit=10)
+        self.addCleanup(github.stop)
+        pool = emailer._SMTPPool('127.0.0.1', smtp.port)
+        self.addCleanup(pool.clear)
+        self.addCleanup(signal.signal, signal.SIGHUP,
+                        signal.getsignal(signal.SIGHUP))
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        with mock.patch('emailer._smtp_pool', new=pool), \
+                mock.patch('emailer._GITHUB_API', new=github.url), \
+                mock.patch('emailer._github_session', new=requests.Session()):
+            emailer.warm_up().join()
+        self.assertEqual(1, smtp.connections)
+        self.assertEqual(1, len(pool._idle))
+        self.assertEqual(10, emailer._github_limiter.tokens)
+        self.assertEqual(0, github.requests)
+        self.assertIs(emailer._reload_config_on_signal,
+                      signal.getsignal(signal.SIGHUP))
+
+    def test_warm_up__unavailable(self):
+        """Verify warm up carries on if it cannot connect."""
+        pool = mock.Mock()
+        pool.warm.side_effect = OSError
+        with mock.patch('emailer._smtp_pool', new=pool):
+            emailer.warm_up().join()
+        pool.warm.assert_called_once_with()
+
+    def test_changed_files__under_limit(self):
+        """Verify every file is listed when under the limit."""
+        head_commit = {'added': ['a'], 'removed': ['b'], 'modified': ['c']}
+        self.assertEqual(['A a', 'R b', 'M c'],
+                         list(emailer._changed_files(head_commit, 3, 10)))
+
+    def test_changed_files__over_limit(self):
+        """Verify files past the limit are counted per directory, sorted by
+        directory."""
+        head_commit = {
+            'added': ['top', 'z/1', 'z/2'],
+            'removed': [],
+            'modified': ['a/b/1', 'README', 'z/3'],
+        }
+        self.assertEqual(['A top',
+                          '... and 5 more files in:',
+                          '      1 .',
+                          '      1 a/b',
+                          '      3 z'],
+                         list(emailer._changed_files(head_commit, 1, 10)))
+
+    def test_changed_files__dir_limit(self):
+        """Verify the number of directories listed is bounded too."""
+        head_commit = {'added': ['d{0}/f'.format(i) for i in range(1000)],
+                       'removed': [], 'modified': []}
+        lines = list(emailer._changed_files(head_commit, 2, 3))
+        self.assertEqual(7, len(lines))
+        self.assertEqual('... and 998 more files in:', lines[2])
+        self.assertEqual('  ... and 995 more directories', lines[-1])
+
+    def test_load_config__no_sender(self):
         """Verify ValueError when sender is not configured."""
-        if 'GITHUB_COMMIT_EMAILER_SENDER' in os.environ:
-            del os.environ['GITHUB_COMMIT_EMAILER_SENDER']
-        self.assertRaises(ValueError,
-                          emailer._send_email, {'pusher_email': 'x'})
+        self.prep_env()
+        del os.environ['GITHUB_COMMIT_EMAILER_SENDER']
+        self.assertRaises(ValueError, emailer.reload_config)
 
-    def test_send_email__no_recipient(self):
+    def test_load_config__no_recipient(self):
         """Verify ValueError when recipient is not configured."""
-        if 'GITHUB_COMMIT_EMAILER_RECIPIENT' in os.environ:
-            del os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT']
-        self.assertRaises(ValueError,
-                          emailer._send_email, {'pusher_email': 'x'})
+        self.prep_env()
+        del os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT']
+        self.assertRaises(ValueError, emailer.reload_config)
 
-    def test_send_email__missing_both(self):
+    def test_load_config__missing_both(self):
         """Verify ValueError when recipient and sender are not configured."""
-        if 'GITHUB_COMMIT_EMAILER_SENDER' in os.environ:
-            del os.environ['GITHUB_COMMIT_EMAILER_SENDER']
-        if 'GITHUB_COMMIT_EMAILER_RECIPIENT' in os.environ:
-            del os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT']
-        self.assertRaises(ValueError,
-                          emailer._send_email, {'pusher_email': 'x'})
+        self.prep_env()
+        del os.environ['GITHUB_COMMIT_EMAILER_SENDER']
+        del os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT']
+        self.assertRaises(ValueError, emailer.reload_config)
+
+    def test_load_config__no_secret(self):
+        """Verify ValueError when secret is not configured."""
+        self.prep_env()
+        del os.environ['GITHUB_COMMIT_EMAILER_SECRET']
+        self.assertRaises(ValueError, emailer.reload_config)
+
+    def test_load_config__author_needs_no_sender(self):
+        """Verify sender is optional when sending from the author."""
+        self.prep_env()
+        del os.environ['GITHUB_COMMIT_EMAILER_SENDER']
+        os.environ['GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR'] = 'yes'
+        self.assertTrue(emailer.reload_config().send_from_author)
+
+    def test_load_config__precomputed(self):
+        """Verify secret is encoded and recipients are split up front."""
+        config = emailer._load_config({
+            'GITHUB_COMMIT_EMAILER_SECRET': 'sekret',
+            'GITHUB_COMMIT_EMAILER_SENDER': self.sender,
+            'GITHUB_COMMIT_EMAILER_RECIPIENT': self.recipient,
+            'GITHUB_COMMIT_EMAILER_RECIPIENT_CC': 'a@fake.fake, b@fake.fake,',
+        })
+        self.assertEqual(b'sekret', config.secret)
+        self.assertEqual(('a@fake.fake', 'b@fake.fake'), config.recipient_cc)
+        self.assertEqual(('a@fake.fake', 'b@fake.fake', self.recipient),
+                         config.recipients)
+
+    def make_rules(self, rules):
+        """Returns _Rules compiled from rules, with the test default."""
+        default = emailer._Route(('list@fake.fake',), ('cc@fake.fake',),
+                                 '[Chapel Merge]')
+        return emailer._Rules(rules, default)
+
+    def test_rules__route(self):
+        """Verify rules match on repo, branch and path, and combine."""
+        rules = self.make_rules([
+            {'repo': 'chapel-lang/chapel', 'paths': ['compiler/'],
+             'recipients': ['compiler@fake.fake'],
+             'subject_prefix': '[Compiler]'},
+            {'repo': 'chapel-lang/*', 'branch': 'release/*',
+             'recipients': ['release@fake.fake'], 'cc': ['rm@fake.fake']},
+            {'paths': ['doc', 'README.md'], 'recipients': ['doc@fake.fake'],
+             'subject_prefix': '[Docs]'},
+        ])
+        route = rules.route('chapel-lang/chapel', 'refs/heads/main',
+                            ['compiler/main/x.cpp', 'README.md'])
+        self.assertEqual(('compiler@fake.fake', 'doc@fake.fake'), route.to)
+        self.assertEqual((), route.cc)
+        self.assertEqual('[Compiler]', route.subject_prefix)
+
+        route = rules.route('chapel-lang/other', 'refs/heads/release/1.2',
+                            ['docs/x', 'doc/y'])
+        self.assertEqual(('release@fake.fake', 'doc@fake.fake'), route.to)
+        self.assertEqual(('rm@fake.fake',), route.cc)
+        self.assertEqual('[Docs]', route.subject_prefix)
+        self.assertEqual(['rm@fake.fake', 'release@fake.fake',
+                          'doc@fake.fake'], route.recipients)
+
+    def test_rules__default(self):
+        """Verify the default route is used when no rule matches, and for
+        anything the matching rules leave unset."""
+        rules = self.make_rules([
+            {'repo': 'a/b', 'subject_prefix': '[B]'},
+            {'repo': 'a/c', 'paths': ['src'], 'recipients': ['c@fake.fake']},
+        ])
+        self.assertIs(rules.default, rules.route('a/c', 'main', ['docs/x']))
+        self.assertIs(rules.default, rules.route('a/d', 'main', ['src/x']))
+        self.assertEqual(
+            emailer._Route(('list@fake.fake',), ('cc@fake.fake',), '[B]'),
+            rules.route('a/b', 'main', []))
+
+    def test_rules__many(self):
+        """Verify routing with thousands of rules and files finds every
+        matching rule, and stops reading files once all have matched."""
+        rules = self.make_rules([
+            {'paths': ['dir{0}/sub'.format(i)],
+             'recipients': ['team{0}@fake.fake'.format(i)]}
+            for i in range(5000)])
+        paths = ['dir{0}/sub/file{1}'.format(i % 3, i) for i in range(20000)]
+        route = rules.route('a/b', 'main', paths)
+        self.assertEqual(('team0@fake.fake', 'team1@fake.fake',
+                          'team2@fake.fake'), route.to)
+        route = rules.route('a/b', 'main', [
+            'dir{0}/sub/x'.format(i) for i in range(5000)])
+        self.assertEqual(5000, len(route.to))
+
+        rules = self.make_rules([
+            {'paths': ['dir{0}'.format(i)],
+             'recipients': ['team{0}@fake.fake'.format(i)]}
+            for i in range(3)])
+        read = []
+        route = rules.route('a/b', 'main',
+                            (read.append(p) or p for p in paths))
+        self.assertEqual(3, len(route.to))
+        self.assertEqual(3, len(read))
+
+    def test_rules__invalid(self):
+        """Verify malformed rules are refused."""
+        for rules in [{}, ['x'], [{'repo': 1}], [{'paths': 'src'}],
+                      [{'paths': ['/']}], [{'recipient': ['a@fake.fake']}]]:
+            self.assertRaises(ValueError, self.make_rules, rules)
+
+    @mock.patch('emailer._smtp_pool.sendmail')
+    def test_rules__send_email(self, mock_sendmail):
+        """Verify pushes are emailed as the rules file routes them."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'rules.json')
+        with open(path, 'w') as f:
+            json.dump([{'paths': ['README'], 'recipients': ['r@fake.fake'],
+                        'subject_prefix': '[Readme]'}], f)
+        os.environ['GITHUB_COMMIT_EMAILER_RULES'] = path
+        self.addCleanup(os.environ.pop, 'GITHUB_COMMIT_EMAILER_RULES')
+        emailer.reload_config()
+        self.addCleanup(self.prep_env)
+
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            self.post_signed(json.dumps(self.push_body()))
+        sender, recipients, message = mock_sendmail.call_args[0]
+        self.assertEqual(['r@fake.fake'], recipients)
+        self.assertIn('To: r@fake.fake\n', message)
+        self.assertIn('Subject: [Readme] commit message.', message)
+
+    def test_load_config__bad_rules(self):
+        """Verify a missing rules file makes the config invalid."""
+        env = {'GITHUB_COMMIT_EMAILER_SECRET': 'sekret',
+               'GITHUB_COMMIT_EMAILER_SENDER': self.sender,
+               'GITHUB_COMMIT_EMAILER_RECIPIENT': self.recipient,
+               'GITHUB_COMMIT_EMAILER_RULES': '/no/such/rules.json'}
+        self.assertRaises(ValueError, emailer._load_config, env)
+
+    def test_reload_config__invalid_keeps_old(self):
+        """Verify a failed reload leaves the current config in place."""
+        self.prep_env()
+        config = emailer._get_config()
+        del os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT']
+        emailer._reload_config_on_signal(1, None)
+        self.assertIs(config, emailer._get_config())
+
+    def test_config_file__reloaded_on_change(self):
+        """Verify config file overrides the environment and is reloaded
+        once it changes."""
+        self.prep_env()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'config')
+        with open(path, 'w') as f:
+            f.write("# comment\nGITHUB_COMMIT_EMAILER_SENDER='a@fake.fake'\n")
+        os.environ['GITHUB_COMMIT_EMAILER_CONFIG'] = path
+        self.addCleanup(os.environ.pop, 'GITHUB_COMMIT_EMAILER_CONFIG')
+        self.assertEqual('a@fake.fake', emailer.reload_config().sender)
+
+        with open(path, 'w') as f:
+            f.write('GITHUB_COMMIT_EMAILER_SENDER=b@fake.fake\n')
+        os.utime(path, (0, 0))
+        with mock.patch('emailer._config_checked', new=0.0):
+            self.assertEqual('b@fake.fake', emailer._get_config().sender)
+
+    def test_config_file__startup_only(self):
+        """Verify the config file's github token sets the github rate limit,
+        and vars only read at startup are warned about."""
+        self.prep_env()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'config')
+        with open(path, 'w') as f:
+            f.write('GITHUB_COMMIT_EMAILER_GITHUB_TOKEN=t0ken\n'
+                    'GITHUB_COMMIT_EMAILER_DIGEST_WINDOW=60\n')
+        limiter = emailer._GitHubLimiter(60)
+        with mock.patch.dict(os.environ, GITHUB_COMMIT_EMAILER_CONFIG=path), \
+                mock.patch('emailer._github_limiter', new=limiter), \
+                mock.patch('logging.warn') as mock_warn:
+            emailer.reload_config()
+        self.addCleanup(emailer.reload_config)
+        self.assertEqual(5000, limiter.capacity)
+        self.assertEqual(5000, limiter.tokens)
+        self.assertEqual('GITHUB_COMMIT_EMAILER_DIGEST_WINDOW',
+                         mock_warn.call_args[0][1])
 
     def prep_env(self):
         """Prepare os.environ for _send_email() tests."""
+        os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = 'sekret'
         os.environ['GITHUB_COMMIT_EMAILER_SENDER'] = self.sender
         os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT'] = self.recipient
+        os.environ.pop('GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR', None)
+        os.environ.pop('GITHUB_COMMIT_EMAILER_RECIPIENT_CC', None)
+        emailer.reload_config()
 
     def check_msg(self, actual_msg):
         """Verify recipient and sender on sent message."""
@@ -222,6 +1135,7 @@ class EmailerTests(unittest.TestCase):
         self.prep_env()
         if 'GITHUB_COMMIT_EMAILER_REPLY_TO' in os.environ:
             del os.environ['GITHUB_COMMIT_EMAILER_REPLY_TO']
+        emailer.reload_config()
         emailer._send_email(self.msg_info)
 
         mock_sendmail.return_value.sendmail.assert_called_once_with(mock.ANY,
@@ -236,6 +1150,7 @@ class EmailerTests(unittest.TestCase):
         """Verify email is sent as expected when reply-to is configured."""
         self.prep_env()
         os.environ['GITHUB_COMMIT_EMAILER_REPLY_TO'] = self.reply_to
+        emailer.reload_config()
         emailer._send_email(self.msg_info)
 
         mock_sendmail.return_value.sendmail.assert_called_once_with(mock.ANY,
@@ -250,6 +1165,7 @@ class EmailerTests(unittest.TestCase):
         """Verify approved header is added when config is set."""
         self.prep_env()
         os.environ['GITHUB_COMMIT_EMAILER_APPROVED_HEADER'] = 'my-super-secret'
+        emailer.reload_config()
         emailer._send_email(self.msg_info)
 
         mock_sendmail.return_value.sendmail.assert_called_once_with(mock.ANY,
@@ -265,6 +1181,7 @@ class EmailerTests(unittest.TestCase):
         self.prep_env()
         if 'GITHUB_COMMIT_EMAILER_APPROVED_HEADER' in os.environ:
             del os.environ['GITHUB_COMMIT_EMAILER_APPROVED_HEADER']
+        emailer.reload_config()
         emailer._send_email(self.msg_info)
 
         mock_sendmail.return_value.sendmail.assert_called_once_with(mock.ANY,
@@ -289,9 +1206,446 @@ class EmailerTests(unittest.TestCase):
         actual_msg = mock_sendmail.return_value.sendmail.call_args[0]
         self.check_msg(actual_msg)
 
+    @mock.patch('smtplib.SMTP')
+    def test_smtp_pool__reuses_connection(self, mock_smtp):
+        """Verify consecutive emails share one logged in connection."""
+        self.prep_env()
+        emailer._send_email(self.msg_info)
+        emailer._send_email(self.msg_info)
+
+        self.assertEqual(1, mock_smtp.call_count)
+        self.assertEqual(1, mock_smtp.return_value.login.call_count)
+        self.assertEqual(2, mock_smtp.return_value.sendmail.call_count)
+        self.assertEqual(0, mock_smtp.return_value.quit.call_count)
+        mock_smtp.return_value.set_debuglevel.assert_called_once_with(0)
+
+    @mock.patch('smtplib.SMTP')
+    def test_smtp_pool__reconnects(self, mock_smtp):
+        """Verify send is retried on a new connection when the server has
+        dropped the pooled one."""
+        stale, fresh = mock.MagicMock(), mock.MagicMock()
+        stale.sendmail.side_effect = smtplib.SMTPServerDisconnected
+        mock_smtp.side_effect = [stale, fresh]
+        pool = emailer._SMTPPool('localhost', 25)
+
+        pool.sendmail('from', ['to'], 'msg')
+        fresh.sendmail.assert_called_once_with('from', ['to'], 'msg')
+        self.assertEqual(2, mock_smtp.call_count)
+
+    @mock.patch('time.monotonic')
+    @mock.patch('smtplib.SMTP')
+    def test_smtp_pool__keepalive_and_idle(self, mock_smtp, mock_time):
+        """Verify idle connections are checked with NOOP, and evicted once
+        they exceed the idle timeout."""
+        mock_smtp.return_value.noop.return_value = (250, b'OK')
+        pool = emailer._SMTPPool('localhost', 25, idle_timeout=60,
+                                 keepalive=5)
+        mock_time.return_value = 0
+        pool.sendmail('from', ['to'], 'msg')
+
+        mock_time.return_value = 10
+        pool.sendmail('from', ['to'], 'msg')
+        self.assertEqual(1, mock_smtp.return_value.noop.call_count)
+        self.assertEqual(1, mock_smtp.call_count)
+
+        mock_time.return_value = 100
+        pool.sendmail('from', ['to'], 'msg')
+        self.assertEqual(1, mock_smtp.return_value.quit.call_count)
+        self.assertEqual(2, mock_smtp.call_count)
+
+    def test_smtp_pool__pipelining(self):
+        """Verify MAIL and RCPT commands are sent together when the server
+        supports PIPELINING, and one at a time otherwise."""
+        recipients = ['{0}@fake.fake'.format(i) for i in range(5)]
+        sends = []
+        for pipelining in (True, False):
+            server = stubs.StubSMTPServer(pipelining=pipelining)
+            self.addCleanup(server.stop)
+            server.refuse.add('0@fake.fake')
+            pool = emailer._SMTPPool('127.0.0.1', server.port)
+            self.addCleanup(pool.clear)
+            # Log in first, so only the sending is counted.
+            pool._send('from@fake.fake', recipients, 'Subject: hi\n')
+            with mock.patch.object(smtplib.SMTP, 'send', autospec=True,
+                                   side_effect=smtplib.SMTP.send) as send:
+                refused = pool._send('from@fake.fake', recipients,
+                                     'Subject: hi\n')
+            sends.append(send.call_count)
+            self.assertEqual(['0@fake.fake'], list(refused))
+            self.assertEqual(recipients[1:], server.messages[1][1])
+        # MAIL and RCPTs, DATA, then the message.
+        self.assertEqual([3, 8], sends)
+
+    def test_smtp_pool__fan_out(self):
+        """Verify long recipient lists are sent in chunks, recipients
+        refused for now retried, and those refused for good reported."""
+        server = self.start_smtp_server()
+        server.max_recipients = 3
+        server.refuse.add('bad@fake.fake')
+        pool = emailer._SMTPPool('127.0.0.1', server.port, max_recipients=4)
+        self.addCleanup(pool.clear)
+        recipients = ['{0}@fake.fake'.format(i) for i in range(9)]
+        recipients.insert(5, 'bad@fake.fake')
+        metrics = emailer._Metrics()
+        with mock.patch('emailer._metrics', new=metrics):
+            refused = pool.sendmail('from@fake.fake', recipients,
+                                    'Subject: hi\n')
+        self.assertEqual({'bad@fake.fake': (550, b'no such user')}, refused)
+        sent = sorted(r for _, rs, _ in server.messages for r in rs)
+        self.assertEqual(sorted(set(recipients) - set(refused)), sent)
+        # Three chunks, then a retry for the first chunk's fourth recipient,
+        # which was over the server's limit.
+        self.assertEqual(4, len(server.messages))
+        self.assertIn('commit_emailer_recipients_refused_total 1\n',
+                      metrics.render())
+
+    def test_smtp_pool__server_limit(self):
+        """Verify recipients over the server's per message limit are retried
+        in chunks it accepts."""
+        server = self.start_smtp_server()
+        server.max_recipients = 3
+        pool = emailer._SMTPPool('127.0.0.1', server.port, max_recipients=10)
+        self.addCleanup(pool.clear)
+        recipients = ['u{0}@fake.fake'.format(i) for i in range(10)]
+        refused = pool.sendmail('from@fake.fake', recipients, 'Subject: hi\n')
+        self.assertEqual({}, refused)
+        self.assertEqual([1, 3, 3, 3],
+                         sorted(len(rs) for _, rs, _ in server.messages))
+        self.assertEqual(recipients,
+                         sorted(r for _, rs, _ in server.messages for r in rs))
+
+    def test_smtp_pool__all_refused(self):
+        """Verify the send fails if no recipient could be sent to."""
+        server = self.start_smtp_server()
+        server.refuse.update(['a@fake.fake', 'b@fake.fake'])
+        pool = emailer._SMTPPool('127.0.0.1', server.port, max_recipients=1)
+        self.addCleanup(pool.clear)
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            pool.sendmail('from@fake.fake', ['a@fake.fake', 'b@fake.fake'],
+                          'Subject: hi\n')
+        self.assertEqual(0, len(server.messages))
+
+    def test_smtp_pool__chunk_retried(self):
+        """Verify a chunk that could not be sent is retried as a whole."""
+        server = self.start_smtp_server()
+        pool = emailer._SMTPPool('127.0.0.1', server.port, max_recipients=2)
+        self.addCleanup(pool.clear)
+        recipients = ['a@fake.fake', 'b@fake.fake', 'c@fake.fake']
+        send = pool._send
+        failures = [smtplib.SMTPServerDisconnected('gone')]
+
+        def flaky_send(sender, chunk, message):
+            if 'c@fake.fake' in chunk and failures:
+                raise failures.pop()
+            return send(sender, chunk, message)
+
+        with mock.patch.object(pool, '_send', side_effect=flaky_send):
+            refused = pool.sendmail('from@fake.fake', recipients,
+                                    'Subject: hi\n')
+        self.assertEqual({}, refused)
+        self.assertEqual([recipients[:2], ['c@fake.fake']],
+                         sorted(rs for _, rs, _ in server.messages))
+
+    def test_outbox__keeps_unsent_recipients(self):
+        """Verify recipients that could not be sent to stay in the outbox,
+        without those that were sent to."""
+        server = self.start_smtp_server()
+        pool = emailer._SMTPPool('127.0.0.1', server.port, max_recipients=1)
+        self.addCleanup(pool.clear)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        outbox = emailer._Outbox(os.path.join(tmpdir, 'outbox.db'),
+                                 pool.sendmail, backoff_base=0)
+        send = pool._send
+
+        def flaky_send(sender, chunk, message):
+            if chunk == ['b@fake.fake']:
+                raise smtplib.SMTPServerDisconnected('gone')
+            return send(sender, chunk, message)
+
+        with mock.patch.object(pool, '_send', side_effect=flaky_send):
+            outbox.deliver('from@fake.fake', ['a@fake.fake', 'b@fake.fake'],
+                           'Subject: hi\n')
+        self.assertEqual(1, outbox.pending())
+        self.assertEqual([['a@fake.fake']],
+                         [rs for _, rs, _ in server.messages])
+
+        outbox.retry_due()
+        self.assertEqual(0, outbox.pending())
+        self.assertEqual([['a@fake.fake'], ['b@fake.fake']],
+                         [rs for _, rs, _ in server.messages])
+
+    def make_outbox(self, server, **kwargs):
+        """Returns outbox sending through server, in a temporary dir."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        pool = emailer._SMTPPool('127.0.0.1', server.port)
+        self.addCleanup(pool.clear)
+        kwargs.setdefault('backoff_base', 0)
+        return emailer._Outbox(os.path.join(tmpdir, 'outbox.db'),
+                               pool.sendmail, **kwargs)
+
+    def start_smtp_server(self):
+        """Returns a running stub SMTP server."""
+        server = stubs.StubSMTPServer()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_outbox__sends(self):
+        """Verify delivered message is sent and removed from the outbox."""
+        server = self.start_smtp_server()
+        outbox = self.make_outbox(server)
+        self.assertTrue(outbox.deliver('from@fake.fake', ['to@fake.fake'],
+                                       'Subject: hi\n'))
+
+        self.assertEqual(1, len(server.messages))
+        self.assertEqual(['to@fake.fake'], server.messages[0][1])
+        self.assertEqual(0, outbox.pending())
+
+    def test_outbox__retries(self):
+        """Verify transient failures are kept and retried."""
+        server = self.start_smtp_server()
+        server.fail_next = 1
+        outbox = self.make_outbox(server)
+        self.assertFalse(outbox.deliver('from@fake.fake', ['to@fake.fake'],
+                                        'Subject: hi\n'))
+        self.assertEqual(0, len(server.messages))
+        self.assertEqual(1, outbox.pending())
+
+        self.assertEqual(1, outbox.retry_due())
+        self.assertEqual(1, len(server.messages))
+        self.assertEqual(0, outbox.pending())
+
+    def test_outbox__gives_up(self):
+        """Verify message is marked failed after max_attempts."""
+        server = self.start_smtp_server()
+        server.fail_next = 2
+        outbox = self.make_outbox(server, max_attempts=2)
+        outbox.deliver('from@fake.fake', ['to@fake.fake'], 'Subject: hi\n')
+        outbox.retry_due()
+
+        self.assertEqual(0, outbox.pending())
+        self.assertEqual(0, outbox.retry_due())
+        self.assertEqual(0, len(server.messages))
+
+    def test_outbox__replays_after_restart(self):
+        """Verify a new outbox on the same file sends what an earlier
+        process left pending."""
+        server = self.start_smtp_server()
+        server.fail_next = 1
+        outbox = self.make_outbox(server)
+        outbox.deliver('from@fake.fake', ['to@fake.fake'], 'Subject: hi\n')
+
+        restarted = emailer._Outbox(outbox.path, outbox.send)
+        self.assertEqual(1, restarted.retry_due())
+        self.assertEqual(1, len(server.messages))
+
+    def test_outbox__backoff(self):
+        """Verify retry delay grows exponentially, with jitter, up to the
+        cap."""
+        outbox = emailer._Outbox(':memory:', None, backoff_base=2,
+                                 backoff_cap=60)
+        for attempts, low, high in [(1, 2, 4), (3, 8, 16), (10, 30, 60)]:
+            delay = outbox._backoff(attempts)
+            self.assertTrue(low <= delay <= high)
+
+    @mock.patch('smtplib.SMTP')
+    def test_send_email__outbox(self, mock_smtp):
+        """Verify _send_email goes through the outbox when configured."""
+        self.prep_env()
+        outbox = mock.Mock()
+        with mock.patch('emailer._outbox', new=outbox):
+            emailer._send_email(self.msg_info)
+        outbox.deliver.assert_called_once_with(
+            self.sender, [self.recipient], mock.ANY)
+        self.assertEqual(0, mock_smtp.call_count)
+
+    @mock.patch('emailer._send_message')
+    def test_send_email__digest(self, mock_send):
+        """Verify emails are collected, not sent, in digest mode."""
+        self.prep_env()
+        digest = mock.Mock()
+        with mock.patch('emailer._digest', new=digest):
+            emailer._send_email(self.msg_info)
+        digest.add.assert_called_once_with(emailer._get_config().route,
+                                           self.msg_info)
+        self.assertEqual(0, mock_send.call_count)
+
+    def test_digest__max_batch(self):
+        """Verify a batch is flushed as soon as it is full, and the window
+        timer does not flush it again."""
+        flushed = []
+        digest = emailer._Digest(0.05, 2, lambda r, b: flushed.append(b))
+        digest.add(('a',), 1)
+        digest.add(('b',), 2)
+        digest.add(('a',), 3)
+        self.assertEqual([[1, 3]], flushed)
+        time.sleep(0.2)
+        self.assertEqual([[1, 3], [2]], flushed)
+
+    def test_digest__flush_all(self):
+        """Verify flush_all sends every pending batch."""
+        flushed = []
+        digest = emailer._Digest(60, 10, lambda r, b: flushed.append((r, b)))
+        digest.add(('a',), 1)
+        digest.add(('a',), 2)
+        digest.flush_all()
+        self.assertEqual([(('a',), [1, 2])], flushed)
+
+    def test_flush_pending(self):
+        """Verify queued deliveries are sent, then pending digests, and
+        errors reported, before the process exits."""
+        flushed = []
+        digest = emailer._Digest(60, 10, lambda r, b: flushed.append((r, b)))
+
+        def deliver(n):
+            time.sleep(0.05)
+            digest.add(('a',), n)
+
+        q = emailer._DeliveryQueue(deliver, workers=1, maxsize=10)
+        for n in range(3):
+            self.assertTrue(q.submit(n))
+        errors = mock.Mock()
+        with mock.patch('emailer._digest', new=digest), \
+                mock.patch('emailer._delivery_queue', new=q), \
+                mock.patch('emailer._errors', new=errors):
+            emailer.flush_pending()
+        self.assertEqual([(('a',), [0, 1, 2])], flushed)
+        errors.flush.assert_called_once_with()
+        self.assertFalse(q.submit(3))
+
+    def test_delivery_queue__drain_timeout(self):
+        """Verify draining gives up after the timeout."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        q = emailer._DeliveryQueue(lambda item: release.wait(),
+                                   workers=1, maxsize=10)
+        q.submit('first')
+        q.submit('second')
+        self.assertEqual(2, q.drain(0.05))
+
+    def test_digest__shared(self):
+        """Verify digests sharing state combine their msg_infos."""
+        flushed = []
+        state = sharedstate.MemoryState()
+        a, b = [emailer._Digest(60, 10, lambda r, b: flushed.append((r, b)),
+                                state=state) for _ in range(2)]
+        a.add(('to',), {'n': 1, 'route': ('to',)})
+        b.add(('to',), {'n': 2})
+        self.assertEqual(2, b.pending())
+        a.flush_all()
+        self.assertEqual([(('to',), [{'n': 1}, {'n': 2}])], flushed)
+        self.assertEqual(0, b.pending())
+
+    @mock.patch('smtplib.SMTP')
+    def test_send_digest__one(self, mock_smtp):
+        """Verify a digest of one email looks like a normal email."""
+        self.prep_env()
+        emailer._send_digest(emailer._get_config().route, [self.msg_info])
+        actual_msg = mock_smtp.return_value.sendmail.call_args[0]
+        self.check_msg(actual_msg)
+
+    @mock.patch('smtplib.SMTP')
+    def test_send_digest__many(self, mock_smtp):
+        """Verify a digest combines several emails under a summary
+        subject."""
+        self.prep_env()
+        other = dict(self.msg_info, revision='other-TEST-sha1')
+        emailer._send_digest(emailer._get_config().route,
+                             [self.msg_info, other])
+        actual_msg = mock_smtp.return_value.sendmail.call_args[0]
+        self.assertEqual([self.recipient], actual_msg[1])
+        assert '[Chapel Merge] 2 merges to TESTING/test' in actual_msg[2]
+
+    def test_get_digest_subject__repos(self):
+        """Verify digest subject counts repos when there are several."""
+        batch = [{'repo': 'a/b'}, {'repo': 'a/c'}, {'repo': 'a/b'}]
+        self.assertEqual('[Chapel Merge] 3 merges to 2 repos',
+                         emailer._get_digest_subject(batch))
+
+    def test_metrics__render(self):
+        """Verify counters, gauges and histograms render in Prometheus text
+        format."""
+        metrics = emailer._Metrics()
+        metrics.inc('commit_emailer_emails_skipped_total', reason='deleted')
+        metrics.inc('commit_emailer_emails_skipped_total', reason='deleted')
+        metrics.gauge('commit_emailer_delivery_queue_depth', lambda: 3)
+        metrics.observe('parse', 0.002)
+        metrics.observe('parse', 20)
+        text = metrics.render()
+
+        self.assertIn('# TYPE commit_emailer_emails_skipped_total counter\n'
+                      'commit_emailer_emails_skipped_total{reason="deleted"} 2'
+                      '\n', text)
+        self.assertIn('commit_emailer_delivery_queue_depth 3\n', text)
+        self.assertIn('# TYPE commit_emailer_stage_seconds histogram\n', text)
+        for line in ['{stage="parse",le="0.001"} 0',
+                     '{stage="parse",le="0.0025"} 1',
+                     '{stage="parse",le="10.0"} 1',
+                     '{stage="parse",le="+Inf"} 2']:
+            self.assertIn('commit_emailer_stage_seconds_bucket' + line, text)
+        self.assertIn('commit_emailer_stage_seconds_count{stage="parse"} 2',
+                      text)
+
+    def test_metrics__processes(self):
+        """Verify render adds up every process's counters, labels gauges
+        by pid, and skips gauges of exited processes."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        metrics = emailer._Metrics(tmpdir)
+        metrics.inc('commit_emailer_emails_sent_total')
+        metrics.gauge('commit_emailer_delivery_queue_depth', lambda: 1)
+        for pid in [os.getppid(), 2 ** 22 + 1]:
+            other = emailer._Metrics().snapshot()
+            other['pid'] = pid
+            other['counters'] = [['commit_emailer_emails_sent_total', [], 2]]
+            other['gauges'] = {'commit_emailer_delivery_queue_depth': 5}
+            with open(os.path.join(tmpdir, '{0}.json'.format(pid)), 'w') as f:
+                json.dump(other, f)
+        text = metrics.render()
+
+        self.assertIn('commit_emailer_emails_sent_total 5\n', text)
+        self.assertIn('commit_emailer_delivery_queue_depth{{pid="{0}"}} 1\n'
+                      .format(os.getpid()), text)
+        self.assertIn('commit_emailer_delivery_queue_depth{{pid="{0}"}} 5\n'
+                      .format(os.getppid()), text)
+        self.assertNotIn('pid="{0}"'.format(2 ** 22 + 1), text)
+
+    def test_metrics__endpoint(self):
+        """Verify /metrics counts webhooks and times the stages."""
+        with mock.patch('emailer._metrics', new=emailer._Metrics()):
+            self.app.post('/commit-email',
+                          headers={'x-github-event': 'whatevs'})
+            self.post_signed(json.dumps({'head_commit': {'message': 'x'}}))
+            r = self.app.get('/metrics')
+        self.assertEqual(200, r.status_code)
+        self.assertTrue(r.content_type.startswith('text/plain'))
+        text = r.get_data(as_text=True)
+        self.assertIn('{reason="not_push"} 1\n', text)
+        self.assertIn('{reason="not_merge"} 1\n', text)
+        self.assertIn('_seconds_count{stage="signature"} 1\n', text)
+
+    def test_metrics__sent_and_failed(self):
+        """Verify the SMTP pool counts sent and failed emails."""
+        server = self.start_smtp_server()
+        pool = emailer._SMTPPool('127.0.0.1', server.port)
+        self.addCleanup(pool.clear)
+        metrics = emailer._Metrics()
+        with mock.patch('emailer._metrics', new=metrics):
+            pool.sendmail('from@fake.fake', ['to@fake.fake'], 'Subject: hi\n')
+            server.fail_next = 1
+            self.assertRaises(smtplib.SMTPException, pool.sendmail,
+                              'from@fake.fake', ['to@fake.fake'], 'hi')
+        text = metrics.render()
+        self.assertIn('commit_emailer_emails_sent_total 1\n', text)
+        self.assertIn('commit_emailer_emails_failed_total 1\n', text)
+        self.assertIn('_count{stage="smtp_login"} 1\n', text)
+
     def test_get_sender__from_author(self):
         """Verify sent from author when appropriate config var set."""
+        self.prep_env()
         os.environ['GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR'] = 'whatevs'
+        emailer.reload_config()
         actual = emailer._get_sender('my-address')
         self.assertEqual('my-address', actual)
 
@@ -299,12 +1653,76 @@ class EmailerTests(unittest.TestCase):
         """Verify sent from config'd sender when appropriate config var
         not set.
         """
+        self.prep_env()
         if 'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in os.environ:
             del os.environ['GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR']
         os.environ['GITHUB_COMMIT_EMAILER_SENDER'] = 'noreply-addr'
+        emailer.reload_config()
         actual = emailer._get_sender('my-address')
         self.assertEqual('noreply-addr', actual)
 
+    def test_get_body(self):
+        """Verify body lines are not indented."""
+        self.prep_env()
+        body = emailer._get_body(self.msg_info)
+        self.assertTrue(body.startswith('Branch: the/TEST/master\n'
+                                        'Revision: some-TEST-sha1\n'))
+        self.assertIn('\nModified Files:\nR a.out\nR gen\n', body)
+        self.assertTrue(body.endswith('\nCompare: http://TEST.fake\n'))
+
+    def test_build_message__html(self):
+        """Verify HTML emails are multipart, with the msg_info escaped."""
+        os.environ['GITHUB_COMMIT_EMAILER_HTML'] = '1'
+        self.addCleanup(os.environ.pop, 'GITHUB_COMMIT_EMAILER_HTML')
+        self.prep_env()
+        self.addCleanup(self.prep_env)
+        msg_info = dict(self.msg_info, message='Merge <b>this</b> & that')
+        sender, route, subject, body, html_body = emailer._email_for(
+            msg_info)
+        self.assertIn('Merge &lt;b&gt;this&lt;/b&gt; &amp; that', html_body)
+        self.assertIn('<a href="http://TEST.fake">', html_body)
+
+        message = emailer._build_message(sender, route, subject, body,
+                                         html_body)
+        self.assertIn('Content-Type: multipart/alternative;', message)
+        self.assertIn('Content-Type: text/plain; charset="utf-8"', message)
+        self.assertIn('Content-Type: text/html; charset="utf-8"', message)
+
+    def test_templates__custom(self):
+        """Verify templates in the configured directory override the
+        defaults, and are recompiled when they change."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'subject.txt')
+        with open(path, 'w') as f:
+            f.write('{{ repo }}: {{ summary }}\n')
+        templates = emailer._Templates(tmpdir, check_interval=0)
+        self.assertEqual('a/b: hi\n', templates.render(
+            'subject.txt', repo='a/b', summary='hi'))
+        self.assertIn('Branch: x', templates.render(
+            'body.txt', **dict(self.msg_info, branch='x')))
+
+        with open(path, 'w') as f:
+            f.write('{{ summary }}!')
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        self.assertEqual('hi!', templates.render(
+            'subject.txt', repo='a/b', summary='hi'))
+
+        with open(path, 'w') as f:
+            f.write('{{ summary ')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual('hi!', templates.render(
+            'subject.txt', repo='a/b', summary='hi'))
+
+    def test_templates__invalid(self):
+        """Verify a template that does not compile makes the config
+        invalid."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'body.txt'), 'w') as f:
+            f.write('{% if %}')
+        self.assertRaises(ValueError, emailer._Templates, tmpdir)
+
     def test_get_subject(self):
         """Verify get_subject returns first line of commit message and
         repo name.
@@ -331,33 +1749,93 @@ class EmailerTests(unittest.TestCase):
         actual = emailer._get_subject('TEST/it', msg)
         self.assertEqual(expected, actual)
 
-    def test_valid_signature__true__str(self):
-        """Verify _valid_signature returns true when signature matches."""
-        body = '{"rock": "on"}'
+    def read_signed_body(self, header, signature, body, secret):
+        """Returns _read_signed_body of a request with body and signature in
+        header, checked against secret."""
+        request = mock.Mock()
+        request.headers = {header: signature}
+        request.content_length = len(body)
+        request.stream = io.BytesIO(body)
+        config = emailer._load_config({
+            'GITHUB_COMMIT_EMAILER_SECRET': secret,
+            'GITHUB_COMMIT_EMAILER_SENDER': self.sender,
+            'GITHUB_COMMIT_EMAILER_RECIPIENT': self.recipient})
+        return emailer._read_signed_body(request, config)
+
+    def test_read_signed_body__sha1(self):
+        """Verify the body is returned when the sha1 signature matches."""
+        body = b'{"rock": "on"}'
         secret = str(uuid.uuid4())
-        h = hmac.new(secret.encode('utf8'), body.encode('utf8'),
-                     digestmod="sha1")
-        sig = 'sha1=' + h.hexdigest()
-        gh_sig = sig
-        self.assertTrue(emailer._valid_signature(gh_sig, body, secret))
-
-    def test_valid_signature__true__unicode(self):
-        """Verify _valid_signature returns true when signature matches,\
-        even if github signature is unicode."""
-        body = '{"rock": "on"}'
+        h = hmac.new(secret.encode('utf8'), body, digestmod="sha1")
+        self.assertEqual(body, self.read_signed_body(
+            'x-hub-signature', 'sha1=' + h.hexdigest(), body, secret))
+
+    @mock.patch('emailer._send_email')
+    def test_signature__sha256_preferred(self, mock_send):
+        """Verify sha256 signature is checked when both are sent."""
+        headers = dict(self.headers, **{'x-hub-signature': 'sha1=bogus'})
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            r = self.post_signed(json.dumps(self.push_body()), headers)
+        self.assertEqual(b'yep', r.data)
+
+    @mock.patch('emailer._send_email')
+    def test_signature__sha1(self, mock_send):
+        """Verify requests with only a sha1 signature are accepted."""
+        data = json.dumps(self.push_body()).encode('utf-8')
+        h = hmac.new(b'sekret', data, digestmod='sha1')
+        headers = dict(self.headers, **{'x-hub-signature':
+                                        'sha1=' + h.hexdigest()})
+        with mock.patch.object(emailer._delivery_queue, 'workers', 0):
+            r = self.app.post('/commit-email', headers=headers, data=data)
+        self.assertEqual(b'yep', r.data)
+        self.assertEqual(1, mock_send.call_count)
+
+    def test_signature__unsigned(self):
+        """Verify unsigned requests are rejected without reading the body."""
+        request = mock.Mock()
+        request.headers = {}
+        config = emailer._get_config()
+        self.assertIsNone(emailer._read_signed_body(request, config))
+        self.assertEqual(0, request.stream.read.call_count)
+
+    def test_signature__too_large(self):
+        """Verify bodies over the size limit are rejected with a 413."""
+        with mock.patch('emailer._config',
+                        new=emailer._get_config()._replace(max_body=10)):
+            r = self.post_signed('x' * 11)
+        self.assertEqual(413, r.status_code)
+
+    def test_signature__too_large_streamed(self):
+        """Verify the size limit applies while reading, whatever the
+        Content-Length header says."""
+        request = mock.Mock()
+        request.headers = {'x-hub-signature-256': 'sha256=bogus'}
+        request.content_length = None
+        request.stream.read.side_effect = [b'x' * 6, b'x' * 6, b'']
+        config = emailer._get_config()._replace(max_body=10)
+        with emailer.app.test_request_context():
+            self.assertRaises(werkzeug.exceptions.RequestEntityTooLarge,
+                              emailer._read_signed_body, request, config)
+
+    def test_signature__keyed_hmac_reused(self):
+        """Verify the precomputed HMAC is copied, not updated, per check."""
+        config = emailer._get_config()
+        before = config.secret_macs['sha256'].hexdigest()
+        self.post_signed('{"head_commit": {"message": "Test"}}')
+        self.assertEqual(before, config.secret_macs['sha256'].hexdigest())
+
+    def test_read_signed_body__sha256(self):
+        """Verify the body is returned when the sha256 signature matches."""
+        body = b'{"rock": "on"}'
         secret = str(uuid.uuid4())
-        h = hmac.new(secret.encode('utf8'), body.encode('utf8'),
-                     digestmod="sha1")
-        sig = 'sha1=' + h.hexdigest()
-        gh_sig = str(sig)
-        self.assertTrue(emailer._valid_signature(gh_sig, body, secret))
-
-    def test_valid_signature__false(self):
-        """Verify _valid_signature returns False when signature does
-        not match."""
-        self.assertFalse(
-            emailer._valid_signature(str('adsf'), 'asdf', 'my-secret')
-        )
+        h = hmac.new(secret.encode('utf8'), body, digestmod="sha256")
+        self.assertEqual(body, self.read_signed_body(
+            'x-hub-signature-256', 'sha256=' + h.hexdigest(), body, secret))
+
+    def test_read_signed_body__mismatch(self):
+        """Verify None is returned when the signature does not match."""
+        self.assertIsNone(self.read_signed_body(
+            'x-hub-signature', 'adsf', b'asdf', 'my-secret'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+import json
+import mailbox
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import mock
+
+import bench
+import emailer
+import replay
+import stubs
+
+
+def make_lines(corpus):
+    """Returns JSONL lines recording the deliveries in a bench corpus."""
+    return [json.dumps({'headers': headers, 'body': body.decode('utf-8')}) +
+            '\n' for headers, body in corpus]
+
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.smtp = stubs.StubSMTPServer()
+        self.addCleanup(self.smtp.stop)
+        self.github = stubs.StubGitHubServer()
+        self.addCleanup(self.github.stop)
+        self.rollbar = stubs.StubRollbarServer()
+        self.addCleanup(self.rollbar.stop)
+        self.env = bench.app_env(self.smtp, self.github, self.rollbar, {})
+
+    def in_process(self):
+        """Configure the emailer in this process like the app env."""
+        patcher = mock.patch.dict(os.environ, self.env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(emailer.reload_config)
+        emailer.reload_config()
+        emailer._dedup.clear()
+        self.addCleanup(emailer._dedup.clear)
+
+    def test_read_deliveries(self):
+        """Verify lines are batched with their line numbers, skipping blank
+        lines."""
+        batches = list(replay.read_deliveries(['a', '\n', 'b', 'c'], 2))
+        self.assertEqual([[(1, 'a'), (3, 'b')], [(4, 'c')]], batches)
+
+    def test_replay__dry_run(self):
+        """Verify deliveries are checked like webhooks, and emails written
+        to an mbox and .eml files without being marked as handled."""
+        self.in_process()
+        corpus = bench.make_corpus(3, [3], 0)
+        headers, body = corpus[0]
+        lines = make_lines(corpus) + make_lines([
+            (dict(headers, **{'X-GitHub-Event': 'issues'}), body),
+            (dict(headers, **{'X-Hub-Signature-256': 'sha256=bad'}), body),
+            (headers, body),
+        ]) + ['not json\n']
+        mbox_path = os.path.join(self.tmp, 'out.mbox')
+        eml_dir = os.path.join(self.tmp, 'eml')
+
+        writer = replay._Writer(mbox_path, eml_dir)
+        outcomes = replay.replay(lines, 0, batch_size=2, writer=writer)
+        writer.close()
+        self.assertEqual({'written': 4, 'not_push': 1, 'bad_signature': 1,
+                          'invalid': 1}, dict(outcomes))
+        self.assertEqual(4, len(mailbox.mbox(mbox_path)))
+        self.assertEqual(['00000001.eml', '00000002.eml', '00000003.eml',
+                          '00000006.eml'], sorted(os.listdir(eml_dir)))
+        self.assertEqual(0, len(self.smtp.messages))
+
+    def test_replay__send(self):
+        """Verify emails are sent, and deliveries already sent skipped."""
+        self.in_process()
+        pool = emailer._SMTPPool('127.0.0.1', self.smtp.port)
+        self.addCleanup(pool.clear)
+        lines = make_lines(bench.make_corpus(3, [3], 0))
+        with mock.patch('emailer._smtp_pool', new=pool):
+            self.assertEqual({'sent': 3}, dict(replay.replay(lines, 0)))
+        self.assertEqual({'duplicate': 3}, dict(replay.replay(lines, 0)))
+        self.assertEqual(3, len(self.smtp.messages))
+
+    def test_main__missing_config_file(self):
+        """Verify a config file that cannot be read is a usage error."""
+        path = os.path.join(self.tmp, 'missing.env')
+        with mock.patch.dict(os.environ, self.env,
+                             GITHUB_COMMIT_EMAILER_CONFIG=path), \
+                mock.patch('sys.stderr'), \
+                self.assertRaises(SystemExit) as cm:
+            replay.main([os.devnull])
+        self.assertEqual(2, cm.exception.code)
+
+    def test_main__workers(self):
+        """Verify a file is replayed by a process pool, with a summary."""
+        path = os.path.join(self.tmp, 'deliveries.jsonl')
+        with open(path, 'w') as f:
+            f.writelines(make_lines(bench.make_corpus(7, [3], 0.5)))
+        here = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.check_output(
+            [sys.executable, 'replay.py', path, '--workers', '2',
+             '--batch-size', '2'],
+            cwd=here, env=self.env, stderr=subprocess.DEVNULL)
+        summary = json.loads(out)
+        self.assertEqual(7, summary['deliveries'])
+        self.assertEqual({'sent': 7}, summary['outcomes'])
+        self.assertEqual(7, len(self.smtp.messages))
+        self.assertEqual(4, self.github.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
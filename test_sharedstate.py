@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import mock
+
+import sharedstate
+import stubs
+
+
+class SharedStateTests(unittest.TestCase):
+
+    def check_state(self, state):
+        """Verify state implements the shared state interface."""
+        state.clear()
+        self.assertIsNone(state.get('a'))
+        state.set('a', 'x\u2026')
+        self.assertEqual('x\u2026', state.get('a'))
+        self.assertFalse(state.add('a', 'y'))
+        self.assertTrue(state.add('b', 'y', ttl=0.05))
+        self.assertEqual(1, state.incr('n', ttl=0.05))
+        self.assertEqual(3, state.incr('n', 2, ttl=0.05))
+        time.sleep(0.1)
+        self.assertIsNone(state.get('b'))
+        self.assertTrue(state.add('b', 'z'))
+        self.assertEqual(1, state.incr('n'))
+        state.delete('a')
+        self.assertIsNone(state.get('a'))
+
+        self.assertEqual([1, 2], [state.push('q', v) for v in '12'])
+        self.assertEqual(2, state.length('q'))
+        self.assertEqual(['1', '2', None], [state.pop('q') for _ in '123'])
+        self.assertEqual(0, state.length('q'))
+
+        state.set('p:a', 'x')
+        state.push('p:q', 'x')
+        state.clear('p:')
+        self.assertIsNone(state.get('p:a'))
+        self.assertEqual(0, state.length('p:q'))
+        self.assertEqual('z', state.get('b'))
+
+    def test_memory_state(self):
+        """Verify the in-process shared state."""
+        self.check_state(sharedstate.MemoryState())
+
+    def test_sqlite_state(self):
+        """Verify the SQLite shared state, shared by two instances."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'state.db')
+        state = sharedstate.SQLiteState(path)
+        self.check_state(state)
+        self.assertEqual('z', sharedstate.SQLiteState(path).get('b'))
+
+    def test_sqlite_state__forked(self):
+        """Verify a forked process opens its own database connection."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        state = sharedstate.SQLiteState(os.path.join(tmpdir, 'state.db'))
+        state.set('a', 'x')
+        parent_db = state._db
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(parent_db, state._db)
+            self.assertEqual('x', state.get('a'))
+
+    def test_redis_state(self):
+        """Verify the Redis client against the stand-in, logging in and
+        reusing one connection."""
+        redis = stubs.StubRedisServer(password='p@ss')
+        self.addCleanup(redis.stop)
+        state = sharedstate.RedisState('127.0.0.1', redis.port, db=2,
+                                       password='p@ss')
+        self.check_state(state)
+        self.assertEqual(1, redis.connections)
+        self.assertEqual({b'commit_emailer:b', b'commit_emailer:n'},
+                         set(redis.values))
+
+    def test_redis_state__errors(self):
+        """Verify dropped connections and error replies raise StateError,
+        and a new connection is opened after a drop."""
+        redis = stubs.StubRedisServer()
+        self.addCleanup(redis.stop)
+        state = sharedstate.RedisState('127.0.0.1', redis.port)
+        state.set('a', 'x')
+        redis.fail_next = 1
+        with self.assertRaises(sharedstate.StateError):
+            state.get('a')
+        self.assertEqual('x', state.get('a'))
+        self.assertEqual(2, redis.connections)
+        with self.assertRaises(sharedstate.StateError):
+            state.incr('a')
+        self.assertEqual('x', state.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()